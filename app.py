@@ -1,24 +1,48 @@
-from flask import Flask, render_template, request, redirect, url_for, send_file, session, make_response, jsonify
+from flask import Flask, render_template, stream_template, stream_with_context, Response, request, redirect, url_for, send_file, session, make_response, jsonify, g, has_app_context
 import os
 from datetime import datetime, timedelta, date
 import calendar
 import psycopg
-from psycopg.rows import dict_row
-import urllib.parse
-import csv
-import io
-import threading
-import requests
-import time
+from psycopg.rows import dict_row, scalar_row, tuple_row
+from markupsafe import escape
+import itertools
+import json
 from functools import wraps
 
 # Импортируем функции из отдельных файлов
 from database_fix import fix_database_operation
+import availability
+import blocked_index
+import booking_record
+import bulk_ops
+import capacity
+import date_blocks
+import db
+import delta_sync
+import export_cache
+import instrumentation
+import jobs
+import keep_alive
+import metrics
+import notifications
+import pending_expiry
+import schema
+import scheduler
+import shared_availability
+import slow_queries
+import submission_guard
+import xlsx_stream
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = os.environ.get('SECRET_KEY', 'dev-key-12345')
 app.config['ADMIN_PASSWORD'] = os.environ.get('ADMIN_PASSWORD', 'YFNS_BOT_Password123')
 
+# Замеры времени запросов (БД / шаблоны / Server-Timing)
+instrumentation.init_app(app)
+metrics.register_collector(db.pool_metrics)
+slow_queries.init()
+jobs.init_app(app)
+
 # Русские названия месяцев
 RUSSIAN_MONTHS = [
     'Январь', 'Февраль', 'Март', 'Апрель', 'Май', 'Июнь',
@@ -28,56 +52,49 @@ RUSSIAN_MONTHS = [
 RUSSIAN_WEEKDAYS_SHORT = ['Пн', 'Вт', 'Ср', 'Чт', 'Пт', 'Сб', 'Вс']
 RUSSIAN_WEEKDAYS_FULL = ['Понедельник', 'Вторник', 'Среда', 'Четверг', 'Пятница', 'Суббота', 'Воскресенье']
 
-# Дни недели, которые должны быть закрыты (понедельник=0, пятница=4)
-CLOSED_WEEKDAYS = [0, 4]
-
 # Флаг для отслеживания инициализации БД
 db_initialized = False
 
-def start_keep_alive():
-    """Запускает keep-alive в фоновом потоке"""
-    def ping_self():
-        url = os.environ.get('RENDER_EXTERNAL_URL', 'https://taxexcursion.ru')
-        
-        while True:
-            try:
-                response = requests.get(f"{url}/health", timeout=10)
-                print(f"[{datetime.now()}] Keep-alive ping: {response.status_code}")
-            except Exception as e:
-                print(f"[{datetime.now()}] Keep-alive failed: {e}")
-            
-            time.sleep(600)
-
-    if os.environ.get('RENDER') == 'true':
-        thread = threading.Thread(target=ping_self, daemon=True)
-        thread.start()
-        print("✅ Keep-alive service started")
-
 def get_db_connection():
-    """Подключение к PostgreSQL с psycopg3"""
-    database_url = os.environ.get('DATABASE_URL')
-    
-    if database_url:
-        parsed_url = urllib.parse.urlparse(database_url)
-        
-        conn = psycopg.connect(
-            dbname=parsed_url.path[1:],
-            user=parsed_url.username,
-            password=parsed_url.password,
-            host=parsed_url.hostname,
-            port=parsed_url.port,
-            sslmode='require'
-        )
-    else:
-        conn = psycopg.connect(
-            dbname='tax_excursion',
-            user='postgres',
-            password='postgres',
-            host='localhost'
-        )
+    """Подключение к PostgreSQL из пула воркера (см. db.py)"""
+    conn = db.get_db_connection()
+    
+    # Запоминаем аренду, чтобы вернуть соединение в пул даже если маршрут упал до close()
+    if has_app_context():
+        g.setdefault('db_leases', []).append((conn, conn._lease))
     
     return conn
 
+@app.teardown_appcontext
+def release_db_connections(exc):
+    """Возвращает в пул соединения, которые не были закрыты в обработчике"""
+    for conn, lease in g.pop('db_leases', []):
+        if getattr(conn, '_lease', None) is lease and getattr(conn, '_pool', None) is not None:
+            conn.close()
+
+def init_worker():
+    """Инициализация ресурсов воркера после fork (вызывается из gunicorn.conf.py)"""
+    try:
+        db.open_pool()
+        jobs.start_workers()
+        notifications.start_dispatcher()
+        # Периодические задачи: поток в каждом воркере, выполняет только лидер
+        scheduler.start()
+        # Карта заблокированных дат загружается в фоне, до нее - точечные запросы
+        blocked_index.get_index()
+        print(f"✅ Воркер {os.getpid()}: пул соединений открыт, фоновые задачи запущены")
+    except Exception as e:
+        print(f"❌ Воркер {os.getpid()}: ошибка открытия пула: {e}")
+
+def shutdown_worker():
+    """Освобождение ресурсов воркера при остановке"""
+    scheduler.stop()
+    jobs.stop_workers()
+    notifications.stop_dispatcher()
+    db.close_pool()
+    metrics.flush()
+    print(f"✅ Воркер {os.getpid()}: пул соединений закрыт")
+
 def init_database():
     """Инициализация БД с таблицей для заблокированных дат"""
     global db_initialized
@@ -85,31 +102,11 @@ def init_database():
         conn = get_db_connection()
         cursor = conn.cursor()
         
-        # Создаем таблицу бронирований если ее нет
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS bookings (
-                id SERIAL PRIMARY KEY,
-                username VARCHAR(100),
-                school_name VARCHAR(200) NOT NULL,
-                class_number VARCHAR(20) NOT NULL,
-                class_profile VARCHAR(100),
-                excursion_date DATE NOT NULL,
-                contact_phone VARCHAR(20) NOT NULL,
-                participants_count INTEGER NOT NULL,
-                booking_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                additional_info TEXT,
-                status VARCHAR(20) DEFAULT 'pending'
-            )
-        ''')
-        
-        # Создаем таблицу для заблокированных дат
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS blocked_dates (
-                id SERIAL PRIMARY KEY,
-                blocked_date DATE NOT NULL UNIQUE,
-                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        # Таблицы бронирований и заблокированных дат, если их нет
+        schema.create_bookings_table(cursor)
+        schema.create_blocked_dates_table(cursor)
+        # Колонки, индексы и служебные таблицы (см. schema.py)
+        schema.ensure_schema(cursor)
         
         conn.commit()
         cursor.close()
@@ -126,68 +123,50 @@ def check_and_init_db():
     if not db_initialized:
         init_database()
 
-def get_blocked_dates():
-    """Получает заблокированные даты из БД"""
+def is_date_blocked(date_obj):
+    """Заблокирована ли дата - для календаря (битовая карта в памяти, см. blocked_index.py)"""
     check_and_init_db()
     
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('SELECT blocked_date FROM blocked_dates')
-        dates = cursor.fetchall()
-        
-        cursor.close()
-        conn.close()
-        
-        return {date[0].isoformat() for date in dates}
-        
+        return blocked_index.is_blocked(date_obj)
     except Exception as e:
-        print(f"Ошибка получения заблокированных дат: {e}")
-        return set()
+        print(f"Ошибка проверки заблокированной даты: {e}")
+        return False
 
-def is_date_blocked(date_obj):
-    """Проверяет, заблокирована ли дата"""
-    blocked_dates = get_blocked_dates()
-    return date_obj.isoformat() in blocked_dates
+def change_blocked_dates(data, blocked):
+    """Блокирует (blocked=True) или разблокирует дни из запроса админки.
 
-def block_date(date_str):
-    """Блокирует дату"""
+    data - одна дата, период, шаблон дней недели или список праздников
+    (см. date_blocks.parse_spec; ошибки в них - ValueError).
+    Возвращает (успех, сообщение, сводка).
+    """
     check_and_init_db()
+    spec = date_blocks.parse_spec(data)
     
     try:
         conn = get_db_connection()
         cursor = conn.cursor()
         
-        cursor.execute('INSERT INTO blocked_dates (blocked_date) VALUES (%s) ON CONFLICT DO NOTHING', (date_str,))
+        if blocked:
+            summary = date_blocks.block(cursor, spec)
+        else:
+            summary = date_blocks.unblock(cursor, spec)
         conn.commit()
         
         cursor.close()
         conn.close()
         
-        return True, "Дата заблокирована"
-        
-    except Exception as e:
-        return False, str(e)
-
-def unblock_date(date_str):
-    """Разблокирует дату"""
-    check_and_init_db()
-    
-    try:
-        conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        cursor.execute('DELETE FROM blocked_dates WHERE blocked_date = %s', (date_str,))
-        conn.commit()
-        
-        cursor.close()
-        conn.close()
+        changed = [date.fromisoformat(day) for day in summary['dates']]
+        if blocked:
+            blocked_index.apply(blocked=changed)
+        else:
+            blocked_index.apply(unblocked=changed)
+        shared_availability.update_days(changed)
         
-        return True, "Дата разблокирована"
+        return True, date_blocks.summary_message(summary, blocked), summary
         
     except Exception as e:
-        return False, str(e)
+        return False, str(e), {}
 
 def get_bookings_count_by_date():
     """Количество записей по датам"""
@@ -197,16 +176,11 @@ def get_bookings_count_by_date():
         conn = get_db_connection()
         cursor = conn.cursor()
         
-        cursor.execute('''
-            SELECT excursion_date::text, COUNT(*) as count 
-            FROM bookings 
-            WHERE (status != 'cancelled' OR status IS NULL)
-            GROUP BY excursion_date
-        ''')
+        cursor.execute(availability.COUNTS_BY_DATE_SQL)
         
         booked_dates = {}
         for row in cursor.fetchall():
-            booked_dates[row[0]] = row[1]
+            booked_dates[row[0].isoformat()] = row[1]
         
         cursor.close()
         conn.close()
@@ -216,6 +190,25 @@ def get_bookings_count_by_date():
         print(f"Ошибка получения бронирований: {e}")
         return {}
 
+def get_range_days(year, month, months=1):
+    """Дни нескольких месяцев со статусом и свободными местами.
+
+    Занятость берется из общей памяти воркеров, а для дней вне ее окна -
+    одним запросом к БД.
+    """
+    start, end = availability.month_bounds(year, month, months)
+    loads = shared_availability.read_range(start, end)
+    if loads is not None:
+        return availability.classify_loads(start, loads, capacity.get_rules())
+    
+    check_and_init_db()
+    conn = get_db_connection()
+    cursor = conn.cursor(row_factory=dict_row)
+    rows = availability.classify_range(cursor, start, end, capacity.get_rules())
+    cursor.close()
+    conn.close()
+    return rows
+
 def generate_calendar_data(year=None, month=None):
     """Генерация календаря с учетом закрытых дней недели и заблокированных дат"""
     today = date.today()
@@ -225,12 +218,8 @@ def generate_calendar_data(year=None, month=None):
     if month is None:
         month = today.month
     
-    _, num_days = calendar.monthrange(year, month)
     first_weekday = calendar.weekday(year, month, 1)
     
-    bookings = get_bookings_count_by_date()
-    blocked_dates_set = get_blocked_dates()
-    
     calendar_data = {
         'year': year,
         'month': month,
@@ -247,46 +236,21 @@ def generate_calendar_data(year=None, month=None):
     for _ in range(first_weekday):
         days.append(None)
     
-    for day in range(1, num_days + 1):
-        date_obj = date(year, month, day)
-        date_str = date_obj.isoformat()
+    # Статусы всех дней месяца посчитаны в PostgreSQL (availability.py)
+    for row in get_range_days(year, month):
+        date_obj = row['day']
         weekday = date_obj.weekday()
-        is_weekend = weekday >= 5
-        is_closed_weekday = weekday in CLOSED_WEEKDAYS
-        
-        if date_obj < today:
-            status = 'past'
-            available_slots = 0
-        elif is_weekend:
-            status = 'weekend'
-            available_slots = 0
-        elif is_closed_weekday:
-            status = 'closed'
-            available_slots = 0
-        elif date_str in blocked_dates_set:
-            status = 'blocked'
-            available_slots = 0
-        else:
-            bookings_count = bookings.get(date_str, 0)
-            available_slots = max(0, 2 - bookings_count)
-            
-            if available_slots == 0:
-                status = 'booked'
-            elif available_slots == 1:
-                status = 'limited'
-            else:
-                status = 'available'
-        
         days.append({
-            'day': day,
-            'date_str': date_str,
+            'day': date_obj.day,
+            'date_str': date_obj.isoformat(),
             'date_obj': date_obj,
-            'status': status,
-            'available_slots': available_slots,
+            'status': row['status'],
+            'available_slots': row['available_slots'],
+            'total_slots': row['total_slots'],
             'is_today': date_obj == today,
-            'is_weekend': is_weekend,
-            'is_closed_weekday': is_closed_weekday,
-            'is_blocked': date_str in blocked_dates_set,
+            'is_weekend': weekday >= 5,
+            'is_closed_weekday': row['total_slots'] == 0,
+            'is_blocked': row['blocked'],
             'weekday_name': RUSSIAN_WEEKDAYS_FULL[weekday],
         })
     
@@ -355,6 +319,47 @@ def month_view(year, month):
     except:
         return redirect('/')
 
+@app.route('/api/availability')
+def api_availability():
+    """Доступность на несколько месяцев вперед: ?start=YYYY-MM&months=N"""
+    try:
+        today = date.today()
+        start = request.args.get('start')
+        if start:
+            year, month = (int(part) for part in start.split('-')[:2])
+        else:
+            year, month = today.year, today.month
+        months = int(request.args.get('months', 3))
+        rows = get_range_days(year, month, months)
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
+    except Exception as e:
+        print(f"Ошибка расчета доступности: {e}")
+        return jsonify({'success': False, 'message': 'Ошибка расчета доступности'}), 500
+    
+    return jsonify({
+        'success': True,
+        'start': rows[0]['day'].isoformat(),
+        'end': rows[-1]['day'].isoformat(),
+        'months': [
+            {
+                'year': year,
+                'month': month,
+                'month_name': RUSSIAN_MONTHS[month - 1],
+                'days': [
+                    {
+                        'date': row['day'].isoformat(),
+                        'status': row['status'],
+                        'available_slots': row['available_slots'],
+                        'total_slots': row['total_slots'],
+                    }
+                    for row in month_rows
+                ],
+            }
+            for year, month, month_rows in availability.by_month(rows)
+        ],
+    })
+
 @app.route('/book/<date_str>')
 def book_date(date_str):
     """Страница записи"""
@@ -391,13 +396,14 @@ def book_date(date_str):
             </html>
             ''', 400
         
-        if weekday in CLOSED_WEEKDAYS:
+        day_capacity = capacity.get_rules().for_day(date_obj)
+        if day_capacity.closed:
             return f'''
             <!DOCTYPE html>
             <html>
             <body style="font-family: Arial; padding: 40px; text-align: center;">
                 <h1 style="color: #e74c3c;">❌ Запись недоступна</h1>
-                <p>По понедельникам и пятницам экскурсии не проводятся.</p>
+                <p>В этот день экскурсии не проводятся.</p>
                 <a href="/" style="display: inline-block; padding: 12px 24px; background: #3498db; color: white; text-decoration: none; border-radius: 5px;">
                     Вернуться к календарю
                 </a>
@@ -405,7 +411,14 @@ def book_date(date_str):
             </html>
             ''', 400
         
-        if is_date_blocked(date_obj):
+        # Занятость дня - из общей памяти воркеров, без нее - из БД
+        load = shared_availability.read_day(date_obj)
+        if load is not None:
+            bookings_count, participants, blocked = load
+        else:
+            blocked = is_date_blocked(date_obj)
+        
+        if blocked:
             return '''
             <!DOCTYPE html>
             <html>
@@ -418,10 +431,17 @@ def book_date(date_str):
             </html>
             ''', 400
         
-        bookings = get_bookings_count_by_date()
-        bookings_count = bookings.get(date_str, 0)
+        # Занятые времена в общей памяти не хранятся
+        taken_slots = []
+        if load is None or day_capacity.time_slots:
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            bookings_count, participants, taken_slots = capacity.day_load(cursor, date_obj)
+            cursor.close()
+            conn.close()
         
-        if bookings_count >= 2:
+        available_slots = day_capacity.available(bookings_count, participants)
+        if available_slots == 0:
             return '''
             <!DOCTYPE html>
             <html>
@@ -434,17 +454,45 @@ def book_date(date_str):
             </html>
             ''', 400
         
-        available_slots = 2 - bookings_count
-        
         return render_template('booking.html',
                              date_str=date_str,
                              date_formatted=date_obj.strftime('%d.%m.%Y'),
                              weekday=RUSSIAN_WEEKDAYS_FULL[weekday],
-                             available_slots=available_slots)
+                             available_slots=available_slots,
+                             total_slots=day_capacity.slots,
+                             time_slots=day_capacity.free_time_slots(taken_slots),
+                             max_participants=day_capacity.participants_left(participants),
+                             idempotency_key=submission_guard.new_idempotency_key())
         
     except:
         return redirect('/')
 
+def booking_error_page(message, details='', back_url='/', back_label='Вернуться к календарю'):
+    """Страница ошибки записи в стиле остальных страниц"""
+    return f'''
+    <!DOCTYPE html>
+    <html>
+    <body style="font-family: Arial; padding: 40px; text-align: center;">
+        <h1 style="color: #e74c3c;">❌ {message}</h1>
+        {f'<p>{details}</p>' if details else ''}
+        <a href="{back_url}" style="display: inline-block; padding: 12px 24px; background: #3498db; color: white; text-decoration: none; border-radius: 5px;">
+            {back_label}
+        </a>
+    </body>
+    </html>
+    '''
+
+def duplicate_booking_page(back_url='/admin'):
+    """Ответ админке: изменение нарушает правило "одна активная запись класса на дату"
+
+    Срабатывает при восстановлении отмененной записи или переносе на дату,
+    где у того же класса уже есть активная запись (индекс submission_guard.DUPLICATE_INDEX).
+    """
+    return booking_error_page('Дубль записи',
+                              'У этого класса уже есть активная запись на эту дату. '
+                              'Отмените или перенесите ее и повторите изменение.',
+                              back_url=back_url, back_label='Вернуться в админ-панель'), 409
+
 @app.route('/submit_booking', methods=['POST'])
 def submit_booking():
     """Обработка формы записи"""
@@ -459,6 +507,8 @@ def submit_booking():
         contact_phone = request.form.get('contact_phone')
         participants_count = request.form.get('participants_count')
         additional_info = request.form.get('additional_info', '')
+        time_slot = request.form.get('time_slot') or None
+        idempotency_key = submission_guard.parse_idempotency_key(request.form.get('idempotency_key'))
         
         # Валидация
         if not all([excursion_date, username, school_name, class_number, 
@@ -475,42 +525,111 @@ def submit_booking():
             </html>
             ''', 400
         
-        # Проверяем доступность
-        bookings = get_bookings_count_by_date()
-        current_count = bookings.get(excursion_date, 0)
+        try:
+            date_obj = date.fromisoformat(excursion_date)
+            participants_count = int(participants_count)
+        except ValueError:
+            return booking_error_page('Некорректная дата или количество участников'), 400
+        if not 1 <= participants_count <= capacity.MAX_GROUP_SIZE:
+            return booking_error_page(f'Количество участников - от 1 до {capacity.MAX_GROUP_SIZE}'), 400
         
-        if current_count >= 2:
-            return '''
-            <!DOCTYPE html>
-            <html>
-            <body style="font-family: Arial; padding: 40px; text-align: center;">
-                <h1 style="color: #e74c3c;">❌ На эту дату уже нет свободных мест</h1>
-                <p>Максимум 2 группы в день.</p>
-                <a href="/" style="display: inline-block; padding: 12px 24px; background: #3498db; color: white; text-decoration: none; border-radius: 5px;">
-                    Вернуться к календарю
-                </a>
-            </body>
-            </html>
-            '''
+        day_capacity = capacity.get_rules().for_day(date_obj)
         
-        # Сохраняем в БД
         conn = get_db_connection()
-        cursor = conn.cursor()
+        cursor = conn.cursor(row_factory=dict_row)
         
-        cursor.execute('''
-            INSERT INTO bookings 
-            (username, school_name, class_number, class_profile, 
-             excursion_date, contact_phone, participants_count, additional_info)
-            VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-        ''', (username, school_name, class_number, class_profile,
-              excursion_date, contact_phone, int(participants_count), additional_info))
+        # Лимит частоты: списанные жетоны фиксируются сразу, даже если
+        # заявку дальше отклонят
+        allowed = submission_guard.allow(cursor, submission_guard.client_keys())
+        conn.commit()
+        if not allowed:
+            cursor.close()
+            conn.close()
+            metrics.inc('bookings_rejected_total', reason='rate_limit')
+            return booking_error_page('Слишком много заявок',
+                                      'Пожалуйста, подождите минуту и попробуйте снова.'), 429
+        
+        # Проверка и вставка под блокировкой дня: две заявки на последнее
+        # место не пройдут обе
+        capacity.lock_day(cursor, date_obj)
+        
+        # Повторная отправка той же формы - запись уже создана
+        if idempotency_key:
+            cursor.execute('SELECT excursion_date, school_name FROM bookings WHERE idempotency_key = %s',
+                           (idempotency_key,))
+            existing = cursor.fetchone()
+            if existing:
+                conn.rollback()
+                cursor.close()
+                conn.close()
+                metrics.inc('bookings_rejected_total', reason='repeat')
+                return render_template('success.html',
+                                     date_formatted=existing['excursion_date'].strftime('%d.%m.%Y'),
+                                     school_name=existing['school_name'])
+        
+        # Блокировку даты проверяем по таблице под той же блокировкой дня, что
+        # и у админки: карта в памяти воркера (blocked_index) может отставать
+        cursor.execute('SELECT 1 FROM blocked_dates WHERE blocked_date = %s', (date_obj,))
+        if cursor.fetchone():
+            conn.rollback()
+            cursor.close()
+            conn.close()
+            metrics.inc('bookings_rejected_total', reason='blocked')
+            return booking_error_page('На эту дату запись временно недоступна'), 400
+        
+        bookings_count, participants, taken_slots = capacity.day_load(cursor, date_obj)
+        
+        error = details = None
+        if day_capacity.available(bookings_count, participants) == 0:
+            error = 'На эту дату уже нет свободных мест'
+            details = f'Максимум групп в день: {day_capacity.slots}.'
+        elif participants_count > day_capacity.participants_left(participants):
+            error = f'На эту дату осталось мест для участников: {day_capacity.participants_left(participants)}'
+        elif day_capacity.time_slots and time_slot not in day_capacity.free_time_slots(taken_slots):
+            error = 'Выбранное время уже занято или не указано'
+        elif not day_capacity.time_slots:
+            time_slot = None
+        
+        if error:
+            conn.rollback()
+            cursor.close()
+            conn.close()
+            return booking_error_page(error, details)
+        
+        # Сохраняем в БД
+        try:
+            cursor.execute(f'''
+                INSERT INTO bookings 
+                (username, school_name, class_number, class_profile, 
+                 excursion_date, contact_phone, participants_count, additional_info, time_slot,
+                 idempotency_key)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, %s)
+                RETURNING {notifications.BOOKING_FIELDS}
+            ''', (username, school_name, class_number, class_profile,
+                  excursion_date, contact_phone, participants_count, additional_info, time_slot,
+                  idempotency_key))
+        except psycopg.errors.UniqueViolation as e:
+            conn.rollback()
+            cursor.close()
+            conn.close()
+            if not submission_guard.is_duplicate_error(e):
+                raise
+            metrics.inc('bookings_rejected_total', reason='duplicate')
+            return booking_error_page('Этот класс уже записан на эту дату',
+                                      f'{escape(school_name)}, {escape(class_number)}: заявка уже есть. '
+                                      'Если нужно что-то изменить, позвоните нам.'), 409
+        
+        # Уведомления пишутся в той же транзакции, а отправляются в фоне
+        notifications.enqueue(cursor, 'booking_created', cursor.fetchone())
         
         conn.commit()
         cursor.close()
         conn.close()
+        shared_availability.update_days([date_obj])
+        notifications.wakeup()
+        metrics.inc('bookings_created_total')
         
         # Успех
-        date_obj = date.fromisoformat(excursion_date)
         return render_template('success.html',
                              date_formatted=date_obj.strftime('%d.%m.%Y'),
                              school_name=school_name)
@@ -602,7 +721,6 @@ def admin():
         search = request.args.get('search', '')
         
         conn = get_db_connection()
-        cursor = conn.cursor(row_factory=dict_row)
         
         # Базовый запрос
         query = '''
@@ -611,53 +729,18 @@ def admin():
                    participants_count, booking_date, status, additional_info
             FROM bookings 
         '''
-        params = []
-        where_clauses = []
-        
-        if status_filter != 'all':
-            where_clauses.append('status = %s')
-            params.append(status_filter)
-        
-        if date_from:
-            where_clauses.append('excursion_date >= %s')
-            params.append(date_from)
-        
-        if date_to:
-            where_clauses.append('excursion_date <= %s')
-            params.append(date_to)
-        
-        if search:
-            where_clauses.append('''
-                (school_name ILIKE %s OR 
-                 username ILIKE %s OR 
-                 contact_phone ILIKE %s)
-            ''')
-            search_term = f'%{search}%'
-            params.extend([search_term, search_term, search_term])
-        
-        if where_clauses:
-            query += ' WHERE ' + ' AND '.join(where_clauses)
+        where_sql, params = bookings_where(export_filters(request.args))
+        query += where_sql
         
         query += ' ORDER BY excursion_date DESC, booking_date DESC'
         
-        cursor.execute(query, params)
-        bookings = cursor.fetchall()
-        
-        # Статистика
-        cursor.execute('SELECT COUNT(*) as total FROM bookings')
-        total = cursor.fetchone()['total']
-        
-        cursor.execute('SELECT COUNT(*) as pending FROM bookings WHERE status = %s', ('pending',))
-        pending = cursor.fetchone()['pending']
-        
-        cursor.execute('SELECT COUNT(*) as confirmed FROM bookings WHERE status = %s', ('confirmed',))
-        confirmed = cursor.fetchone()['confirmed']
-        
-        cursor.execute('SELECT COUNT(*) as cancelled FROM bookings WHERE status = %s', ('cancelled',))
-        cancelled = cursor.fetchone()['cancelled']
-        
-        # Статистика по месяцам
-        cursor.execute('''
+        # Статистика: независимые запросы одной пачкой (один сетевой цикл)
+        total, pending, confirmed, cancelled, monthly_stats = db.run_batch(conn, [
+            'SELECT COUNT(*) as count FROM bookings',
+            ('SELECT COUNT(*) as count FROM bookings WHERE status = %s', ('pending',)),
+            ('SELECT COUNT(*) as count FROM bookings WHERE status = %s', ('confirmed',)),
+            ('SELECT COUNT(*) as count FROM bookings WHERE status = %s', ('cancelled',)),
+            '''
             SELECT 
                 DATE_TRUNC('month', excursion_date) as month,
                 COUNT(*) as count
@@ -665,13 +748,18 @@ def admin():
             WHERE excursion_date >= CURRENT_DATE - INTERVAL '6 months'
             GROUP BY DATE_TRUNC('month', excursion_date)
             ORDER BY month DESC
-        ''')
-        monthly_stats = cursor.fetchall()
-        
-        cursor.close()
-        conn.close()
-        
-        return render_template('admin.html', 
+            ''',
+        ], row_factory=dict_row)
+        total, pending, confirmed, cancelled = (rows[0]['count'] for rows in (total, pending, confirmed, cancelled))
+        
+        # Записи читаются серверным курсором по мере рендеринга шаблона.
+        # Первую строку читаем сразу: ошибка SQL попадет в except ниже,
+        # а не в середину уже начатого ответа
+        bookings = db.StreamedRows(conn, query, params, row_factory=booking_record.booking_row)
+        bool(bookings)
+        
+        # Соединение вернется в пул в teardown, когда шаблон будет дорендерен
+        return stream_template('admin.html', 
                              bookings=bookings,
                              status_filter=status_filter,
                              date_from=date_from,
@@ -684,6 +772,7 @@ def admin():
                                  'cancelled': cancelled,
                                  'monthly_stats': monthly_stats
                              },
+                             last_sync=session.get('delta_watermark'),
                              today=date.today())
     except Exception as e:
         return f'''
@@ -697,49 +786,172 @@ def admin():
         </html>
         ''', 500
 
-@app.route('/admin/block_date', methods=['POST'])
-@admin_required
-def admin_block_date():
-    """Блокировка даты через API"""
+def blocked_dates_response(blocked):
+    """Ответ API блокировки: одна дата, период, дни недели или список праздников"""
     try:
-        data = request.get_json()
-        date_str = data.get('date')
-        
-        if not date_str:
-            return jsonify({'success': False, 'message': 'Дата не указана'}), 400
+        data = request.get_json(silent=True) or {}
         
-        success, message = block_date(date_str)
+        success, message, summary = change_blocked_dates(data, blocked)
         
         return jsonify({
             'success': success,
             'message': message,
-            'date': date_str
+            'date': data.get('date'),
+            **summary
         })
         
+    except ValueError as e:
+        return jsonify({'success': False, 'message': str(e)}), 400
     except Exception as e:
         return jsonify({'success': False, 'message': str(e)}), 500
 
+@app.route('/admin/block_date', methods=['POST'])
+@admin_required
+def admin_block_date():
+    """Блокировка даты или диапазона дат через API"""
+    return blocked_dates_response(True)
+
 @app.route('/admin/unblock_date', methods=['POST'])
 @admin_required
 def admin_unblock_date():
-    """Разблокировка даты через API"""
-    try:
-        data = request.get_json()
-        date_str = data.get('date')
-        
-        if not date_str:
-            return jsonify({'success': False, 'message': 'Дата не указана'}), 400
-        
-        success, message = unblock_date(date_str)
-        
-        return jsonify({
-            'success': success,
-            'message': message,
-            'date': date_str
-        })
-        
-    except Exception as e:
-        return jsonify({'success': False, 'message': str(e)}), 500
+    """Разблокировка даты или диапазона дат через API"""
+    return blocked_dates_response(False)
+
+@app.route('/admin/capacity', methods=['GET', 'POST'])
+@admin_required
+def admin_capacity():
+    """Правила вместимости: группы, лимит участников и время по дням недели и датам"""
+    message = ''
+    if request.method == 'POST':
+        try:
+            form = request.form
+            weekday = int(form['weekday']) if form.get('target') == 'weekday' else None
+            rule_date = date.fromisoformat(form['rule_date']) if form.get('target') == 'date' else None
+            
+            conn = get_db_connection()
+            cursor = conn.cursor()
+            capacity.save_rule(
+                cursor,
+                weekday=weekday,
+                rule_date=rule_date,
+                slots=int(form.get('slots') or 0),
+                max_participants=int(form['max_participants']) if form.get('max_participants') else None,
+                time_slots=capacity.parse_time_slots(form.get('time_slots')),
+                note=form.get('note', '').strip(),
+            )
+            conn.commit()
+            cursor.close()
+            conn.close()
+            capacity.invalidate()
+            message = '<p style="color: #27ae60;">✅ Правило сохранено</p>'
+        except (KeyError, ValueError) as e:
+            message = f'<p style="color: #e74c3c;">❌ {escape(str(e))}</p>'
+    
+    conn = get_db_connection()
+    cursor = conn.cursor(row_factory=dict_row)
+    rules = capacity.list_rules(cursor)
+    cursor.close()
+    conn.close()
+    
+    rows = []
+    for rule in rules:
+        if rule['rule_date'] is not None:
+            target = rule['rule_date'].strftime('%d.%m.%Y')
+        else:
+            target = RUSSIAN_WEEKDAYS_FULL[rule['weekday']]
+        rows.append(f"""
+            <tr>
+                <td>{target}</td>
+                <td>{rule['slots'] if rule['slots'] else 'закрыто'}</td>
+                <td>{rule['max_participants'] or '—'}</td>
+                <td>{', '.join(rule['time_slots'] or []) or '—'}</td>
+                <td>{escape(rule['note'] or '')}</td>
+                <td>
+                    <form method="POST" action="/admin/capacity/delete/{rule['id']}" onsubmit="return confirm('Удалить правило?')">
+                        <button type="submit" class="btn-delete">Удалить</button>
+                    </form>
+                </td>
+            </tr>""")
+    
+    weekday_options = ''.join(
+        f'<option value="{i}">{name}</option>' for i, name in enumerate(RUSSIAN_WEEKDAYS_FULL)
+    )
+    
+    return f"""
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <title>Вместимость дней</title>
+        <meta name="viewport" content="width=device-width, initial-scale=1.0">
+        <style>
+            body {{ font-family: Arial; padding: 20px; background: #f5f5f5; }}
+            .container {{ max-width: 900px; margin: 0 auto; background: white; padding: 30px; border-radius: 10px; box-shadow: 0 5px 15px rgba(0,0,0,0.1); }}
+            table {{ width: 100%; border-collapse: collapse; }}
+            th, td {{ padding: 10px; border-bottom: 1px solid #eee; text-align: left; }}
+            form.rule {{ display: grid; grid-template-columns: repeat(auto-fit, minmax(180px, 1fr)); gap: 10px; background: #e8f6ff; padding: 20px; border-radius: 10px; margin-top: 20px; }}
+            form.rule label {{ display: flex; flex-direction: column; font-size: 0.9em; gap: 5px; }}
+            form.rule input, form.rule select {{ padding: 8px; border: 2px solid #ddd; border-radius: 5px; }}
+            .btn {{ display: inline-block; padding: 12px 24px; background: #3498db; color: white; text-decoration: none; border-radius: 5px; margin-top: 20px; border: none; cursor: pointer; }}
+            .btn-delete {{ background: #e74c3c; color: white; border: none; padding: 6px 12px; border-radius: 5px; cursor: pointer; }}
+        </style>
+    </head>
+    <body>
+        <div class="container">
+            <h1>👥 Вместимость дней</h1>
+            <p>Дни без правила принимают {capacity.DEFAULT_SLOTS} группы. Правило даты важнее правила дня недели.
+               Если указано время, в каждое время записывается одна группа. Суббота и воскресенье закрыты всегда.</p>
+            {message}
+            <table>
+                <tr><th>День</th><th>Групп</th><th>Лимит участников</th><th>Время</th><th>Комментарий</th><th></th></tr>
+                {''.join(rows) or '<tr><td colspan="6">Правил нет</td></tr>'}
+            </table>
+            
+            <form method="POST" class="rule">
+                <label>Правило для
+                    <select name="target">
+                        <option value="weekday">дня недели</option>
+                        <option value="date">конкретной даты</option>
+                    </select>
+                </label>
+                <label>День недели
+                    <select name="weekday">{weekday_options}</select>
+                </label>
+                <label>Дата
+                    <input type="date" name="rule_date">
+                </label>
+                <label>Групп в день (0 - закрыто)
+                    <input type="number" name="slots" min="0" value="{capacity.DEFAULT_SLOTS}">
+                </label>
+                <label>Лимит участников в день
+                    <input type="number" name="max_participants" min="1" placeholder="без лимита">
+                </label>
+                <label>Время начала (через запятую)
+                    <input type="text" name="time_slots" placeholder="10:00, 13:00">
+                </label>
+                <label>Комментарий
+                    <input type="text" name="note" maxlength="200">
+                </label>
+                <button type="submit" class="btn">Сохранить правило</button>
+            </form>
+            
+            <a href="/admin" class="btn">Вернуться в админ-панель</a>
+        </div>
+    </body>
+    </html>
+    """
+
+@app.route('/admin/capacity/delete/<int:rule_id>', methods=['POST'])
+@admin_required
+def admin_capacity_delete(rule_id):
+    """Удаление правила вместимости"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    capacity.delete_rule(cursor, rule_id)
+    conn.commit()
+    cursor.close()
+    conn.close()
+    capacity.invalidate()
+    return redirect('/admin/capacity')
 
 @app.route('/admin/fix_database', methods=['GET', 'POST'])
 @admin_required
@@ -814,78 +1026,16 @@ def fix_database():
             </html>
             '''
         
-        # Используем внешнюю функцию для миграции
-        success, results = fix_database_operation()
-        
-        html_result = "<br>".join(results)
-        
-        if success:
-            return f'''
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <title>Исправление базы данных - завершено</title>
-                <meta name="viewport" content="width=device-width, initial-scale=1.0">
-                <style>
-                    body {{ font-family: Arial; padding: 20px; background: #f5f5f5; }}
-                    .container {{ max-width: 800px; margin: 0 auto; background: white; padding: 30px; border-radius: 10px; box-shadow: 0 5px 15px rgba(0,0,0,0.1); }}
-                    .success-box {{ background: #d4edda; border: 2px solid #c3e6cb; padding: 20px; border-radius: 10px; margin: 20px 0; }}
-                    .results {{ margin: 20px 0; padding: 20px; background: #f8f9fa; border-radius: 5px; max-height: 500px; overflow-y: auto; font-family: monospace; font-size: 14px; line-height: 1.4; }}
-                    .btn {{ display: inline-block; padding: 12px 24px; background: #3498db; color: white; text-decoration: none; border-radius: 5px; margin: 10px; font-size: 14px; }}
-                    @media (max-width: 768px) {{
-                        .container {{ padding: 20px; }}
-                        .btn {{ width: 100%; margin: 5px 0; text-align: center; }}
-                    }}
-                </style>
-            </head>
-            <body>
-                <div class="container">
-                    <h1 style="color: #2ecc71;">🎉 Исправление базы данных завершено!</h1>
-                    
-                    <div class="success-box">
-                        <h2>✅ Успешно выполнено!</h2>
-                        <p>Все операции миграции успешно выполнены. База данных готова к работе.</p>
-                    </div>
-                    
-                    <div class="results">
-                        {html_result}
-                    </div>
-                    
-                    <div style="margin-top: 30px;">
-                        <a href="/admin" class="btn">Вернуться в админ-панель</a>
-                        <a href="/" class="btn" style="background: #2ecc71;">Перейти к календарю</a>
-                    </div>
-                </div>
-            </body>
-            </html>
-            '''
-        else:
-            return f'''
-            <!DOCTYPE html>
-            <html>
-            <body style="font-family: Arial; padding: 40px; text-align: center;">
-                <h1 style="color: #e74c3c;">❌ Ошибка исправления базы</h1>
-                <div style="background: #ffe6e6; padding: 20px; border-radius: 5px; margin: 20px 0; text-align: left;">
-                    {html_result}
-                </div>
-                <div style="margin-top: 30px;">
-                    <a href="/admin" style="display: inline-block; padding: 12px 24px; background: #3498db; color: white; text-decoration: none; border-radius: 5px; margin: 10px;">
-                        Вернуться в админ-панель
-                    </a>
-                    <a href="/admin/fix_database" style="display: inline-block; padding: 12px 24px; background: #e74c3c; color: white; text-decoration: none; border-radius: 5px; margin: 10px;">
-                        Попробовать снова
-                    </a>
-                </div>
-            </body>
-            </html>
-            ''', 500
+        # Копирование таблицы может идти дольше таймаута gunicorn - выполняем в фоне
+        job_id = jobs.enqueue('fix_database')
+        return redirect(f'/admin/jobs/{job_id}')
 
 @app.route('/admin/edit/<int:booking_id>', methods=['GET', 'POST'])
 @admin_required
 def edit_booking(booking_id):
     """Редактирование записи"""
     conn = get_db_connection()
-    cursor = conn.cursor(row_factory=dict_row)
+    cursor = conn.cursor(row_factory=booking_record.booking_row)
     
     if request.method == 'POST':
         # Обновляем запись
@@ -898,29 +1048,53 @@ def edit_booking(booking_id):
         status = request.form.get('status')
         additional_info = request.form.get('additional_info')
         
-        cursor.execute('''
-            UPDATE bookings SET
-                school_name = %s,
-                class_number = %s,
-                class_profile = %s,
-                excursion_date = %s,
-                contact_phone = %s,
-                participants_count = %s,
-                status = %s,
-                additional_info = %s
-            WHERE id = %s
-        ''', (school_name, class_number, class_profile, excursion_date,
-              contact_phone, participants_count, status,
-              additional_info, booking_id))
+        cursor.execute('SELECT excursion_date FROM bookings WHERE id = %s', (booking_id,))
+        previous = cursor.fetchone()
+        
+        try:
+            cursor.execute('''
+                UPDATE bookings SET
+                    school_name = %s,
+                    class_number = %s,
+                    class_profile = %s,
+                    excursion_date = %s,
+                    contact_phone = %s,
+                    participants_count = %s,
+                    status = %s,
+                    additional_info = %s,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE id = %s
+            ''', (school_name, class_number, class_profile, excursion_date,
+                  contact_phone, participants_count, status,
+                  additional_info, booking_id))
+        except psycopg.errors.UniqueViolation as e:
+            conn.rollback()
+            cursor.close()
+            conn.close()
+            if not submission_guard.is_duplicate_error(e):
+                raise
+            return duplicate_booking_page(f'/admin/edit/{booking_id}')
         
         conn.commit()
         cursor.close()
         conn.close()
         
+        # Дата и число участников могли измениться - пересчитываем оба дня
+        days = [date.fromisoformat(excursion_date)] if excursion_date else []
+        if previous:
+            days.append(previous.excursion_date)
+        shared_availability.update_days(days)
+        
         return redirect('/admin')
     
-    # Получаем запись для редактирования
-    cursor.execute('SELECT * FROM bookings WHERE id = %s', (booking_id,))
+    # Получаем запись для редактирования: только колонки формы - у Booking
+    # нет слотов для посторонних колонок старых схем (например, contact_person)
+    cursor.execute('''
+        SELECT id, username, school_name, class_number, class_profile,
+               excursion_date, contact_phone, participants_count,
+               booking_date, status, additional_info, time_slot, updated_at
+        FROM bookings WHERE id = %s
+    ''', (booking_id,))
     booking = cursor.fetchone()
     
     cursor.close()
@@ -939,10 +1113,11 @@ def delete_booking(booking_id):
         try:
             conn = get_db_connection()
             cursor = conn.cursor()
-            cursor.execute('DELETE FROM bookings WHERE id = %s', (booking_id,))
+            deleted = delta_sync.delete_bookings(cursor, [booking_id], returning='id, excursion_date')
             conn.commit()
             cursor.close()
             conn.close()
+            shared_availability.update_days([row[1] for row in deleted])
         except Exception as e:
             print(f"Ошибка удаления: {e}")
     
@@ -956,11 +1131,28 @@ def update_status(booking_id):
         status = request.form.get('status')
         try:
             conn = get_db_connection()
-            cursor = conn.cursor()
-            cursor.execute('UPDATE bookings SET status = %s WHERE id = %s', (status, booking_id))
+            cursor = conn.cursor(row_factory=dict_row)
+            try:
+                cursor.execute('UPDATE bookings SET status = %s, updated_at = CURRENT_TIMESTAMP '
+                               'WHERE id = %s AND status IS DISTINCT FROM %s '
+                               f'RETURNING {notifications.BOOKING_FIELDS}',
+                               (status, booking_id, status))
+            except psycopg.errors.UniqueViolation as e:
+                conn.rollback()
+                cursor.close()
+                conn.close()
+                if not submission_guard.is_duplicate_error(e):
+                    raise
+                return duplicate_booking_page()
+            changed = cursor.fetchall()
+            notifications.enqueue(cursor, 'status_changed', changed)
             conn.commit()
             cursor.close()
             conn.close()
+            if status == 'cancelled':
+                metrics.inc('bookings_cancelled_total', len(changed))
+            shared_availability.update_days([row['excursion_date'] for row in changed])
+            notifications.wakeup()
         except Exception as e:
             print(f"Ошибка обновления статуса: {e}")
     
@@ -969,36 +1161,66 @@ def update_status(booking_id):
 @app.route('/admin/bulk_actions', methods=['POST'])
 @admin_required
 def bulk_actions():
-    """Массовые действия с записями"""
-    action = request.form.get('action')
-    selected_ids = request.form.getlist('selected_ids')
-    
-    if not selected_ids:
+    """Массовые действия с записями.
+
+    Принимает форму (action, selected_ids) или JSON {"action": ..., "ids": [...]}.
+    Клиенту, ожидающему JSON (fetch из админки), отдается сводка по каждому ID,
+    обычной отправке формы - редирект в админку.
+    """
+    if request.is_json:
+        data = request.get_json(silent=True) or {}
+        action = data.get('action')
+        raw_ids = data.get('ids') or []
+        if not isinstance(raw_ids, list):
+            raw_ids = [raw_ids]
+    else:
+        action = request.form.get('action')
+        raw_ids = request.form.getlist('selected_ids')
+    wants_json = request.is_json or request.accept_mimetypes.best == 'application/json'
+
+    ids, invalid = bulk_ops.parse_ids(raw_ids)
+    if action not in bulk_ops.ACTIONS or not ids:
+        message = 'Неизвестное действие' if action not in bulk_ops.ACTIONS else 'Не выбрано ни одной записи'
+        if wants_json:
+            return jsonify({'success': False, 'message': message, 'invalid': invalid}), 400
         return redirect('/admin')
-    
+
     try:
         conn = get_db_connection()
-        cursor = conn.cursor()
-        
-        if action == 'delete':
-            placeholders = ','.join(['%s'] * len(selected_ids))
-            cursor.execute(f'DELETE FROM bookings WHERE id IN ({placeholders})', selected_ids)
-        elif action == 'confirm':
-            placeholders = ','.join(['%s'] * len(selected_ids))
-            cursor.execute(f'UPDATE bookings SET status = %s WHERE id IN ({placeholders})', 
-                          ['confirmed'] + selected_ids)
-        elif action == 'cancel':
-            placeholders = ','.join(['%s'] * len(selected_ids))
-            cursor.execute(f'UPDATE bookings SET status = %s WHERE id IN ({placeholders})', 
-                          ['cancelled'] + selected_ids)
-        
-        conn.commit()
-        cursor.close()
-        conn.close()
-        
+        try:
+            cursor = conn.cursor(row_factory=dict_row)
+            summary = bulk_ops.run(cursor, action, ids)
+            conn.commit()
+            cursor.close()
+        finally:
+            conn.close()
+        bulk_ops.record_metrics(summary)
+        shared_availability.update_days([date.fromisoformat(day) for day in summary['days']])
+        notifications.wakeup()
+
+        summary['invalid'] = invalid
+        summary['message'] = bulk_ops.summary_message(summary, invalid)
+        print(f"✅ Массовое действие {action}: {summary['message']}")
+
+    except ValueError as e:
+        if wants_json:
+            return jsonify({'success': False, 'message': str(e)}), 400
+        print(f"Ошибка массовых действий: {e}")
+        return redirect('/admin')
     except Exception as e:
         print(f"Ошибка массовых действий: {e}")
-    
+        if submission_guard.is_duplicate_error(e):
+            # Восстановление отмененных записей: у класса уже есть активная на ту же дату
+            if wants_json:
+                return jsonify({'success': False, 'message': 'Дубль записи: у класса уже есть '
+                                'активная запись на эту дату. Ничего не изменено.'}), 409
+            return duplicate_booking_page()
+        if wants_json:
+            return jsonify({'success': False, 'message': str(e)}), 500
+        return redirect('/admin')
+
+    if wants_json:
+        return jsonify(summary)
     return redirect('/admin')
 
 @app.route('/admin/clear_all', methods=['GET', 'POST'])
@@ -1049,43 +1271,8 @@ def clear_all():
     if request.method == 'POST':
         confirmation = request.form.get('confirmation')
         if confirmation == 'УДАЛИТЬ ВСЕ':
-            try:
-                conn = get_db_connection()
-                cursor = conn.cursor()
-                cursor.execute('DELETE FROM bookings')
-                conn.commit()
-                
-                cursor.execute('SELECT COUNT(*) FROM bookings')
-                remaining = cursor.fetchone()[0]
-                
-                cursor.close()
-                conn.close()
-                
-                return f'''
-                <!DOCTYPE html>
-                <html>
-                <body style="font-family: Arial; padding: 40px; text-align: center;">
-                    <h1 style="color: #2ecc71;">✅ База данных очищена</h1>
-                    <p>Все записи были удалены. Осталось записей: {remaining}</p>
-                    <div style="margin-top: 30px;">
-                        <a href="/admin" style="display: inline-block; padding: 12px 24px; background: #3498db; color: white; text-decoration: none; border-radius: 5px; margin: 10px;">
-                            Вернуться в админ-панель
-                        </a>
-                    </div>
-                </body>
-                </html>
-                '''
-            except Exception as e:
-                return f'''
-                <!DOCTYPE html>
-                <html>
-                <body style="font-family: Arial; padding: 40px; text-align: center;">
-                    <h1 style="color: #e74c3c;">❌ Ошибка очистки базы</h1>
-                    <p>{str(e)}</p>
-                    <a href="/admin">Вернуться в админ-панель</a>
-                </body>
-                </html>
-                '''
+            job_id = jobs.enqueue('clear_all')
+            return redirect(f'/admin/jobs/{job_id}')
         else:
             return '''
             <!DOCTYPE html>
@@ -1127,112 +1314,154 @@ def health():
             'error': str(e)
         }, 500
 
+@app.route('/metrics')
+def metrics_endpoint():
+    """Метрики в формате Prometheus (без обращения к БД)"""
+    token = os.environ.get('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != f'Bearer {token}':
+        return 'Unauthorized', 401
+    
+    response = make_response(metrics.render_text())
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
+
+# Сколько строк экспорта накапливать перед отправкой очередной порции клиенту
+EXPORT_CHUNK_ROWS = 1000
+
+# Проекция выгрузок: статус на русском, даты и пустые значения форматирует
+# PostgreSQL, поэтому строки приходят готовыми и Python их не перебирает
+EXPORT_STATUS_SQL = """CASE status
+            WHEN 'pending' THEN 'Ожидание'
+            WHEN 'confirmed' THEN 'Подтверждено'
+            WHEN 'cancelled' THEN 'Отменено'
+            ELSE status
+        END"""
+
+# Колонки CSV без псевдонимов: ORDER BY и WHERE по-прежнему видят
+# исходные excursion_date и booking_date, а не отформатированный текст
+EXPORT_CSV_SQL = f'''
+    SELECT 
+        id,
+        to_char(excursion_date, 'DD.MM.YYYY'),
+        COALESCE(username, ''),
+        COALESCE(school_name, ''),
+        COALESCE(class_number, ''),
+        COALESCE(class_profile, ''),
+        COALESCE(contact_phone, ''),
+        participants_count,
+        {EXPORT_STATUS_SQL},
+        COALESCE(to_char(booking_date, 'DD.MM.YYYY HH24:MI'), ''),
+        COALESCE(additional_info, '')
+    FROM bookings 
+'''
+
+# Запись JSON собирает row_to_json: ключи в порядке колонок, даты строками,
+# booking_date без значения - null
+EXPORT_JSON_SQL = f'''
+    SELECT row_to_json(record)::text
+    FROM bookings
+    CROSS JOIN LATERAL (
+        SELECT 
+            id,
+            COALESCE(username, '') as username,
+            COALESCE(school_name, '') as school_name,
+            COALESCE(class_number, '') as class_number,
+            COALESCE(class_profile, '') as class_profile,
+            to_char(excursion_date, 'DD.MM.YYYY') as excursion_date,
+            COALESCE(contact_phone, '') as contact_phone,
+            participants_count,
+            status,
+            to_char(booking_date, 'DD.MM.YYYY HH24:MI') as booking_date,
+            COALESCE(additional_info, '') as additional_info,
+            {EXPORT_STATUS_SQL} as status_rus
+    ) AS record
+'''
+
+EXPORT_ORDER_SQL = ' ORDER BY bookings.excursion_date DESC, bookings.booking_date DESC'
+
+# Заголовки на русском
+EXPORT_CSV_HEADER = [
+    'ID', 'Дата экскурсии', 'Ответственный', 'Школа', 'Класс',
+    'Профиль класса', 'Телефон', 'Кол-во участников', 'Статус',
+    'Дата записи', 'Дополнительная информация'
+]
+
+# Точка с запятой как разделитель - лучше для русского Excel; все значения
+# в кавычках, как у csv.QUOTE_ALL (NULL в проекции заменены на '')
+EXPORT_COPY_OPTIONS = "FORMAT csv, DELIMITER ';', FORCE_QUOTE *"
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+# Как часто лидер планировщика пересобирает полные выгрузки после изменений
+EXPORT_WARMUP_SECONDS = float(os.environ.get('EXPORT_WARMUP_SECONDS', 300))
+
+def copy_csv(conn, query, params, header=EXPORT_CSV_HEADER):
+    """Генератор CSV из COPY: UTF-8 BOM и заголовок, затем строки по EXPORT_CHUNK_ROWS.
+    
+    Кавычки, разделители и экранирование делает PostgreSQL - блоки COPY
+    только склеиваются в порции. Первая строка читается сразу, поэтому
+    ошибка SQL возникает при вызове, а не посреди отдачи ответа.
+    """
+    rows = db.copy_out(conn, query, params, EXPORT_COPY_OPTIONS)
+    first = bytes(next(rows, b''))
+    
+    def generate():
+        # BOM для корректного отображения UTF-8 в Excel
+        yield b'\xef\xbb\xbf' + (';'.join(f'"{title}"' for title in header) + '\n').encode('utf-8')
+        
+        chunk = bytearray(first)
+        count = 1 if first else 0
+        for row in rows:
+            chunk += row
+            count += 1
+            if count == EXPORT_CHUNK_ROWS:
+                yield bytes(chunk)
+                chunk.clear()
+                count = 0
+        
+        yield bytes(chunk)
+    
+    return generate()
+
+def count_export_bytes(chunks, export_format):
+    """Пропускает порции ответа, считая отданные байты (для выгрузок мимо кэша)"""
+    for chunk in chunks:
+        metrics.inc('export_bytes_total', len(chunk), format=export_format)
+        yield chunk
+
+def export_csv_body(conn):
+    """Тело CSV-экспорта всех записей: генератор порций байтов.
+    
+    Запрос выполняется сразу, поэтому ошибка SQL возникает при вызове,
+    а не посреди отдачи ответа.
+    """
+    return copy_csv(conn, EXPORT_CSV_SQL + EXPORT_ORDER_SQL, None)
+
+def send_export(export_format, filters, extension, mimetype, filename, build):
+    """Отдает выгрузку из кэша файлов (export_cache.py), собирая ее при промахе.
+    
+    Соединение нужно только на проверку версии и сборку файла - оно
+    возвращается в пул до отдачи. send_file отдает файл через wsgi.file_wrapper
+    (sendfile в gunicorn), conditional=True - поддержка Range и If-None-Match.
+    Отданные байты считаются здесь, на каждый ответ - и при попадании в кэш.
+    """
+    conn = get_db_connection()
+    try:
+        path = export_cache.get_or_build(conn, export_format, filters, extension, build)
+    finally:
+        conn.close()
+    
+    metrics.inc('export_bytes_total', os.path.getsize(path), format=export_format)
+    return send_file(path, mimetype=mimetype, as_attachment=True, download_name=filename,
+                     conditional=True, max_age=0)
+
 @app.route('/admin/export/csv')
 @admin_required
 def export_csv():
     """Экспорт всех записей в CSV с разделителями, совместимый с Excel"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(row_factory=dict_row)
-        
-        cursor.execute('''
-            SELECT 
-                id,
-                excursion_date,
-                COALESCE(username, '') as username,
-                COALESCE(school_name, '') as school_name,
-                COALESCE(class_number, '') as class_number,
-                COALESCE(class_profile, '') as class_profile,
-                COALESCE(contact_phone, '') as contact_phone,
-                participants_count,
-                COALESCE(status, 'pending') as status,
-                booking_date,
-                COALESCE(additional_info, '') as additional_info
-            FROM bookings 
-            ORDER BY excursion_date DESC, booking_date DESC
-        ''')
-        
-        bookings = cursor.fetchall()
-        cursor.close()
-        conn.close()
-        
-        # Создаем CSV в памяти
-        output = io.StringIO()
-        
-        # Используем точку с запятой как разделитель (лучше для Excel/Russian Excel)
-        # и UTF-8 with BOM для корректного отображения русских букв
-        writer = csv.writer(output, delimiter=';', quoting=csv.QUOTE_ALL)
-        
-        # Заголовки на русском
-        writer.writerow([
-            'ID',
-            'Дата экскурсии',
-            'Ответственный',
-            'Школа',
-            'Класс',
-            'Профиль класса',
-            'Телефон',
-            'Кол-во участников',
-            'Статус',
-            'Дата записи',
-            'Дополнительная информация'
-        ])
-        
-        # Данные
-        for booking in bookings:
-            # Форматируем статус
-            status_map = {
-                'pending': 'Ожидание',
-                'confirmed': 'Подтверждено',
-                'cancelled': 'Отменено'
-            }
-            status_rus = status_map.get(booking.get('status', 'pending'), booking.get('status', ''))
-            
-            # Форматируем даты
-            excursion_date = booking['excursion_date']
-            if isinstance(excursion_date, date):
-                excursion_date = excursion_date.strftime('%d.%m.%Y')
-            elif excursion_date:
-                excursion_date = str(excursion_date)
-            else:
-                excursion_date = ''
-            
-            booking_date = booking['booking_date']
-            if isinstance(booking_date, datetime):
-                booking_date = booking_date.strftime('%d.%m.%Y %H:%M')
-            elif isinstance(booking_date, date):
-                booking_date = booking_date.strftime('%d.%m.%Y')
-            elif booking_date:
-                booking_date = str(booking_date)
-            else:
-                booking_date = ''
-            
-            writer.writerow([
-                booking['id'],
-                excursion_date,
-                booking.get('username', ''),  # ← ИСПРАВЛЕНО: используем .get()
-                booking.get('school_name', ''),
-                booking.get('class_number', ''),
-                booking.get('class_profile', ''),
-                booking.get('contact_phone', ''),
-                booking.get('participants_count', 0),
-                status_rus,
-                booking_date,
-                booking.get('additional_info', '')
-            ])
-        
-        # Подготавливаем ответ с UTF-8 BOM для Excel
-        csv_content = output.getvalue()
-        output.close()
-        
-        # Добавляем BOM для корректного отображения UTF-8 в Excel
-        csv_bytes = b'\xef\xbb\xbf' + csv_content.encode('utf-8')
-        
-        response = make_response(csv_bytes)
-        response.headers['Content-Disposition'] = f'attachment; filename=excursions_export_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv'
-        response.headers['Content-Type'] = 'text/csv; charset=utf-8'
-        
-        return response
+        return send_export('csv', None, 'csv', 'text/csv; charset=utf-8',
+                           f'excursions_export_{datetime.now().strftime("%Y%m%d_%H%M%S")}.csv',
+                           export_csv_body)
         
     except Exception as e:
         return f'''
@@ -1248,75 +1477,42 @@ def export_csv():
         </html>
         ''', 500
 
+def export_json_body(conn):
+    """Тело JSON-экспорта всех записей: генератор порций байтов.
+    
+    Записи приходят из EXPORT_JSON_SQL готовым JSON-текстом и склеиваются
+    порциями по EXPORT_CHUNK_ROWS.
+    """
+    batches = db.stream_batches(conn, EXPORT_JSON_SQL + EXPORT_ORDER_SQL,
+                                row_factory=scalar_row, size=EXPORT_CHUNK_ROWS)
+    first = next(batches, [])
+    
+    def generate():
+        # Количество записей известно только в конце, поэтому total_records идет после data
+        parts = ['{\n  "export_date": ' + json.dumps(datetime.now().strftime('%d.%m.%Y %H:%M:%S')) + ',\n  "data": [']
+        total = 0
+        for records in itertools.chain([first], batches):
+            if not records:
+                continue
+            parts.append((',\n    ' if total else '\n    ') + ',\n    '.join(records))
+            total += len(records)
+            chunk = ''.join(parts).encode('utf-8')
+            parts = []
+            yield chunk
+        
+        parts.append(('\n  ]' if total else ']') + f',\n  "total_records": {total}\n}}')
+        yield ''.join(parts).encode('utf-8')
+    
+    return generate()
+
 @app.route('/admin/export/json')
 @admin_required
 def export_json():
     """Экспорт всех записей в JSON с форматированием"""
     try:
-        conn = get_db_connection()
-        cursor = conn.cursor(row_factory=dict_row)
-        
-        cursor.execute('''
-            SELECT 
-                id,
-                COALESCE(username, '') as username,
-                COALESCE(school_name, '') as school_name,
-                COALESCE(class_number, '') as class_number,
-                COALESCE(class_profile, '') as class_profile,
-                excursion_date,
-                COALESCE(contact_phone, '') as contact_phone,
-                participants_count,
-                COALESCE(status, 'pending') as status,
-                booking_date,
-                COALESCE(additional_info, '') as additional_info
-            FROM bookings 
-            ORDER BY excursion_date DESC, booking_date DESC
-        ''')
-        
-        bookings = cursor.fetchall()
-        cursor.close()
-        conn.close()
-        
-        # Преобразуем даты в строки для JSON
-        export_data = []
-        status_map = {
-            'pending': 'Ожидание',
-            'confirmed': 'Подтверждено',
-            'cancelled': 'Отменено'
-        }
-        
-        for booking in bookings:
-            booking_dict = dict(booking)
-            
-            # Преобразуем даты в строки
-            if isinstance(booking_dict.get('excursion_date'), (date, datetime)):
-                booking_dict['excursion_date'] = booking_dict['excursion_date'].strftime('%d.%m.%Y')
-            elif booking_dict.get('excursion_date'):
-                booking_dict['excursion_date'] = str(booking_dict['excursion_date'])
-            
-            if isinstance(booking_dict.get('booking_date'), (date, datetime)):
-                booking_dict['booking_date'] = booking_dict['booking_date'].strftime('%d.%m.%Y %H:%M')
-            elif booking_dict.get('booking_date'):
-                booking_dict['booking_date'] = str(booking_dict['booking_date'])
-            
-            # Добавляем русский статус
-            booking_dict['status_rus'] = status_map.get(booking_dict.get('status', 'pending'), booking_dict.get('status', ''))
-            
-            export_data.append(booking_dict)
-        
-        # Создаем объект с метаданными
-        result = {
-            'export_date': datetime.now().strftime('%d.%m.%Y %H:%M:%S'),
-            'total_records': len(export_data),
-            'data': export_data
-        }
-        
-        # Отправляем JSON с отступами для читаемости
-        response = make_response(json.dumps(result, ensure_ascii=False, indent=2))
-        response.headers['Content-Disposition'] = f'attachment; filename=excursions_export_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json'
-        response.headers['Content-Type'] = 'application/json; charset=utf-8'
-        
-        return response
+        return send_export('json', None, 'json', 'application/json; charset=utf-8',
+                           f'excursions_export_{datetime.now().strftime("%Y%m%d_%H%M%S")}.json',
+                           export_json_body)
         
     except Exception as e:
         return f'''
@@ -1332,126 +1528,250 @@ def export_json():
         </html>
         ''', 500
     
+def export_filters(args):
+    """Фильтры выгрузки из параметров запроса (те же, что в админ-панели)"""
+    return {
+        'status': args.get('status', 'all'),
+        'date_from': args.get('date_from', ''),
+        'date_to': args.get('date_to', ''),
+        'search': args.get('search', ''),
+    }
+
+def bookings_where(filters):
+    """WHERE по фильтрам админ-панели: (' WHERE ...' или '', параметры)"""
+    params = []
+    where_clauses = []
+    
+    if filters['status'] != 'all':
+        where_clauses.append('status = %s')
+        params.append(filters['status'])
+    
+    if filters['date_from']:
+        where_clauses.append('excursion_date >= %s')
+        params.append(filters['date_from'])
+    
+    if filters['date_to']:
+        where_clauses.append('excursion_date <= %s')
+        params.append(filters['date_to'])
+    
+    if filters['search']:
+        where_clauses.append('''
+            (school_name ILIKE %s OR 
+             username ILIKE %s OR 
+             contact_phone ILIKE %s)
+        ''')
+        search_term = f"%{filters['search']}%"
+        params.extend([search_term, search_term, search_term])
+    
+    if not where_clauses:
+        return '', params
+    return ' WHERE ' + ' AND '.join(where_clauses), params
+
+def export_csv_filtered_body(conn, filters):
+    """Тело CSV-экспорта отфильтрованных записей: генератор порций байтов"""
+    # Та же проекция, что у полного экспорта, с фильтрами админ-панели
+    where_sql, params = bookings_where(filters)
+    return copy_csv(conn, EXPORT_CSV_SQL + where_sql + EXPORT_ORDER_SQL, params)
+
 @app.route('/admin/export/csv_filtered')
 @admin_required
 def export_csv_filtered():
     """Экспорт отфильтрованных записей в CSV"""
     try:
         # Получаем параметры фильтрации из URL
-        status_filter = request.args.get('status', 'all')
-        date_from = request.args.get('date_from', '')
-        date_to = request.args.get('date_to', '')
-        search = request.args.get('search', '')
-        
-        conn = get_db_connection()
-        cursor = conn.cursor(row_factory=dict_row)
-        
-        # Строим запрос с фильтрацией (как в админ-панели)
-        query = '''
-            SELECT 
-                id,
-                excursion_date,
-                username as responsible_person,
-                school_name,
-                class_number,
-                class_profile,
-                contact_phone,
-                participants_count,
-                status,
-                booking_date,
-                additional_info
-            FROM bookings 
-        '''
-        params = []
-        where_clauses = []
+        filters = export_filters(request.args)
+        status_filter = filters['status']
         
+        # Генерируем имя файла с учетом фильтров
+        filename_parts = ['excursions']
         if status_filter != 'all':
-            where_clauses.append('status = %s')
-            params.append(status_filter)
-        
-        if date_from:
-            where_clauses.append('excursion_date >= %s')
-            params.append(date_from)
+            filename_parts.append(status_filter)
+        filename_parts.append(datetime.now().strftime("%Y%m%d_%H%M%S"))
         
-        if date_to:
-            where_clauses.append('excursion_date <= %s')
-            params.append(date_to)
+        return send_export('csv_filtered', filters, 'csv', 'text/csv; charset=utf-8',
+                           f'{"_".join(filename_parts)}.csv',
+                           lambda conn: export_csv_filtered_body(conn, filters))
         
-        if search:
-            where_clauses.append('''
-                (school_name ILIKE %s OR 
-                 username ILIKE %s OR 
-                 contact_phone ILIKE %s)
-            ''')
-            search_term = f'%{search}%'
-            params.extend([search_term, search_term, search_term])
+    except Exception as e:
+        return str(e), 500
+
+# Колонки XLSX: те же, что у CSV, но даты и числа остаются типизированными -
+# Excel получает настоящие даты, а телефон - текстом
+EXPORT_XLSX_SQL = f'''
+    SELECT 
+        id,
+        excursion_date,
+        username,
+        school_name,
+        class_number,
+        class_profile,
+        contact_phone,
+        participants_count,
+        {EXPORT_STATUS_SQL},
+        booking_date,
+        additional_info
+    FROM bookings 
+'''
+
+# Ширины колонок XLSX в символах (в порядке EXPORT_CSV_HEADER)
+EXPORT_XLSX_WIDTHS = [8, 14, 32, 28, 8, 18, 16, 10, 14, 17, 40]
+
+def export_xlsx_body(conn, filters):
+    """Тело XLSX-экспорта отфильтрованных записей: генератор порций байтов.
+    
+    Строки из серверного курсора сразу пишутся в zip-архив
+    (xlsx_stream), память не растет с размером выгрузки. Запрос
+    выполняется при вызове, как у остальных выгрузок.
+    """
+    where_sql, params = bookings_where(filters)
+    bookings = db.StreamedRows(conn, EXPORT_XLSX_SQL + where_sql + EXPORT_ORDER_SQL, params,
+                               row_factory=tuple_row)
+    bool(bookings)
+    
+    return xlsx_stream.stream_xlsx(
+        bookings, EXPORT_CSV_HEADER,
+        sheet_name='Записи',
+        widths=EXPORT_XLSX_WIDTHS,
+        chunk_rows=EXPORT_CHUNK_ROWS,
+    )
+
+@app.route('/admin/export/xlsx')
+@admin_required
+def export_xlsx():
+    """Экспорт отфильтрованных записей в XLSX (Excel)"""
+    try:
+        filters = export_filters(request.args)
         
-        if where_clauses:
-            query += ' WHERE ' + ' AND '.join(where_clauses)
+        filename_parts = ['excursions']
+        if filters['status'] != 'all':
+            filename_parts.append(filters['status'])
+        filename_parts.append(datetime.now().strftime("%Y%m%d_%H%M%S"))
         
-        query += ' ORDER BY excursion_date DESC, booking_date DESC'
+        return send_export('xlsx', filters, 'xlsx', XLSX_MIMETYPE,
+                           f'{"_".join(filename_parts)}.xlsx',
+                           lambda conn: export_xlsx_body(conn, filters))
         
-        cursor.execute(query, params)
-        bookings = cursor.fetchall()
+    except Exception as e:
+        return str(e), 500
+
+# Колонки инкрементальной выгрузки (имя, выражение по bookings) в порядке
+# ключей JSON. Форматирует PostgreSQL, как и в полной выгрузке; у удаленных
+# записей все колонки, кроме id, - NULL (delta_sync.changes_query)
+DELTA_COLUMNS = [
+    ('id', 'id'),
+    ('username', "COALESCE(username, '')"),
+    ('school_name', "COALESCE(school_name, '')"),
+    ('class_number', "COALESCE(class_number, '')"),
+    ('class_profile', "COALESCE(class_profile, '')"),
+    ('excursion_date', "to_char(excursion_date, 'DD.MM.YYYY')"),
+    ('contact_phone', "COALESCE(contact_phone, '')"),
+    ('participants_count', 'participants_count'),
+    ('status', "COALESCE(status, 'pending')"),
+    ('booking_date', "to_char(booking_date, 'DD.MM.YYYY HH24:MI')"),
+    ('additional_info', "COALESCE(additional_info, '')"),
+    ('updated_at', "to_char(updated_at, 'DD.MM.YYYY HH24:MI:SS')"),
+    ('status_rus', EXPORT_STATUS_SQL),
+]
+
+DELTA_CSV_HEADER = [
+    'Изменение', 'ID', 'Дата экскурсии', 'Ответственный', 'Школа', 'Класс',
+    'Профиль класса', 'Телефон', 'Кол-во участников', 'Статус',
+    'Дата записи', 'Дополнительная информация', 'Изменено'
+]
+
+# Колонки CSV после "Изменение" и ID; пустые значения (и все у удаленных) - ''
+DELTA_CSV_FIELDS = [
+    'excursion_date', 'username', 'school_name', 'class_number', 'class_profile',
+    'contact_phone', 'participants_count', 'status_rus', 'booking_date',
+    'additional_info', 'updated_at',
+]
+
+DELTA_CSV_SQL = '''
+    SELECT CASE changes.change WHEN 'delete' THEN 'Удалено' ELSE 'Изменено' END,
+           changes.id,
+           ''' + ',\n           '.join(f"COALESCE(changes.{name}::text, '')" for name in DELTA_CSV_FIELDS) + '''
+    FROM ({changes}) AS changes
+    ORDER BY changes.id
+'''
+
+# Удаленная запись - {"change": "delete", "id": ...}, остальные - все колонки
+DELTA_JSON_SQL = '''
+    SELECT (CASE changes.change WHEN 'delete' THEN row_to_json(deleted) ELSE row_to_json(record) END)::text
+    FROM ({changes}) AS changes
+    CROSS JOIN LATERAL (SELECT changes.change, changes.id) AS deleted
+    CROSS JOIN LATERAL (
+        SELECT ''' + ', '.join(f'changes.{name}' for name, _ in DELTA_COLUMNS[:-1]) + ''',
+               changes.change, changes.status_rus
+    ) AS record
+    ORDER BY changes.id
+'''
+
+@app.route('/admin/export/delta')
+@admin_required
+def export_delta():
+    """Инкрементальная выгрузка: записи, измененные после since, и удаленные ID.
+    
+    since - токен из заголовка X-Sync-Watermark прошлой выгрузки (или дата/время
+    в ISO-формате). Без since или для слишком старого since отдается полная
+    выгрузка с заголовком X-Sync-Full: 1 - таблицу у клиента нужно заменить.
+    """
+    export_format = request.args.get('format', 'csv')
+    if export_format not in ('csv', 'json'):
+        return 'format: csv или json', 400
+    
+    try:
+        since = delta_sync.parse_since(request.args.get('since', ''))
+    except ValueError:
+        return 'Неверный since: ожидается токен прошлой выгрузки или дата YYYY-MM-DD', 400
+    
+    try:
+        conn = get_db_connection()
+        cursor = conn.cursor()
+        watermark, full = delta_sync.prepare(cursor, since)
         cursor.close()
-        conn.close()
-        
-        # Создаем CSV (аналогично основному экспорту)
-        output = io.StringIO()
-        writer = csv.writer(output, delimiter=';', quoting=csv.QUOTE_ALL)
+        # Фиксируем чистку журнала удалений до открытия серверного курсора:
+        # commit закрыл бы курсор посреди выгрузки
+        conn.commit()
         
-        writer.writerow([
-            'ID', 'Дата экскурсии', 'Ответственный', 'Школа', 'Класс',
-            'Профиль класса', 'Телефон', 'Кол-во участников', 'Статус',
-            'Дата записи', 'Дополнительная информация'
-        ])
+        changes_sql, params = delta_sync.changes_query(
+            [f'{expression} AS {name}' for name, expression in DELTA_COLUMNS], since, full)
         
-        status_map = {
-            'pending': 'Ожидание',
-            'confirmed': 'Подтверждено',
-            'cancelled': 'Отменено'
-        }
+        token = delta_sync.format_watermark(watermark)
+        # Кнопка "Изменения" в админке продолжит с этого токена
+        session['delta_watermark'] = token
         
-        for booking in bookings:
-            excursion_date = booking['excursion_date']
-            if isinstance(excursion_date, date):
-                excursion_date = excursion_date.strftime('%d.%m.%Y')
+        if export_format == 'json':
+            changes = db.StreamedRows(conn, DELTA_JSON_SQL.format(changes=changes_sql), params,
+                                      row_factory=scalar_row)
+            # Ошибка SQL должна попасть в except до начала потоковой отдачи
+            bool(changes)
             
-            booking_date = booking['booking_date']
-            if isinstance(booking_date, datetime):
-                booking_date = booking_date.strftime('%d.%m.%Y %H:%M')
-            elif isinstance(booking_date, date):
-                booking_date = booking_date.strftime('%d.%m.%Y')
+            def generate():
+                # Токен и признак полной выгрузки известны заранее - идут первыми
+                yield (f'{{"watermark": {json.dumps(token)}, "full": {json.dumps(full)}, "changes": [').encode('utf-8')
+                buffer = []
+                for i, record in enumerate(changes):
+                    buffer.append((',' if i else '') + '\n' + record)
+                    if len(buffer) >= EXPORT_CHUNK_ROWS:
+                        chunk = ''.join(buffer).encode('utf-8')
+                        buffer = []
+                        yield chunk
+                buffer.append('\n]}\n')
+                yield ''.join(buffer).encode('utf-8')
             
-            writer.writerow([
-                booking['id'],
-                excursion_date,
-                booking['username'] or booking.get('responsible_person', ''),
-                booking['school_name'],
-                booking['class_number'],
-                booking.get('class_profile', ''),
-                booking['contact_phone'],
-                booking['participants_count'],
-                status_map.get(booking.get('status', 'pending'), booking.get('status', '')),
-                booking_date,
-                booking.get('additional_info', '')
-            ])
-        
-        csv_content = output.getvalue()
-        output.close()
-        
-        csv_bytes = b'\xef\xbb\xbf' + csv_content.encode('utf-8')
-        
-        # Генерируем имя файла с учетом фильтров
-        filename_parts = ['excursions']
-        if status_filter != 'all':
-            filename_parts.append(status_filter)
-        filename_parts.append(datetime.now().strftime("%Y%m%d_%H%M%S"))
-        
-        response = make_response(csv_bytes)
-        response.headers['Content-Disposition'] = f'attachment; filename={"_".join(filename_parts)}.csv'
-        response.headers['Content-Type'] = 'text/csv; charset=utf-8'
+            response = Response(stream_with_context(count_export_bytes(generate(), 'delta_json')))
+            response.headers['Content-Type'] = 'application/json; charset=utf-8'
+        else:
+            response = Response(stream_with_context(count_export_bytes(copy_csv(
+                conn, DELTA_CSV_SQL.format(changes=changes_sql), params, DELTA_CSV_HEADER), 'delta_csv')))
+            response.headers['Content-Type'] = 'text/csv; charset=utf-8'
         
+        kind = 'full' if full else 'delta'
+        response.headers['Content-Disposition'] = (
+            f'attachment; filename=excursions_{kind}_{watermark.strftime("%Y%m%d_%H%M%S")}.{export_format}'
+        )
+        response.headers['X-Sync-Watermark'] = token
+        response.headers['X-Sync-Full'] = '1' if full else '0'
         return response
         
     except Exception as e:
@@ -1518,60 +1838,9 @@ def admin_reset_database():
             </html>
             '''
         
-        # Запускаем сброс базы
-        success, results = recreate_database()
-        html_result = "<br>".join(results)
-        
-        if success:
-            return f'''
-            <!DOCTYPE html>
-            <html>
-            <head>
-                <style>
-                    body {{ font-family: Arial; padding: 20px; background: #f5f5f5; }}
-                    .container {{ max-width: 800px; margin: 0 auto; background: white; padding: 30px; border-radius: 10px; }}
-                    .success {{ background: #e8f6ef; padding: 20px; border-radius: 10px; }}
-                    .results {{ padding: 20px; background: #f8f9fa; border-radius: 5px; }}
-                    .btn {{ padding: 10px 20px; background: #3498db; color: white; text-decoration: none; border-radius: 5px; margin: 10px; }}
-                </style>
-            </head>
-            <body>
-                <div class="container">
-                    <h1 style="color: #2ecc71;">✅ База данных успешно пересоздана!</h1>
-                    <div class="success">
-                        <p><strong>Операция выполнена успешно!</strong></p>
-                    </div>
-                    <div class="results">
-                        {html_result}
-                    </div>
-                    <div style="margin-top: 30px;">
-                        <a href="/admin" class="btn">Вернуться в админ-панель</a>
-                        <a href="/" class="btn" style="background: #2ecc71;">Перейти к календарю</a>
-                    </div>
-                </div>
-            </body>
-            </html>
-            '''
-        else:
-            return f'''
-            <!DOCTYPE html>
-            <html>
-            <body style="font-family: Arial; padding: 40px; text-align: center;">
-                <h1 style="color: #e74c3c;">❌ Ошибка сброса базы</h1>
-                <div style="background: #ffe6e6; padding: 20px; border-radius: 5px; margin: 20px 0; text-align: left;">
-                    {html_result}
-                </div>
-                <div>
-                    <a href="/admin" style="padding: 10px 20px; background: #3498db; color: white; text-decoration: none; border-radius: 5px; margin: 10px;">
-                        Вернуться в админ-панель
-                    </a>
-                    <a href="/admin/reset_database" style="padding: 10px 20px; background: #e74c3c; color: white; text-decoration: none; border-radius: 5px; margin: 10px;">
-                        Попробовать снова
-                    </a>
-                </div>
-            </body>
-            </html>
-            ''', 500
+        # Запускаем сброс базы в фоне
+        job_id = jobs.enqueue('reset_database')
+        return redirect(f'/admin/jobs/{job_id}')
 
 def recreate_database():
     """Полный сброс и пересоздание базы данных"""
@@ -1591,64 +1860,52 @@ def recreate_database():
             # 1. Удаляем все таблицы если они существуют
             results.append("<br><strong>📊 Шаг 1: Удаление существующих таблиц...</strong>")
             
-            cursor.execute("DROP TABLE IF EXISTS bookings CASCADE")
+            # Независимые DDL и проверки ниже идут пачками (db.run_batch):
+            # на удаленной БД это один сетевой цикл на шаг, а не на запрос
+            db.run_batch(conn, [
+                "DROP TABLE IF EXISTS bookings CASCADE",
+                "DROP TABLE IF EXISTS blocked_dates CASCADE",
+            ])
             results.append("   ✅ Таблица bookings удалена")
-            
-            cursor.execute("DROP TABLE IF EXISTS blocked_dates CASCADE")
             results.append("   ✅ Таблица blocked_dates удалена")
             
             # Коммитим удаление
             conn.commit()
             results.append("   ✅ Все таблицы удалены")
             
-            # 2. Создаем таблицу bookings с правильной структурой
+            # 2. Создаем таблицы bookings и blocked_dates с правильной структурой
             results.append("<br><strong>📊 Шаг 2: Создание новой таблицы bookings...</strong>")
             
-            cursor.execute('''
-                CREATE TABLE bookings (
-                    id SERIAL PRIMARY KEY,
-                    username VARCHAR(100) NOT NULL,
-                    school_name VARCHAR(200) NOT NULL,
-                    class_number VARCHAR(20) NOT NULL,
-                    class_profile VARCHAR(100),
-                    excursion_date DATE NOT NULL,
-                    contact_phone VARCHAR(20) NOT NULL,
-                    participants_count INTEGER NOT NULL,
-                    booking_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    additional_info TEXT,
-                    status VARCHAR(20) DEFAULT 'pending'
-                )
-            ''')
+            schema.create_bookings_table(cursor)
+            schema.create_blocked_dates_table(cursor)
             
             results.append("   ✅ Таблица bookings создана")
             
-            # 3. Создаем таблицу blocked_dates
+            # 3. Таблица blocked_dates создана той же пачкой
             results.append("<br><strong>📊 Шаг 3: Создание таблицы blocked_dates...</strong>")
-            
-            cursor.execute('''
-                CREATE TABLE blocked_dates (
-                    id SERIAL PRIMARY KEY,
-                    blocked_date DATE NOT NULL UNIQUE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
-            
             results.append("   ✅ Таблица blocked_dates создана")
             
             # 4. Добавляем индексы для ускорения поиска
             results.append("<br><strong>📊 Шаг 4: Создание индексов...</strong>")
             
-            cursor.execute('CREATE INDEX idx_bookings_date ON bookings(excursion_date)')
-            cursor.execute('CREATE INDEX idx_bookings_status ON bookings(status)')
-            cursor.execute('CREATE INDEX idx_bookings_school ON bookings(school_name)')
+            db.run_batch(conn, [
+                'CREATE INDEX idx_bookings_date ON bookings(excursion_date)',
+                'CREATE INDEX idx_bookings_status ON bookings(status)',
+                'CREATE INDEX idx_bookings_school ON bookings(school_name)',
+            ])
             
             results.append("   ✅ Индексы созданы")
             
+            # Колонки, индексы и служебные таблицы (см. schema.py)
+            schema.ensure_schema(cursor)
+            # Прежние ID недействительны - клиентам нужна полная выгрузка
+            delta_sync.mark_full_resync(cursor)
+            
             # 5. Тестируем вставку
             results.append("<br><strong>📊 Шаг 5: Тестирование вставки данных...</strong>")
             
-            # Тестовые данные
-            cursor.execute('''
+            # Тестовые данные и тестовая заблокированная дата
+            db.run_batch(conn, ['''
                 INSERT INTO bookings 
                 (username, school_name, class_number, class_profile, 
                  excursion_date, contact_phone, participants_count, status, additional_info)
@@ -1659,23 +1916,19 @@ def recreate_database():
                  '2024-03-16', '+79997654321', 20, 'confirmed', 'Вторая тестовая запись'),
                 ('Сидоров Алексей Петрович', 'Школа №3', '9В', '', 
                  '2024-03-17', '+79995554433', 15, 'pending', 'Третья тестовая запись')
-            ''')
-            
-            # Тестовая заблокированная дата
-            cursor.execute('INSERT INTO blocked_dates (blocked_date) VALUES (%s)', ('2024-03-18',))
+            ''', ('INSERT INTO blocked_dates (blocked_date) VALUES (%s)', ('2024-03-18',))])
             
             results.append("   ✅ Тестовые данные добавлены")
             
             # 6. Проверяем структуру
             results.append("<br><strong>📊 Шаг 6: Проверка структуры базы...</strong>")
             
-            cursor.execute("SELECT COUNT(*) FROM bookings")
-            bookings_count = cursor.fetchone()[0]
-            results.append(f"   📊 Записей в bookings: {bookings_count}")
-            
-            cursor.execute("SELECT COUNT(*) FROM blocked_dates")
-            blocked_count = cursor.fetchone()[0]
-            results.append(f"   📊 Заблокированных дат: {blocked_count}")
+            bookings_rows, blocked_rows = db.run_batch(conn, [
+                "SELECT COUNT(*) FROM bookings",
+                "SELECT COUNT(*) FROM blocked_dates",
+            ])
+            results.append(f"   📊 Записей в bookings: {bookings_rows[0][0]}")
+            results.append(f"   📊 Заблокированных дат: {blocked_rows[0][0]}")
             
             # Финализируем
             conn.commit()
@@ -1703,8 +1956,259 @@ def recreate_database():
         results.append(f"<br><strong style='color: #e74c3c;'>❌ КРИТИЧЕСКАЯ ОШИБКА: {str(e)}</strong>")
         return False, results
 
+def clear_all_bookings():
+    """Удаляет все записи; возвращает, сколько осталось"""
+    conn = get_db_connection()
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM bookings')
+    # Вместо журнала на каждую запись - метка "удалено все"
+    delta_sync.mark_full_resync(cursor)
+    conn.commit()
+    
+    cursor.execute('SELECT COUNT(*) FROM bookings')
+    remaining = cursor.fetchone()[0]
+    
+    cursor.close()
+    conn.close()
+    return remaining
+
+# ---- Фоновые задачи (см. jobs.py) ----
+
+EXPORT_JOB_FORMATS = {
+    'csv': ('csv', 'text/csv; charset=utf-8'),
+    'json': ('json', 'application/json; charset=utf-8'),
+    'csv_filtered': ('csv', 'text/csv; charset=utf-8'),
+    'xlsx': ('xlsx', XLSX_MIMETYPE),
+}
+# Форматы, которые учитывают фильтры админ-панели
+EXPORT_FILTERED_FORMATS = ('csv_filtered', 'xlsx')
+
+def run_export_job(job):
+    """Экспорт в файл JOBS_DIR; прогресс считается по выгруженным строкам"""
+    export_format = job.params.get('format', 'csv')
+    if export_format not in EXPORT_JOB_FORMATS:
+        raise ValueError(f'Неизвестный формат экспорта: {export_format}')
+    extension, mimetype = EXPORT_JOB_FORMATS[export_format]
+    filters = export_filters(job.params.get('filters') or {})
+    
+    conn = get_db_connection()
+    try:
+        cursor = conn.cursor()
+        where_sql, params = bookings_where(filters) if export_format in EXPORT_FILTERED_FORMATS else ('', [])
+        cursor.execute('SELECT COUNT(*) FROM bookings' + where_sql, params)
+        total = cursor.fetchone()[0]
+        cursor.close()
+        job.progress(0, f'Записей к выгрузке: {total}')
+        
+        if export_format == 'csv':
+            body = export_csv_body(conn)
+        elif export_format == 'json':
+            body = export_json_body(conn)
+        elif export_format == 'xlsx':
+            body = export_xlsx_body(conn, filters)
+        else:
+            body = export_csv_filtered_body(conn, filters)
+        
+        # Генераторы отдают порцию на каждые EXPORT_CHUNK_ROWS строк
+        path = job.artifact_path(extension)
+        size = 0
+        try:
+            with open(f'{path}.tmp', 'wb') as f:
+                for chunks, chunk in enumerate(body):
+                    f.write(chunk)
+                    size += len(chunk)
+                    if total:
+                        job.progress(min(99, chunks * EXPORT_CHUNK_ROWS * 100 // total))
+            os.replace(f'{path}.tmp', path)
+        except Exception:
+            if os.path.exists(f'{path}.tmp'):
+                os.remove(f'{path}.tmp')
+            raise
+    finally:
+        conn.close()
+    
+    filename_parts = ['excursions_export']
+    if export_format in EXPORT_FILTERED_FORMATS and filters['status'] != 'all':
+        filename_parts.append(filters['status'])
+    filename_parts.append(datetime.now().strftime("%Y%m%d_%H%M%S"))
+    
+    return {
+        'file': path,
+        'filename': f'{"_".join(filename_parts)}.{extension}',
+        'mimetype': mimetype,
+        'size': size,
+        'lines': [f'Выгружено записей: {total}'],
+    }
+
+def run_fix_database_job(job):
+    job.progress(5, 'Исправление структуры базы...')
+    success, results = fix_database_operation()
+    shared_availability.invalidate()
+    return {'success': success, 'lines': results}
+
+def run_reset_database_job(job):
+    job.progress(5, 'Пересоздание таблиц...')
+    success, results = recreate_database()
+    shared_availability.invalidate()
+    return {'success': success, 'lines': results}
+
+def run_clear_all_job(job):
+    job.progress(5, 'Удаление записей...')
+    remaining = clear_all_bookings()
+    shared_availability.invalidate()
+    return {'lines': [f'Все записи были удалены. Осталось записей: {remaining}']}
+
+jobs.register('export', run_export_job, 'Экспорт записей', retry=True)
+jobs.register('fix_database', run_fix_database_job, 'Исправление структуры базы')
+jobs.register('reset_database', run_reset_database_job, 'Полный сброс базы')
+jobs.register('clear_all', run_clear_all_job, 'Очистка всех записей')
+
+def warm_export_cache():
+    """Собирает полные выгрузки заранее, если данные изменились (задача планировщика)"""
+    for export_format, extension, build in (('csv', 'csv', export_csv_body),
+                                            ('json', 'json', export_json_body)):
+        conn = get_db_connection()
+        try:
+            export_cache.get_or_build(conn, export_format, None, extension, build)
+        finally:
+            conn.close()
+
+# Периодические задачи (scheduler.py): выполняет один воркер-лидер
+if keep_alive.enabled():
+    scheduler.register('keep_alive', keep_alive.ping, keep_alive.KEEPALIVE_INTERVAL_SECONDS)
+scheduler.register('export_warmup', warm_export_cache, EXPORT_WARMUP_SECONDS, delay=60)
+scheduler.register('export_cache_cleanup', export_cache.cleanup, 3600, delay=300)
+scheduler.register('pending_expiry', pending_expiry.sweep, pending_expiry.PENDING_EXPIRY_INTERVAL_SECONDS, delay=120)
+
+@app.route('/admin/jobs/export', methods=['POST'])
+@admin_required
+def enqueue_export():
+    """Ставит экспорт в очередь фоновых задач"""
+    export_format = request.form.get('format', 'csv')
+    if export_format not in EXPORT_JOB_FORMATS:
+        return 'format: csv, json, csv_filtered или xlsx', 400
+    
+    job_id = jobs.enqueue('export', {
+        'format': export_format,
+        'filters': export_filters(request.form),
+    }, title=f'Экспорт {export_format.upper()}')
+    return redirect(f'/admin/jobs/{job_id}')
+
+@app.route('/admin/jobs')
+@admin_required
+def jobs_list():
+    """Последние фоновые задачи"""
+    rows = []
+    for job in jobs.recent():
+        rows.append(f"""
+            <tr>
+                <td><a href="/admin/jobs/{job['id']}">#{job['id']}</a></td>
+                <td>{escape(job['title'] or job['kind'])}</td>
+                <td>{jobs.STATUS_LABELS.get(job['status'], job['status'])}</td>
+                <td>{job['progress']}%</td>
+                <td>{job['created_at'].strftime('%d.%m.%Y %H:%M:%S')}</td>
+            </tr>""")
+    
+    return f"""
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <title>Фоновые задачи</title>
+        <meta name="viewport" content="width=device-width, initial-scale=1.0">
+        <style>
+            body {{ font-family: Arial; padding: 20px; background: #f5f5f5; }}
+            .container {{ max-width: 900px; margin: 0 auto; background: white; padding: 30px; border-radius: 10px; box-shadow: 0 5px 15px rgba(0,0,0,0.1); }}
+            table {{ width: 100%; border-collapse: collapse; }}
+            th, td {{ padding: 10px; border-bottom: 1px solid #eee; text-align: left; }}
+            .btn {{ display: inline-block; padding: 12px 24px; background: #3498db; color: white; text-decoration: none; border-radius: 5px; margin-top: 20px; }}
+        </style>
+    </head>
+    <body>
+        <div class="container">
+            <h1>⏳ Фоновые задачи</h1>
+            <table>
+                <tr><th>ID</th><th>Задача</th><th>Статус</th><th>Прогресс</th><th>Создана</th></tr>
+                {''.join(rows) or '<tr><td colspan="5">Задач пока нет</td></tr>'}
+            </table>
+            <a href="/admin" class="btn">Вернуться в админ-панель</a>
+        </div>
+    </body>
+    </html>
+    """
+
+@app.route('/admin/jobs/<int:job_id>')
+@admin_required
+def job_status(job_id):
+    """Статус фоновой задачи: прогресс, результат и ссылка на файл"""
+    job = jobs.get(job_id)
+    if job is None:
+        return redirect('/admin/jobs')
+    
+    in_progress = job['status'] in ('queued', 'running')
+    result = job['result'] or {}
+    color = {'done': '#2ecc71', 'failed': '#e74c3c'}.get(job['status'], '#f39c12')
+    
+    details = ''
+    if job['message'] and in_progress:
+        details += f"<p>{escape(job['message'])}</p>"
+    if job['error']:
+        details += f'<p style="background: #ffe6e6; padding: 15px; border-radius: 5px;">{escape(job["error"])}</p>'
+    if result.get('lines'):
+        # Строки отчета операций с базой уже содержат HTML-разметку
+        details += f'<div class="results">{"<br>".join(result["lines"])}</div>'
+    if job['status'] == 'done' and result.get('file'):
+        details += (f'<a href="/admin/jobs/{job_id}/download" class="btn" style="background: #27ae60;">'
+                    f'📥 Скачать {escape(result["filename"])} ({result.get("size", 0) // 1024} КБ)</a>')
+    
+    return f"""
+    <!DOCTYPE html>
+    <html>
+    <head>
+        <title>Задача #{job_id}</title>
+        <meta name="viewport" content="width=device-width, initial-scale=1.0">
+        {'<meta http-equiv="refresh" content="2">' if in_progress else ''}
+        <style>
+            body {{ font-family: Arial; padding: 20px; background: #f5f5f5; }}
+            .container {{ max-width: 800px; margin: 0 auto; background: white; padding: 30px; border-radius: 10px; box-shadow: 0 5px 15px rgba(0,0,0,0.1); }}
+            .progress {{ background: #ecf0f1; border-radius: 5px; height: 24px; overflow: hidden; margin: 20px 0; }}
+            .progress-bar {{ background: {color}; height: 100%; width: {job['progress']}%; }}
+            .results {{ margin: 20px 0; padding: 20px; background: #f8f9fa; border-radius: 5px; max-height: 500px; overflow-y: auto; font-family: monospace; font-size: 14px; line-height: 1.4; }}
+            .btn {{ display: inline-block; padding: 12px 24px; background: #3498db; color: white; text-decoration: none; border-radius: 5px; margin: 10px 10px 0 0; }}
+        </style>
+    </head>
+    <body>
+        <div class="container">
+            <h1>{escape(job['title'] or job['kind'])} <small>#{job_id}</small></h1>
+            <h2 style="color: {color};">{jobs.STATUS_LABELS.get(job['status'], job['status'])}</h2>
+            <div class="progress"><div class="progress-bar"></div></div>
+            {details}
+            <div>
+                <a href="/admin" class="btn">Вернуться в админ-панель</a>
+                <a href="/admin/jobs" class="btn" style="background: #95a5a6;">Все задачи</a>
+            </div>
+        </div>
+    </body>
+    </html>
+    """
+
+@app.route('/admin/jobs/<int:job_id>/download')
+@admin_required
+def job_download(job_id):
+    """Скачивание файла, подготовленного фоновой задачей"""
+    job = jobs.get(job_id)
+    result = (job or {}).get('result') or {}
+    if not job or job['status'] != 'done' or not result.get('file') or not os.path.exists(result['file']):
+        return redirect(f'/admin/jobs/{job_id}')
+    
+    metrics.inc('export_bytes_total', os.path.getsize(result['file']),
+                format=(job.get('params') or {}).get('format', 'csv'))
+    return send_file(result['file'], mimetype=result['mimetype'], as_attachment=True,
+                     download_name=result['filename'])
+
 if __name__ == '__main__':
     init_database()
-    start_keep_alive()
+    jobs.start_workers()
+    notifications.start_dispatcher()
+    scheduler.start()
     port = int(os.environ.get('PORT', 5000))
     app.run(host='0.0.0.0', port=port, debug=False)
\ No newline at end of file
@@ -0,0 +1,197 @@
+# availability.py - Доступность дней за произвольный период одним запросом
+#
+# Для периода в несколько месяцев PostgreSQL сам строит ряд дат
+# (generate_series), подтягивает к нему число активных записей и участников,
+# заблокированные даты и правила вместимости (переданные массивами) и
+# классифицирует все дни одним CASE: past / weekend / closed / blocked /
+# booked / limited / available. В Python остается только разложить строки
+# по месяцам.
+#
+# Если занятость дней уже есть в общей памяти воркеров
+# (shared_availability.py), те же статусы считает classify_loads - без БД.
+#
+# Подсчет активных записей по датам идет index-only scan по частичному
+# индексу ACTIVE_INDEX. Для этого status - NOT NULL (ensure_schema), а
+# условие "запись активна" во всех запросах - ровно status != 'cancelled':
+# с OR status IS NULL планировщик индекс использовать не может.
+import calendar
+from datetime import date
+
+# Не больше стольких месяцев за один запрос
+MAX_MONTHS = 12
+
+ACTIVE_INDEX = 'idx_bookings_active_date'
+
+# Активные записи по всем датам
+COUNTS_BY_DATE_SQL = '''
+    SELECT excursion_date, COUNT(*) AS bookings
+    FROM bookings
+    WHERE status != 'cancelled'
+    GROUP BY excursion_date
+'''
+
+# Записи и участники по датам периода %(start)s..%(end)s
+LOAD_SQL = '''
+    SELECT excursion_date, COUNT(*) AS bookings, SUM(participants_count) AS participants
+    FROM bookings
+    WHERE excursion_date BETWEEN %(start)s AND %(end)s
+      AND status != 'cancelled'
+    GROUP BY excursion_date
+'''
+
+STATUSES = ('past', 'weekend', 'closed', 'blocked', 'booked', 'limited', 'available')
+
+
+def ensure_schema(cursor):
+    """status NOT NULL DEFAULT 'pending' и частичный покрывающий индекс (идемпотентно)"""
+    cursor.execute('''
+        SELECT is_nullable = 'YES' FROM information_schema.columns
+        WHERE table_schema = current_schema() AND table_name = 'bookings' AND column_name = 'status'
+    ''')
+    row = cursor.fetchone()
+    if row and row[0]:
+        cursor.execute("UPDATE bookings SET status = 'pending' WHERE status IS NULL")
+        cursor.execute("ALTER TABLE bookings ALTER COLUMN status SET DEFAULT 'pending'")
+        cursor.execute('ALTER TABLE bookings ALTER COLUMN status SET NOT NULL')
+
+    # Все, что нужно календарю и проверке дня, есть в самом индексе
+    cursor.execute(f'''
+        CREATE INDEX IF NOT EXISTS {ACTIVE_INDEX}
+        ON bookings (excursion_date) INCLUDE (participants_count, time_slot)
+        WHERE status != 'cancelled'
+    ''')
+
+
+def month_bounds(year, month, months=1):
+    """Первый день месяца и последний день месяца через months - 1"""
+    if not 1 <= months <= MAX_MONTHS:
+        raise ValueError(f'Количество месяцев - от 1 до {MAX_MONTHS}')
+    start = date(year, month, 1)
+    last_index = year * 12 + month - 1 + months - 1
+    last_year, last_month = divmod(last_index, 12)
+    last_month += 1
+    end = date(last_year, last_month, calendar.monthrange(last_year, last_month)[1])
+    return start, end
+
+
+def classify_range(cursor, start, end, rules, today=None):
+    """Дни с start по end включительно с их статусом и свободными местами.
+
+    cursor должен возвращать словари. rules - capacity.CapacityRules.
+    Возвращает строки {day, status, available_slots, total_slots, blocked}.
+    """
+    if today is None:
+        today = date.today()
+    weekday_slots, weekday_caps, rule_dates, date_slots, date_caps = rules.arrays()
+
+    cursor.execute(f'''
+        WITH days AS (
+            SELECT d::date AS day, EXTRACT(ISODOW FROM d)::int AS isodow
+            FROM generate_series(%(start)s::date, %(end)s::date, INTERVAL '1 day') AS d
+        ),
+        load AS ({LOAD_SQL}),
+        date_rules AS (
+            SELECT * FROM unnest(%(rule_dates)s::date[], %(date_slots)s::int[], %(date_caps)s::int[])
+                AS rule(day, slots, max_participants)
+        ),
+        capacity AS (
+            SELECT days.day, days.isodow,
+                   COALESCE(load.bookings, 0) AS bookings,
+                   COALESCE(load.participants, 0) AS participants,
+                   blocked.blocked_date IS NOT NULL AS blocked,
+                   CASE WHEN rule.day IS NOT NULL THEN rule.slots
+                        ELSE (%(weekday_slots)s::int[])[days.isodow] END AS slots,
+                   CASE WHEN rule.day IS NOT NULL THEN rule.max_participants
+                        ELSE (%(weekday_caps)s::int[])[days.isodow] END AS max_participants
+            FROM days
+            LEFT JOIN load ON load.excursion_date = days.day
+            LEFT JOIN blocked_dates AS blocked ON blocked.blocked_date = days.day
+            LEFT JOIN date_rules AS rule ON rule.day = days.day
+        ),
+        free AS (
+            SELECT *,
+                   CASE WHEN max_participants IS NOT NULL AND participants >= max_participants THEN 0
+                        ELSE GREATEST(0, slots - bookings) END AS free_slots
+            FROM capacity
+        )
+        SELECT day,
+               CASE WHEN day < %(today)s THEN 'past'
+                    WHEN isodow >= 6 THEN 'weekend'
+                    WHEN slots = 0 THEN 'closed'
+                    WHEN blocked THEN 'blocked'
+                    WHEN free_slots = 0 THEN 'booked'
+                    WHEN free_slots = 1 THEN 'limited'
+                    ELSE 'available' END AS status,
+               CASE WHEN day < %(today)s OR isodow >= 6 OR blocked THEN 0
+                    ELSE free_slots END AS available_slots,
+               slots AS total_slots,
+               blocked
+        FROM free
+        ORDER BY day
+    ''', {
+        'start': start,
+        'end': end,
+        'today': today,
+        'weekday_slots': weekday_slots,
+        'weekday_caps': weekday_caps,
+        'rule_dates': rule_dates,
+        'date_slots': date_slots,
+        'date_caps': date_caps,
+    })
+    return cursor.fetchall()
+
+
+def classify_loads(start, loads, rules, today=None):
+    """Строки как у classify_range по готовой занятости дней - тот же CASE в Python.
+
+    loads - [(записей, участников, заблокирован)] подряд начиная со start.
+    Вместимость всех дней разрешается заранее (rules.for_range), дни недели
+    идут по кругу от start - в проходе нет поиска правил и вызовов на день.
+    """
+    if today is None:
+        today = date.today()
+    base = start.toordinal()
+    past = max(0, today.toordinal() - base)
+    weekday = start.weekday()
+    rows = []
+    for offset, (day_capacity, (bookings, participants, blocked)) in enumerate(
+            zip(rules.for_range(start, len(loads)), loads)):
+        weekend = (weekday + offset) % 7 >= 5
+        slots = day_capacity.slots
+        if day_capacity.max_participants is not None and participants >= day_capacity.max_participants:
+            free = 0
+        else:
+            free = max(0, slots - bookings)
+        if offset < past:
+            status = 'past'
+        elif weekend:
+            status = 'weekend'
+        elif slots == 0:
+            status = 'closed'
+        elif blocked:
+            status = 'blocked'
+        elif free == 0:
+            status = 'booked'
+        elif free == 1:
+            status = 'limited'
+        else:
+            status = 'available'
+        rows.append({
+            'day': date.fromordinal(base + offset),
+            'status': status,
+            'available_slots': 0 if offset < past or weekend or blocked else free,
+            'total_slots': slots,
+            'blocked': blocked,
+        })
+    return rows
+
+
+def by_month(rows):
+    """Раскладывает строки classify_range по месяцам: [(year, month, [rows])]"""
+    months = []
+    for row in rows:
+        key = (row['day'].year, row['day'].month)
+        if not months or months[-1][:2] != key:
+            months.append((key[0], key[1], []))
+        months[-1][2].append(row)
+    return months
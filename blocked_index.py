@@ -0,0 +1,162 @@
+# blocked_index.py - Заблокированные даты в памяти: битовая карта по порядковому номеру дня
+#
+# Бит i карты соответствует дню base + i (date.toordinal()), поэтому проверка
+# даты - сдвиг и маска, а проверка периода - одна маска на весь период.
+# Карта строится одним SELECT по blocked_dates и неизменяема: обновление
+# создает новую карту и подменяет ссылку, так что читатели в других потоках
+# не видят промежуточного состояния.
+#
+# Пока карта не загружена (холодный старт) или устарела, проверка даты
+# идет точечным запросом WHERE blocked_date = %s, а карта загружается в фоне.
+# Блокировка/разблокировка в этом процессе сразу правит карту; остальные
+# воркеры перечитают ее через BLOCKED_DATES_REFRESH_SECONDS.
+#
+# Карта - только для отображения календаря. Прием заявки (submit_booking)
+# проверяет blocked_dates в своей транзакции под блокировкой дня: отставание
+# карты не должно пропускать записи на уже заблокированную дату.
+import os
+import time
+import threading
+from datetime import date
+
+import db
+
+BLOCKED_DATES_REFRESH_SECONDS = float(os.environ.get('BLOCKED_DATES_REFRESH_SECONDS', 30))
+
+_index = None
+_loaded_at = 0.0
+_loading = threading.Lock()
+
+
+class BlockedDateIndex:
+    """Неизменяемая битовая карта заблокированных дат"""
+    __slots__ = ('base', 'bits')
+
+    def __init__(self, dates=(), base=None, bits=0):
+        if base is None:
+            ordinals = [day.toordinal() for day in dates]
+            base = min(ordinals) if ordinals else date.today().toordinal()
+            for ordinal in ordinals:
+                bits |= 1 << (ordinal - base)
+        self.base = base
+        self.bits = bits
+
+    def __len__(self):
+        return bin(self.bits).count('1')
+
+    def __contains__(self, day):
+        offset = day.toordinal() - self.base
+        return offset >= 0 and (self.bits >> offset) & 1 == 1
+
+    def _range_bits(self, start, end):
+        first = max(0, start.toordinal() - self.base)
+        last = end.toordinal() - self.base
+        if last < first:
+            return 0, first
+        return (self.bits >> first) & ((1 << (last - first + 1)) - 1), first
+
+    def any_in_range(self, start, end):
+        """Есть ли заблокированные дни с start по end включительно"""
+        return self._range_bits(start, end)[0] != 0
+
+    def in_range(self, start, end):
+        """Заблокированные дни с start по end включительно"""
+        bits, first = self._range_bits(start, end)
+        days = []
+        offset = first
+        while bits:
+            if bits & 1:
+                days.append(date.fromordinal(self.base + offset))
+            bits >>= 1
+            offset += 1
+        return days
+
+    def changed(self, blocked=(), unblocked=()):
+        """Новая карта с добавленными и снятыми датами"""
+        ordinals = [day.toordinal() for day in blocked]
+        base = min([self.base] + ordinals)
+        bits = self.bits << (self.base - base)
+        for ordinal in ordinals:
+            bits |= 1 << (ordinal - base)
+        for day in unblocked:
+            offset = day.toordinal() - base
+            if offset >= 0:
+                bits &= ~(1 << offset)
+        return BlockedDateIndex(base=base, bits=bits)
+
+
+def load(cursor):
+    cursor.execute('SELECT blocked_date FROM blocked_dates')
+    return BlockedDateIndex([row[0] for row in cursor.fetchall()])
+
+
+def refresh():
+    """Перечитывает карту из БД"""
+    global _index, _loaded_at
+    conn = db.get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            index = load(cursor)
+        conn.commit()
+    finally:
+        conn.close()
+    _index = index
+    _loaded_at = time.monotonic()
+    return index
+
+
+def _refresh_in_background():
+    if not _loading.acquire(blocking=False):
+        return
+
+    def run():
+        try:
+            refresh()
+        except Exception as e:
+            print(f"Ошибка загрузки заблокированных дат: {e}")
+        finally:
+            _loading.release()
+
+    threading.Thread(target=run, daemon=True, name='blocked-dates-refresh').start()
+
+
+def get_index():
+    """Актуальная карта или None, если она еще не загружена или устарела"""
+    index = _index
+    if index is not None and time.monotonic() - _loaded_at < BLOCKED_DATES_REFRESH_SECONDS:
+        return index
+    _refresh_in_background()
+    return None
+
+
+def is_blocked(day):
+    """Заблокирована ли дата: по карте, а без нее - точечным запросом"""
+    index = get_index()
+    if index is not None:
+        return day in index
+
+    conn = db.get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SELECT 1 FROM blocked_dates WHERE blocked_date = %s', (day,))
+            blocked = cursor.fetchone() is not None
+        conn.commit()
+    finally:
+        conn.close()
+    return blocked
+
+
+def blocked_in_range(start, end):
+    """Заблокированные дни периода (при необходимости карта загружается сразу)"""
+    index = get_index()
+    if index is None:
+        index = refresh()
+    return index.in_range(start, end)
+
+
+def apply(blocked=(), unblocked=()):
+    """Учитывает блокировку/разблокировку этого процесса (вызывать после commit)"""
+    global _index
+    index = _index
+    if index is not None:
+        _index = index.changed(blocked, unblocked)
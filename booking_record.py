@@ -0,0 +1,93 @@
+# booking_record.py - Компактная запись bookings для админки и выгрузок
+#
+# dict_row создает на каждую строку свой словарь (хэш-таблицу), а выгрузки
+# еще и копировали его в новый словарь. Booking хранит значения в __slots__:
+# без __dict__ на экземпляр строка занимает в несколько раз меньше памяти,
+# а чтение атрибута - обращение к слоту по смещению.
+#
+# Курсор с row_factory=booking_row отдает Booking. Поддерживается и доступ
+# по ключу (booking['id'], booking.get(...)), как у словаря: шаблоны и
+# выгрузки, написанные под dict_row, работают без изменений. Колонки,
+# которых не было в запросе, отсутствуют и у записи - как ключи словаря.
+import psycopg
+from psycopg.rows import no_result
+
+# Колонки bookings и псевдонимы, которые встречаются в запросах админки и выгрузок
+FIELDS = (
+    'id', 'username', 'school_name', 'class_number', 'class_profile',
+    'excursion_date', 'contact_phone', 'participants_count', 'status',
+    'booking_date', 'additional_info', 'updated_at', 'time_slot',
+    'idempotency_key',
+    # Псевдонимы выгрузок
+    'responsible_person', 'status_rus', 'change',
+)
+
+
+class Booking:
+    """Строка bookings со значениями в слотах"""
+    __slots__ = FIELDS
+
+    def __init__(self, **values):
+        for name, value in values.items():
+            setattr(self, name, value)
+
+    def __getitem__(self, name):
+        try:
+            return getattr(self, name)
+        except AttributeError:
+            raise KeyError(name) from None
+
+    def __contains__(self, name):
+        return name in _FIELD_SET and hasattr(self, name)
+
+    def get(self, name, default=None):
+        return getattr(self, name, default) if name in _FIELD_SET else default
+
+    def keys(self):
+        return [name for name in FIELDS if hasattr(self, name)]
+
+    def as_dict(self):
+        """Словарь колонок, выбранных запросом (в порядке FIELDS)"""
+        return {name: getattr(self, name) for name in FIELDS if hasattr(self, name)}
+
+    def __repr__(self):
+        return f'Booking({self.as_dict()!r})'
+
+
+_FIELD_SET = frozenset(FIELDS)
+# Конструкторы строк по набору колонок запроса
+_makers = {}
+
+
+def _maker(names):
+    """Функция values -> Booking для данного набора колонок.
+
+    Как namedtuple, код собирается один раз на набор колонок: присваивание
+    кортежа слотам (b.id, b.username, ... = values) в несколько раз быстрее
+    цикла с setattr. Имена уже проверены по FIELDS.
+    """
+    maker = _makers.get(names)
+    if maker is None:
+        targets = ', '.join(f'b.{name}' for name in names)
+        source = (
+            'def make_row(values):\n'
+            '    b = new(Booking)\n'
+            f'    {targets}, = values\n'
+            '    return b\n'
+        )
+        namespace = {'new': Booking.__new__, 'Booking': Booking}
+        exec(source, namespace)
+        maker = _makers[names] = namespace['make_row']
+    return maker
+
+
+def booking_row(cursor):
+    """Фабрика строк psycopg: каждая строка результата - Booking"""
+    if cursor.description is None:
+        return no_result
+
+    names = tuple(column.name for column in cursor.description)
+    unknown = [name for name in names if name not in _FIELD_SET]
+    if unknown:
+        raise psycopg.ProgrammingError(f"Booking: неизвестные колонки {', '.join(unknown)}")
+    return _maker(names)
@@ -0,0 +1,170 @@
+# bulk_ops.py - Массовые действия с записями: подтверждение, отмена, удаление
+#
+# Выбранные ID передаются одним параметром-массивом (id = ANY(%s)), поэтому
+# текст запроса не зависит от размера выборки. Очень большие выборки
+# обрабатываются частями по BULK_CHUNK_SIZE, но в одной транзакции вызывающего.
+# RETURNING сообщает, какие записи действительно изменены: по ним строится
+# результат для каждого ID, уведомления и пересчет занятости затронутых дат.
+import os
+
+import delta_sync
+import metrics
+import notifications
+
+BULK_CHUNK_SIZE = int(os.environ.get('BULK_CHUNK_SIZE', 1000))
+# Больше ID за один запрос не принимаем - это уже не выделение в таблице
+BULK_MAX_IDS = int(os.environ.get('BULK_MAX_IDS', 50000))
+
+# action -> новый статус (None - удаление)
+ACTIONS = {
+    'confirm': 'confirmed',
+    'cancel': 'cancelled',
+    'delete': None,
+}
+
+ACTION_LABELS = {
+    'confirm': 'Подтверждено',
+    'cancel': 'Отменено',
+    'delete': 'Удалено',
+}
+
+# Результаты по отдельным ID
+RESULT_LABELS = {
+    'updated': 'изменено',
+    'deleted': 'удалено',
+    'unchanged': 'уже в этом статусе',
+    'not_found': 'не найдено',
+}
+
+# INTEGER в PostgreSQL
+MAX_ID = 2 ** 31 - 1
+
+
+def parse_ids(values):
+    """ID из формы или JSON: (уникальные ID в исходном порядке, отвергнутые значения)"""
+    ids = []
+    invalid = []
+    seen = set()
+    for value in values:
+        try:
+            booking_id = int(str(value).strip())
+        except ValueError:
+            invalid.append(str(value))
+            continue
+        if not 0 < booking_id <= MAX_ID:
+            invalid.append(str(value))
+            continue
+        if booking_id not in seen:
+            seen.add(booking_id)
+            ids.append(booking_id)
+    return ids, invalid
+
+
+def _chunks(ids):
+    for start in range(0, len(ids), BULK_CHUNK_SIZE):
+        yield ids[start:start + BULK_CHUNK_SIZE]
+
+
+def _update_status(cursor, chunk, status):
+    # Записи уже в этом статусе не трогаем - иначе лишние уведомления
+    cursor.execute(f'''
+        UPDATE bookings SET status = %s, updated_at = CURRENT_TIMESTAMP
+        WHERE id = ANY(%s) AND status IS DISTINCT FROM %s
+        RETURNING {notifications.BOOKING_FIELDS}
+    ''', (status, chunk, status))
+    changed = cursor.fetchall()
+    notifications.enqueue(cursor, 'status_changed', changed)
+
+    # Оставшиеся ID: либо уже в нужном статусе, либо их нет
+    changed_ids = {row['id'] for row in changed}
+    rest = [booking_id for booking_id in chunk if booking_id not in changed_ids]
+    existing = set()
+    if rest:
+        cursor.execute('SELECT id FROM bookings WHERE id = ANY(%s)', (rest,))
+        existing = {row['id'] for row in cursor.fetchall()}
+    return changed, 'updated', existing
+
+
+def _delete(cursor, chunk):
+    deleted = delta_sync.delete_bookings(cursor, chunk, returning='id, excursion_date, status')
+    return deleted, 'deleted', set()
+
+
+def day_counts(cursor, dates):
+    """Активные (не отмененные) записи на датах - в снимке текущей транзакции"""
+    if not dates:
+        return {}
+    cursor.execute('''
+        SELECT excursion_date, COUNT(*) AS active
+        FROM bookings
+        WHERE excursion_date = ANY(%s)
+          AND status != 'cancelled'
+        GROUP BY excursion_date
+    ''', (sorted(dates),))
+    counts = {day.isoformat(): 0 for day in dates}
+    for row in cursor.fetchall():
+        counts[row['excursion_date'].isoformat()] = row['active']
+    return dict(sorted(counts.items()))
+
+
+def run(cursor, action, ids):
+    """Выполняет массовое действие в текущей транзакции (commit - у вызывающего).
+
+    cursor должен возвращать словари (dict_row). Возвращает сводку:
+    результат для каждого ID, счетчики и занятость затронутых дат.
+    Метрики записывает record_metrics - после commit.
+    """
+    if action not in ACTIONS:
+        raise ValueError(f'Неизвестное действие: {action}')
+    if len(ids) > BULK_MAX_IDS:
+        raise ValueError(f'Слишком много записей за раз: {len(ids)} (максимум {BULK_MAX_IDS})')
+
+    status = ACTIONS[action]
+    results = {}
+    dates = set()
+    for chunk in _chunks(ids):
+        if status is None:
+            affected, result, existing = _delete(cursor, chunk)
+        else:
+            affected, result, existing = _update_status(cursor, chunk, status)
+        for row in affected:
+            results[row['id']] = result
+            dates.add(row['excursion_date'])
+        for booking_id in chunk:
+            if booking_id not in results:
+                results[booking_id] = 'unchanged' if booking_id in existing else 'not_found'
+
+    counts = {name: 0 for name in RESULT_LABELS}
+    for result in results.values():
+        counts[result] += 1
+    affected_count = counts['updated'] + counts['deleted']
+
+    return {
+        'success': True,
+        'action': action,
+        'requested': len(ids),
+        'affected': affected_count,
+        'counts': counts,
+        'results': {str(booking_id): results[booking_id] for booking_id in ids},
+        'days': day_counts(cursor, dates),
+    }
+
+
+def record_metrics(summary):
+    """Счетчики по сводке run (вызывать после commit - откаченное не считаем)"""
+    if summary['action'] == 'cancel':
+        metrics.inc('bookings_cancelled_total', summary['affected'])
+    for result, value in summary['counts'].items():
+        if value:
+            metrics.inc('bulk_action_rows_total', value, action=summary['action'], result=result)
+
+
+def summary_message(summary, invalid=()):
+    """Текст для администратора: '<Действие>: N; уже в этом статусе: M; ...'"""
+    parts = [f"{ACTION_LABELS[summary['action']]}: {summary['affected']}"]
+    for result in ('unchanged', 'not_found'):
+        if summary['counts'][result]:
+            parts.append(f"{RESULT_LABELS[result]}: {summary['counts'][result]}")
+    if invalid:
+        parts.append(f"некорректных ID: {len(invalid)}")
+    return '; '.join(parts)
@@ -0,0 +1,300 @@
+# capacity.py - Правила вместимости: сколько групп и участников принимается в день
+#
+# Правила хранятся в таблице capacity_rules: правило дня недели или
+# конкретной даты (правило даты важнее). Правило задает число групп в день
+# (0 - день закрыт), необязательный лимит участников на день и, при
+# необходимости, время начала экскурсий (тогда групп столько, сколько времен).
+#
+# При первом обращении правила компилируются в таблицу из 7 дней недели и
+# словарь дат, так что проверка любого дня - O(1) без обращения к БД.
+# Изменение правил в админке сбрасывает кэш своего процесса; остальные
+# воркеры перечитают правила через CAPACITY_REFRESH_SECONDS.
+import os
+import re
+import time
+import threading
+from psycopg.rows import dict_row
+
+import db
+
+# Групп в день для дней без правила
+DEFAULT_SLOTS = int(os.environ.get('CAPACITY_DEFAULT_SLOTS', 2))
+CAPACITY_REFRESH_SECONDS = float(os.environ.get('CAPACITY_REFRESH_SECONDS', 30))
+# Дни недели, закрытые правилами по умолчанию (понедельник и пятница)
+DEFAULT_CLOSED_WEEKDAYS = (0, 4)
+# Участников в одной группе (ограничение формы записи)
+MAX_GROUP_SIZE = 20
+# Пространство ключей pg_advisory_xact_lock для блокировки дня
+LOCK_NAMESPACE = 3801
+
+_TIME_RE = re.compile(r'^([01]?\d|2[0-3]):([0-5]\d)$')
+
+_rules = None
+_loaded_at = 0.0
+_lock = threading.Lock()
+
+
+def ensure_schema(cursor):
+    """Таблица правил и колонка времени у записей (идемпотентно).
+
+    Правила по умолчанию добавляются только при создании таблицы: если
+    администратор удалил все правила, они не должны появиться снова.
+    """
+    cursor.execute("SELECT to_regclass('capacity_rules') IS NULL")
+    if cursor.fetchone()[0]:
+        # Воркеры инициализируют базу одновременно - создает один
+        # (ключ 0 не совпадает с днями lock_day: их ключи - номера дат)
+        cursor.execute('SELECT pg_advisory_xact_lock(%s, 0)', (LOCK_NAMESPACE,))
+        cursor.execute("SELECT to_regclass('capacity_rules') IS NULL")
+        if cursor.fetchone()[0]:
+            _create_rules_table(cursor)
+
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_capacity_rules_weekday ON capacity_rules(weekday) WHERE weekday IS NOT NULL')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_capacity_rules_date ON capacity_rules(rule_date) WHERE rule_date IS NOT NULL')
+
+    cursor.execute('ALTER TABLE bookings ADD COLUMN IF NOT EXISTS time_slot VARCHAR(5)')
+
+
+def _create_rules_table(cursor):
+    """Новая таблица правил с правилами по умолчанию"""
+    cursor.execute('''
+        CREATE TABLE capacity_rules (
+            id SERIAL PRIMARY KEY,
+            weekday SMALLINT CHECK (weekday BETWEEN 0 AND 6),
+            rule_date DATE,
+            slots INTEGER NOT NULL CHECK (slots >= 0),
+            max_participants INTEGER CHECK (max_participants > 0),
+            time_slots TEXT[],
+            note VARCHAR(200),
+            updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            CHECK ((weekday IS NULL) <> (rule_date IS NULL))
+        )
+    ''')
+    # Прежнее поведение: понедельник и пятница закрыты
+    cursor.execute('''
+        INSERT INTO capacity_rules (weekday, slots, note)
+        SELECT weekday, 0, 'Экскурсии не проводятся'
+        FROM unnest(%s::smallint[]) AS weekday
+    ''', (list(DEFAULT_CLOSED_WEEKDAYS),))
+
+
+class DayCapacity:
+    """Вместимость одного дня"""
+    __slots__ = ('slots', 'max_participants', 'time_slots', 'rule_id')
+
+    def __init__(self, slots, max_participants=None, time_slots=(), rule_id=None):
+        self.time_slots = tuple(time_slots or ())
+        # Если задано время, каждая группа занимает одно время
+        self.slots = len(self.time_slots) if self.time_slots else slots
+        self.max_participants = max_participants
+        self.rule_id = rule_id
+
+    @property
+    def closed(self):
+        return self.slots == 0
+
+    def available(self, bookings_count, participants=0):
+        """Сколько групп еще можно записать"""
+        free = max(0, self.slots - bookings_count)
+        if self.max_participants is not None and participants >= self.max_participants:
+            return 0
+        return free
+
+    def participants_left(self, participants=0):
+        """Сколько участников еще можно записать одной группой"""
+        if self.max_participants is None:
+            return MAX_GROUP_SIZE
+        return max(0, min(MAX_GROUP_SIZE, self.max_participants - participants))
+
+    def free_time_slots(self, taken):
+        taken = set(taken)
+        return [slot for slot in self.time_slots if slot not in taken]
+
+
+class CapacityRules:
+    """Скомпилированные правила: таблица дней недели и словарь дат"""
+
+    def __init__(self, rows=()):
+        default = DayCapacity(DEFAULT_SLOTS)
+        self._weekdays = [default] * 7
+        self._dates = {}
+        for row in rows:
+            capacity = DayCapacity(row['slots'], row['max_participants'], row['time_slots'], row['id'])
+            if row['rule_date'] is not None:
+                self._dates[row['rule_date']] = capacity
+            else:
+                self._weekdays[row['weekday']] = capacity
+
+    def for_day(self, day):
+        capacity = self._dates.get(day)
+        if capacity is None:
+            capacity = self._weekdays[day.weekday()]
+        return capacity
+
+    def for_range(self, start, days):
+        """Вместимость days дней подряд начиная со start: дни недели по кругу, поверх - даты"""
+        first = start.weekday()
+        week = self._weekdays[first:] + self._weekdays[:first]
+        capacities = (week * (days // 7 + 1))[:days]
+        base = start.toordinal()
+        for day, capacity in self._dates.items():
+            if 0 <= day.toordinal() - base < days:
+                capacities[day.toordinal() - base] = capacity
+        return capacities
+
+    def closed_weekdays(self):
+        return [weekday for weekday, capacity in enumerate(self._weekdays) if capacity.closed]
+
+    def arrays(self):
+        """Правила в виде массивов для классификации дней в SQL.
+
+        Возвращает (групп по дням недели, лимиты по дням недели,
+        даты правил, групп по датам, лимиты по датам); дни недели -
+        с понедельника.
+        """
+        dates = sorted(self._dates)
+        return (
+            [c.slots for c in self._weekdays],
+            [c.max_participants for c in self._weekdays],
+            dates,
+            [self._dates[d].slots for d in dates],
+            [self._dates[d].max_participants for d in dates],
+        )
+
+
+def load(cursor):
+    """Читает и компилирует правила; cursor должен возвращать словари"""
+    cursor.execute('''
+        SELECT id, weekday, rule_date, slots, max_participants, time_slots
+        FROM capacity_rules
+    ''')
+    return CapacityRules(cursor.fetchall())
+
+
+def get_rules():
+    """Скомпилированные правила этого процесса (перечитываются раз в CAPACITY_REFRESH_SECONDS)"""
+    global _rules, _loaded_at
+    rules = _rules
+    if rules is not None and time.monotonic() - _loaded_at < CAPACITY_REFRESH_SECONDS:
+        return rules
+
+    with _lock:
+        if _rules is not None and time.monotonic() - _loaded_at < CAPACITY_REFRESH_SECONDS:
+            return _rules
+        try:
+            conn = db.get_db_connection()
+            try:
+                with conn.cursor(row_factory=dict_row) as cursor:
+                    rules = load(cursor)
+                conn.commit()
+            finally:
+                conn.close()
+            _rules = rules
+        except Exception as e:
+            print(f"Ошибка загрузки правил вместимости: {e}")
+            if _rules is None:
+                # Без БД - правила по умолчанию, следующая попытка через интервал
+                _rules = CapacityRules([
+                    {'id': None, 'weekday': weekday, 'rule_date': None, 'slots': 0,
+                     'max_participants': None, 'time_slots': None}
+                    for weekday in DEFAULT_CLOSED_WEEKDAYS
+                ])
+        _loaded_at = time.monotonic()
+        return _rules
+
+
+def invalidate():
+    """Сбрасывает кэш правил (вызывать после commit изменений)"""
+    global _rules
+    with _lock:
+        _rules = None
+
+
+def parse_time_slots(value):
+    """'10:00, 13:30' -> ['10:00', '13:30'] (по возрастанию, без повторов)"""
+    if not value:
+        return []
+    slots = set()
+    for part in re.split(r'[\s,;]+', value.strip()):
+        if not part:
+            continue
+        match = _TIME_RE.match(part)
+        if not match:
+            raise ValueError(f'Некорректное время: {part} (нужно ЧЧ:ММ)')
+        slots.add(f'{int(match.group(1)):02d}:{match.group(2)}')
+    return sorted(slots)
+
+
+def save_rule(cursor, weekday=None, rule_date=None, slots=None, max_participants=None, time_slots=None, note=None):
+    """Добавляет или заменяет правило дня недели или даты"""
+    if (weekday is None) == (rule_date is None):
+        raise ValueError('Укажите день недели или дату')
+    if weekday is not None and not 0 <= weekday <= 6:
+        raise ValueError('День недели - от 0 (понедельник) до 6 (воскресенье)')
+    time_slots = time_slots or []
+    if time_slots:
+        slots = len(time_slots)
+    if slots is None or slots < 0:
+        raise ValueError('Количество групп должно быть неотрицательным числом')
+    if max_participants is not None and max_participants <= 0:
+        raise ValueError('Лимит участников должен быть положительным')
+
+    conflict = '(weekday) WHERE weekday IS NOT NULL' if weekday is not None else '(rule_date) WHERE rule_date IS NOT NULL'
+    cursor.execute(f'''
+        INSERT INTO capacity_rules (weekday, rule_date, slots, max_participants, time_slots, note)
+        VALUES (%s, %s, %s, %s, %s, %s)
+        ON CONFLICT {conflict} DO UPDATE SET
+            slots = EXCLUDED.slots,
+            max_participants = EXCLUDED.max_participants,
+            time_slots = EXCLUDED.time_slots,
+            note = EXCLUDED.note,
+            updated_at = CURRENT_TIMESTAMP
+    ''', (weekday, rule_date, slots, max_participants, time_slots or None, note or None))
+
+
+def delete_rule(cursor, rule_id):
+    cursor.execute('DELETE FROM capacity_rules WHERE id = %s', (rule_id,))
+    return cursor.rowcount
+
+
+def list_rules(cursor):
+    """Правила для админки: сначала дни недели, затем даты"""
+    cursor.execute('''
+        SELECT id, weekday, rule_date, slots, max_participants, time_slots, note
+        FROM capacity_rules
+        ORDER BY rule_date NULLS FIRST, weekday
+    ''')
+    return cursor.fetchall()
+
+
+def day_load(cursor, day):
+    """Активные записи на дату: (групп, участников, занятые времена)"""
+    with cursor.connection.cursor() as plain:
+        plain.execute('''
+            SELECT COUNT(*), COALESCE(SUM(participants_count), 0),
+                   COALESCE(array_agg(time_slot) FILTER (WHERE time_slot IS NOT NULL), '{}')
+            FROM bookings
+            WHERE excursion_date = %s
+              AND status != 'cancelled'
+        ''', (day,))
+        bookings_count, participants, taken = plain.fetchone()
+    return bookings_count, participants, list(taken)
+
+
+def lock_day(cursor, day):
+    """Блокировка дня до конца транзакции: параллельные записи на дату идут по очереди"""
+    cursor.execute('SELECT pg_advisory_xact_lock(%s, %s)', (LOCK_NAMESPACE, day.toordinal()))
+
+
+def lock_days(cursor, days_sql, params=None):
+    """Блокировка набора дней до конца транзакции (те же ключи, что у lock_day).
+
+    days_sql - подзапрос с колонкой day. Дни блокируются по порядку дат,
+    поэтому две такие операции не заблокируют друг друга навсегда.
+    """
+    # date.toordinal(): 0001-01-01 - день 1
+    cursor.execute(f'''
+        SELECT pg_advisory_xact_lock(%s, (day - DATE '0001-01-01') + 1)
+        FROM ({days_sql}) AS days
+        ORDER BY day
+    ''', [LOCK_NAMESPACE, *(params or [])])
@@ -1,32 +1,11 @@
 # database_fix.py - Инструменты для работы с базой данных
-import os
-import urllib.parse
-import psycopg
+from psycopg import sql
+from psycopg.rows import tuple_row
 
-def get_db_connection():
-    """Подключение к PostgreSQL с psycopg3"""
-    database_url = os.environ.get('DATABASE_URL')
-    
-    if database_url:
-        parsed_url = urllib.parse.urlparse(database_url)
-        
-        conn = psycopg.connect(
-            dbname=parsed_url.path[1:],
-            user=parsed_url.username,
-            password=parsed_url.password,
-            host=parsed_url.hostname,
-            port=parsed_url.port,
-            sslmode='require'
-        )
-    else:
-        conn = psycopg.connect(
-            dbname='tax_excursion',
-            user='postgres',
-            password='postgres',
-            host='localhost'
-        )
-    
-    return conn
+import delta_sync
+import schema
+# Соединение из пула воркера - с теми же параметрами (в том числе sslmode), что у приложения
+from db import get_db_connection, run_batch, stream_rows
 
 # СОХРАНИТЬ ЭТУ ФУНКЦИЮ для совместимости с app.py
 def fix_database_operation():
@@ -75,46 +54,34 @@ def reset_database_radical():
             # 2. Создаем таблицу bookings с правильной структурой
             results.append("<br><strong>📊 Шаг 2: Создание новой таблицы bookings...</strong>")
             
-            cursor.execute('''
-                CREATE TABLE bookings (
-                    id SERIAL PRIMARY KEY,
-                    username VARCHAR(100) NOT NULL,
-                    school_name VARCHAR(200) NOT NULL,
-                    class_number VARCHAR(20) NOT NULL,
-                    class_profile VARCHAR(100),
-                    excursion_date DATE NOT NULL,
-                    contact_phone VARCHAR(20) NOT NULL,
-                    participants_count INTEGER NOT NULL,
-                    booking_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    additional_info TEXT,
-                    status VARCHAR(20) DEFAULT 'pending'
-                )
-            ''')
+            schema.create_bookings_table(cursor)
             
             results.append("   ✅ Таблица bookings создана")
             
             # 3. Создаем таблицу blocked_dates
             results.append("<br><strong>📊 Шаг 3: Создание таблицы blocked_dates...</strong>")
             
-            cursor.execute('''
-                CREATE TABLE blocked_dates (
-                    id SERIAL PRIMARY KEY,
-                    blocked_date DATE NOT NULL UNIQUE,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            ''')
+            schema.create_blocked_dates_table(cursor)
             
             results.append("   ✅ Таблица blocked_dates создана")
             
             # 4. Добавляем индекс для ускорения поиска
             results.append("<br><strong>📊 Шаг 4: Создание индексов...</strong>")
             
-            cursor.execute('CREATE INDEX idx_bookings_date ON bookings(excursion_date)')
-            cursor.execute('CREATE INDEX idx_bookings_status ON bookings(status)')
-            cursor.execute('CREATE INDEX idx_bookings_school ON bookings(school_name)')
+            # Независимые запросы - одной пачкой (один сетевой цикл до БД)
+            run_batch(conn, [
+                'CREATE INDEX idx_bookings_date ON bookings(excursion_date)',
+                'CREATE INDEX idx_bookings_status ON bookings(status)',
+                'CREATE INDEX idx_bookings_school ON bookings(school_name)',
+            ])
             
             results.append("   ✅ Индексы созданы")
             
+            # Колонки, индексы и служебные таблицы (см. schema.py)
+            schema.ensure_schema(cursor)
+            # Прежние ID недействительны - клиентам нужна полная выгрузка
+            delta_sync.mark_full_resync(cursor)
+            
             # 5. Тестируем вставку
             results.append("<br><strong>📊 Шаг 5: Тестирование вставки данных...</strong>")
             
@@ -128,54 +95,45 @@ def reset_database_radical():
                  '2024-03-17', '+79995554433', 15, 'pending', 'Третья тестовая запись')
             ]
             
-            for data in test_data:
-                cursor.execute('''
-                    INSERT INTO bookings 
-                    (username, school_name, class_number, class_profile, 
-                     excursion_date, contact_phone, participants_count, status, additional_info)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
-                ''', data)
-            
-            # Тестовая заблокированная дата
-            cursor.execute('INSERT INTO blocked_dates (blocked_date) VALUES (%s)', ('2024-03-18',))
+            insert_booking = '''
+                INSERT INTO bookings 
+                (username, school_name, class_number, class_profile, 
+                 excursion_date, contact_phone, participants_count, status, additional_info)
+                VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s)
+            '''
+            # Тестовые записи и тестовая заблокированная дата
+            run_batch(conn, [(insert_booking, data) for data in test_data] + [
+                ('INSERT INTO blocked_dates (blocked_date) VALUES (%s)', ('2024-03-18',)),
+            ])
             
             results.append("   ✅ Тестовые данные добавлены")
             
             # 6. Проверяем структуру
             results.append("<br><strong>📊 Шаг 6: Проверка структуры базы...</strong>")
             
-            cursor.execute("SELECT COUNT(*) FROM bookings")
-            bookings_count = cursor.fetchone()[0]
-            results.append(f"   📊 Записей в bookings: {bookings_count}")
-            
-            cursor.execute("SELECT COUNT(*) FROM blocked_dates")
-            blocked_count = cursor.fetchone()[0]
-            results.append(f"   📊 Заблокированных дат: {blocked_count}")
-            
-            # Показываем структуру bookings
-            results.append("<br><strong>Структура таблицы bookings:</strong>")
-            cursor.execute("""
+            structure_query = """
                 SELECT column_name, data_type, is_nullable 
                 FROM information_schema.columns 
-                WHERE table_name = 'bookings'
+                WHERE table_name = %s
                 ORDER BY ordinal_position
-            """)
+            """
+            bookings_rows, blocked_rows, bookings_columns, blocked_columns = run_batch(conn, [
+                "SELECT COUNT(*) FROM bookings",
+                "SELECT COUNT(*) FROM blocked_dates",
+                (structure_query, ('bookings',)),
+                (structure_query, ('blocked_dates',)),
+            ])
+            results.append(f"   📊 Записей в bookings: {bookings_rows[0][0]}")
+            results.append(f"   📊 Заблокированных дат: {blocked_rows[0][0]}")
             
-            columns = cursor.fetchall()
-            for col in columns:
+            # Показываем структуру bookings
+            results.append("<br><strong>Структура таблицы bookings:</strong>")
+            for col in bookings_columns:
                 results.append(f"   - {col[0]} ({col[1]}) {'NULL' if col[2] == 'YES' else 'NOT NULL'}")
             
             # Показываем структуру blocked_dates
             results.append("<br><strong>Структура таблицы blocked_dates:</strong>")
-            cursor.execute("""
-                SELECT column_name, data_type, is_nullable 
-                FROM information_schema.columns 
-                WHERE table_name = 'blocked_dates'
-                ORDER BY ordinal_position
-            """)
-            
-            columns = cursor.fetchall()
-            for col in columns:
+            for col in blocked_columns:
                 results.append(f"   - {col[0]} ({col[1]}) {'NULL' if col[2] == 'YES' else 'NOT NULL'}")
             
             # Финализируем
@@ -204,6 +162,38 @@ def reset_database_radical():
         results.append(f"<br><strong style='color: #e74c3c;'>❌ КРИТИЧЕСКАЯ ОШИБКА: {str(e)}</strong>")
         return False, results
 
+# Замены пустых значений в обязательных колонках при восстановлении из бэкапа
+RESTORE_DEFAULTS = {
+    'username': "'Не указано'",
+    'school_name': "'Не указано'",
+    'class_number': "'Не указано'",
+    'contact_phone': "'Не указано'",
+    'participants_count': '0',
+    'booking_date': 'CURRENT_TIMESTAMP',
+    'status': "'pending'",
+    'updated_at': 'CURRENT_TIMESTAMP',
+}
+
+def restore_columns(cursor):
+    """Колонки новой bookings, которые есть и в бэкапе (кроме id - он новый).
+
+    Список строится по information_schema, поэтому переносятся и колонки,
+    добавленные позже (time_slot, idempotency_key, updated_at и т. д.).
+    """
+    cursor.execute("""
+        SELECT target.column_name
+        FROM information_schema.columns AS target
+        JOIN information_schema.columns AS backup
+          ON backup.table_schema = target.table_schema
+         AND backup.table_name = 'temp_backup'
+         AND backup.column_name = target.column_name
+        WHERE target.table_schema = current_schema()
+          AND target.table_name = 'bookings'
+          AND target.column_name <> 'id'
+        ORDER BY target.ordinal_position
+    """)
+    return [row[0] for row in cursor.fetchall()]
+
 def fix_database_soft():
     """Мягкое исправление: сохраняет существующие данные"""
     results = []
@@ -218,18 +208,18 @@ def fix_database_soft():
         # 1. Проверяем текущую структуру
         results.append("<br><strong>📊 Текущая структура таблицы bookings:</strong>")
         try:
-            cursor.execute("""
+            columns = stream_rows(conn, """
                 SELECT column_name, data_type, is_nullable 
                 FROM information_schema.columns 
                 WHERE table_name = 'bookings'
                 ORDER BY ordinal_position
-            """)
+            """, row_factory=tuple_row)
             
-            columns = cursor.fetchall()
-            if columns:
-                for col in columns:
-                    results.append(f"  - {col[0]} ({col[1]}) {'NULL' if col[2] == 'YES' else 'NOT NULL'}")
-            else:
+            found = False
+            for col in columns:
+                found = True
+                results.append(f"  - {col[0]} ({col[1]}) {'NULL' if col[2] == 'YES' else 'NOT NULL'}")
+            if not found:
                 results.append("   ℹ️ Таблица bookings не существует или пуста")
         except:
             results.append("   ℹ️ Не удалось получить структуру таблицы")
@@ -242,45 +232,12 @@ def fix_database_soft():
             results.append("<br><strong>🔧 Сохраняем существующие данные...</strong>")
             
             try:
-                # Создаем временную таблицу для сохранения данных
-                cursor.execute('''
-                    CREATE TABLE IF NOT EXISTS temp_backup (
-                        id SERIAL PRIMARY KEY,
-                        username VARCHAR(100),
-                        school_name VARCHAR(200),
-                        class_number VARCHAR(20),
-                        class_profile VARCHAR(100),
-                        excursion_date DATE,
-                        contact_phone VARCHAR(20),
-                        participants_count INTEGER,
-                        booking_date TIMESTAMP,
-                        additional_info TEXT,
-                        status VARCHAR(20)
-                    )
-                ''')
-                
-                # Копируем данные в бэкап
-                cursor.execute('TRUNCATE TABLE temp_backup')
+                # Бэкап со всеми колонками старой таблицы - что из них перенести,
+                # решается при восстановлении по колонкам новой
+                cursor.execute('DROP TABLE IF EXISTS temp_backup')
                 
                 try:
-                    cursor.execute('''
-                        INSERT INTO temp_backup 
-                        (username, school_name, class_number, class_profile, 
-                         excursion_date, contact_phone, participants_count, 
-                         booking_date, additional_info, status)
-                        SELECT 
-                            username, 
-                            school_name, 
-                            class_number, 
-                            COALESCE(class_profile, '') as class_profile,
-                            excursion_date, 
-                            contact_phone, 
-                            participants_count, 
-                            booking_date, 
-                            COALESCE(additional_info, '') as additional_info,
-                            COALESCE(status, 'pending') as status
-                        FROM bookings
-                    ''')
+                    cursor.execute('CREATE TABLE temp_backup AS SELECT * FROM bookings')
                     
                     backup_count = cursor.rowcount
                     results.append(f"   ✅ Сохранено {backup_count} записей в бэкап")
@@ -299,21 +256,7 @@ def fix_database_soft():
             cursor.execute('DROP TABLE IF EXISTS bookings CASCADE')
             results.append("   ✅ Старая таблица удалена")
             
-            cursor.execute('''
-                CREATE TABLE bookings (
-                    id SERIAL PRIMARY KEY,
-                    username VARCHAR(100) NOT NULL,
-                    school_name VARCHAR(200) NOT NULL,
-                    class_number VARCHAR(20) NOT NULL,
-                    class_profile VARCHAR(100),
-                    excursion_date DATE NOT NULL,
-                    contact_phone VARCHAR(20) NOT NULL,
-                    participants_count INTEGER NOT NULL,
-                    booking_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    additional_info TEXT,
-                    status VARCHAR(20) DEFAULT 'pending'
-                )
-            ''')
+            schema.create_bookings_table(cursor)
             
             results.append("   ✅ Новая таблица создана")
             
@@ -327,24 +270,15 @@ def fix_database_soft():
             results.append("<br><strong>🔧 Восстанавливаем данные из бэкапа...</strong>")
             
             try:
-                cursor.execute('''
-                    INSERT INTO bookings 
-                    (username, school_name, class_number, class_profile, 
-                     excursion_date, contact_phone, participants_count, 
-                     booking_date, additional_info, status)
-                    SELECT 
-                        COALESCE(username, 'Не указано'),
-                        COALESCE(school_name, 'Не указано'),
-                        COALESCE(class_number, 'Не указано'),
-                        class_profile,
-                        excursion_date,
-                        COALESCE(contact_phone, 'Не указано'),
-                        COALESCE(participants_count, 0),
-                        COALESCE(booking_date, CURRENT_TIMESTAMP),
-                        additional_info,
-                        COALESCE(status, 'pending')
-                    FROM temp_backup
-                ''')
+                columns = restore_columns(cursor)
+                cursor.execute(sql.SQL('INSERT INTO bookings ({}) SELECT {} FROM temp_backup').format(
+                    sql.SQL(', ').join(sql.Identifier(column) for column in columns),
+                    sql.SQL(', ').join(
+                        sql.SQL('COALESCE({}, {})').format(sql.Identifier(column), sql.SQL(RESTORE_DEFAULTS[column]))
+                        if column in RESTORE_DEFAULTS else sql.Identifier(column)
+                        for column in columns
+                    ),
+                ))
                 
                 restored_count = cursor.rowcount
                 results.append(f"   ✅ Восстановлено {restored_count} записей")
@@ -370,13 +304,7 @@ def fix_database_soft():
             """)
             
             if not cursor.fetchone()[0]:
-                cursor.execute('''
-                    CREATE TABLE blocked_dates (
-                        id SERIAL PRIMARY KEY,
-                        blocked_date DATE NOT NULL UNIQUE,
-                        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                    )
-                ''')
+                schema.create_blocked_dates_table(cursor)
                 results.append("   ✅ Таблица blocked_dates создана")
             else:
                 results.append("   ✅ Таблица blocked_dates уже существует")
@@ -387,28 +315,34 @@ def fix_database_soft():
         # 7. Создаем индексы
         results.append("<br><strong>🔧 Создаем индексы...</strong>")
         try:
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_bookings_date ON bookings(excursion_date)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_bookings_status ON bookings(status)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_bookings_school ON bookings(school_name)')
+            run_batch(conn, [
+                'CREATE INDEX IF NOT EXISTS idx_bookings_date ON bookings(excursion_date)',
+                'CREATE INDEX IF NOT EXISTS idx_bookings_status ON bookings(status)',
+                'CREATE INDEX IF NOT EXISTS idx_bookings_school ON bookings(school_name)',
+            ])
             results.append("   ✅ Индексы созданы")
+            
+            # Колонки, индексы и служебные таблицы (см. schema.py)
+            schema.ensure_schema(cursor)
+            # Таблица пересоздана с новыми ID - клиентам нужна полная выгрузка
+            delta_sync.mark_full_resync(cursor)
         except Exception as e:
             results.append(f"   ⚠️  Ошибка создания индексов: {str(e)}")
         
         # 8. Финальная проверка
         results.append("<br><strong>📊 Финальная структура базы:</strong>")
         
-        cursor.execute("SELECT COUNT(*) FROM bookings")
-        count = cursor.fetchone()[0]
-        results.append(f"   📊 Всего записей в bookings: {count}")
-        
-        cursor.execute("""
+        count_rows, columns = run_batch(conn, [
+            "SELECT COUNT(*) FROM bookings",
+            """
             SELECT column_name, data_type, is_nullable 
             FROM information_schema.columns 
             WHERE table_name = 'bookings'
             ORDER BY ordinal_position
-        """)
+            """,
+        ])
+        results.append(f"   📊 Всего записей в bookings: {count_rows[0][0]}")
         
-        columns = cursor.fetchall()
         for col in columns:
             results.append(f"   - {col[0]} ({col[1]}) {'NULL' if col[2] == 'YES' else 'NOT NULL'}")
         
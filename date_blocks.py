@@ -0,0 +1,232 @@
+# date_blocks.py - Блокировка и разблокировка дат диапазонами
+#
+# Период (с/по), шаблон дней недели или импортированный список праздников
+# превращаются в набор дней прямо в PostgreSQL (generate_series / unnest)
+# и блокируются одним INSERT ... SELECT ... ON CONFLICT DO NOTHING или
+# разблокируются одним DELETE. Для блокировки сразу возвращается, на какие
+# из дат уже есть активные записи - их нужно перенести или отменить вручную.
+#
+# Дни блокируются под теми же advisory-блокировками дня, что и запись
+# (capacity.lock_day): заявка, проверившая дату, успевает зафиксироваться до
+# блокировки дня, а заявка после блокировки уже видит ее.
+import os
+import re
+from datetime import date, timedelta
+
+import capacity
+
+# Не больше стольких дней за одну операцию
+MAX_RANGE_DAYS = int(os.environ.get('BLOCK_MAX_RANGE_DAYS', 3 * 366))
+
+WEEKDAY_NAMES = ['пн', 'вт', 'ср', 'чт', 'пт', 'сб', 'вс']
+
+_DATE = r'\d{4}-\d{2}-\d{2}|\d{2}\.\d{2}\.\d{4}'
+_RANGE_RE = re.compile(rf'({_DATE})\s*(?:\.\.|-|–|—)\s*({_DATE})')
+_DATE_RE = re.compile(_DATE)
+_ICS_RE = re.compile(r'^(DTSTART|DTEND)[^:]*:(\d{8})', re.IGNORECASE)
+
+
+def parse_date(value):
+    """YYYY-MM-DD или DD.MM.YYYY"""
+    value = str(value).strip()
+    try:
+        if '.' in value:
+            day, month, year = value.split('.')
+            return date(int(year), int(month), int(day))
+        return date.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'Некорректная дата: {value}')
+
+
+def _expand(start, end):
+    if end < start:
+        start, end = end, start
+    if (end - start).days >= MAX_RANGE_DAYS:
+        raise ValueError(f'Слишком длинный период: больше {MAX_RANGE_DAYS} дней')
+    return [start + timedelta(days=i) for i in range((end - start).days + 1)]
+
+
+def parse_holidays(text):
+    """Список дат из импортированного текста.
+
+    Понимает по строке: даты YYYY-MM-DD или DD.MM.YYYY (остальной текст -
+    названия праздников - игнорируется), периоды "01.01.2026 - 08.01.2026"
+    и события iCalendar (DTSTART/DTEND с VALUE=DATE, DTEND не включается).
+    """
+    days = []
+    event_start = None
+    for line in (text or '').splitlines():
+        line = line.split('#', 1)[0].strip()
+        if not line:
+            continue
+
+        ics = _ICS_RE.match(line)
+        if ics:
+            value = date(int(ics.group(2)[:4]), int(ics.group(2)[4:6]), int(ics.group(2)[6:]))
+            if ics.group(1).upper() == 'DTSTART':
+                event_start = value
+                days.append(value)
+            elif event_start is not None and value - event_start > timedelta(days=1):
+                days.extend(_expand(event_start, value - timedelta(days=1))[1:])
+            continue
+        if line.upper() == 'END:VEVENT':
+            event_start = None
+            continue
+
+        for match in _RANGE_RE.finditer(line):
+            days.extend(_expand(parse_date(match.group(1)), parse_date(match.group(2))))
+        line = _RANGE_RE.sub(' ', line)
+        days.extend(parse_date(value) for value in _DATE_RE.findall(line))
+    return days
+
+
+def parse_weekdays(values):
+    """Дни недели: номера 0-6 (0 - понедельник) или сокращения 'Пн'..'Вс'"""
+    if not values:
+        return None
+    if isinstance(values, str):
+        values = re.split(r'[\s,;]+', values.strip())
+    weekdays = set()
+    for value in values:
+        value = str(value).strip().lower()
+        if not value:
+            continue
+        if value in WEEKDAY_NAMES:
+            weekdays.add(WEEKDAY_NAMES.index(value))
+        elif value.isdigit() and 0 <= int(value) <= 6:
+            weekdays.add(int(value))
+        else:
+            raise ValueError(f'Неизвестный день недели: {value}')
+    return sorted(weekdays) or None
+
+
+def parse_spec(data):
+    """Набор дней из запроса админки.
+
+    data: {"date"} (одна дата), {"date_from", "date_to"} (период),
+    {"dates": [...]} и/или {"holidays": "<текст>"} (список); "weekdays"
+    дополнительно оставляет только указанные дни недели.
+    """
+    weekdays = parse_weekdays(data.get('weekdays'))
+
+    dates = [parse_date(value) for value in data.get('dates') or []]
+    dates.extend(parse_holidays(data.get('holidays')))
+    if dates:
+        dates = sorted(set(dates))
+        if len(dates) > MAX_RANGE_DAYS:
+            raise ValueError(f'Слишком много дат: больше {MAX_RANGE_DAYS}')
+        return {'dates': dates, 'start': None, 'end': None, 'weekdays': weekdays}
+
+    start = data.get('date_from') or data.get('date')
+    if not start:
+        raise ValueError('Дата не указана')
+    start = parse_date(start)
+    end = parse_date(data.get('date_to')) if data.get('date_to') else start
+    if end < start:
+        start, end = end, start
+    if (end - start).days >= MAX_RANGE_DAYS:
+        raise ValueError(f'Слишком длинный период: больше {MAX_RANGE_DAYS} дней')
+    return {'dates': None, 'start': start, 'end': end, 'weekdays': weekdays}
+
+
+def _days_sql(spec):
+    """Подзапрос дней (колонка day) и его параметры"""
+    if spec['dates'] is not None:
+        source = 'SELECT DISTINCT unnest(%s::date[]) AS day'
+        params = [spec['dates']]
+    else:
+        source = "SELECT d::date AS day FROM generate_series(%s::date, %s::date, INTERVAL '1 day') AS d"
+        params = [spec['start'], spec['end']]
+    sql = f'''
+        SELECT day FROM ({source}) AS source
+        WHERE %s::int[] IS NULL OR EXTRACT(ISODOW FROM day)::int - 1 = ANY(%s::int[])
+    '''
+    return sql, params + [spec['weekdays'], spec['weekdays']]
+
+
+def block(cursor, spec):
+    """Блокирует дни одним запросом. Возвращает сводку с конфликтами.
+
+    Конфликт - заблокированный день, на который есть активные
+    (не отмененные) записи.
+    """
+    days_sql, params = _days_sql(spec)
+    capacity.lock_days(cursor, days_sql, params)
+    cursor.execute(f'''
+        WITH days AS ({days_sql}),
+        inserted AS (
+            INSERT INTO blocked_dates (blocked_date)
+            SELECT day FROM days
+            ON CONFLICT (blocked_date) DO NOTHING
+            RETURNING blocked_date
+        )
+        SELECT days.day,
+               inserted.blocked_date IS NOT NULL AS changed,
+               active.bookings,
+               active.ids
+        FROM days
+        LEFT JOIN inserted ON inserted.blocked_date = days.day
+        CROSS JOIN LATERAL (
+            SELECT COUNT(*) AS bookings, array_agg(id ORDER BY id) AS ids
+            FROM bookings
+            WHERE excursion_date = days.day
+              AND status != 'cancelled'
+        ) AS active
+        ORDER BY days.day
+    ''', params)
+    rows = cursor.fetchall()
+
+    changed = [row[0] for row in rows if row[1]]
+    conflicts = [
+        {'date': row[0].isoformat(), 'bookings': row[2], 'ids': row[3]}
+        for row in rows if row[2]
+    ]
+    return {
+        'requested': len(rows),
+        'changed': len(changed),
+        'unchanged': len(rows) - len(changed),
+        'dates': [day.isoformat() for day in changed],
+        'conflicts': conflicts,
+    }
+
+
+def unblock(cursor, spec):
+    """Разблокирует дни одним DELETE. Возвращает сводку"""
+    days_sql, params = _days_sql(spec)
+    capacity.lock_days(cursor, days_sql, params)
+    cursor.execute(f'''
+        WITH days AS ({days_sql}),
+        deleted AS (
+            DELETE FROM blocked_dates
+            WHERE blocked_date IN (SELECT day FROM days)
+            RETURNING blocked_date
+        )
+        SELECT (SELECT COUNT(*) FROM days),
+               ARRAY(SELECT blocked_date FROM deleted ORDER BY blocked_date)
+    ''', params)
+    requested, changed = cursor.fetchone()
+    return {
+        'requested': requested,
+        'changed': len(changed),
+        'unchanged': requested - len(changed),
+        'dates': [day.isoformat() for day in changed],
+        'conflicts': [],
+    }
+
+
+def summary_message(summary, blocked):
+    """Текст для администратора"""
+    verb = 'Заблокировано' if blocked else 'Разблокировано'
+    already = 'уже были заблокированы' if blocked else 'не были заблокированы'
+    message = f"{verb} дат: {summary['changed']}"
+    if summary['unchanged']:
+        message += f" ({already}: {summary['unchanged']})"
+    if summary['conflicts']:
+        listed = ', '.join(
+            f"{parse_date(c['date']).strftime('%d.%m.%Y')} ({c['bookings']})"
+            for c in summary['conflicts'][:10]
+        )
+        if len(summary['conflicts']) > 10:
+            listed += ', ...'
+        message += f". Есть активные записи на {len(summary['conflicts'])} датах: {listed}"
+    return message
@@ -0,0 +1,388 @@
+# db.py - Подключение к PostgreSQL и пул соединений воркера
+import os
+import urllib.parse
+import threading
+import time
+import itertools
+import psycopg
+from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool
+
+# Размеры пула на один воркер (переопределяются переменными окружения)
+DB_POOL_MIN_SIZE = int(os.environ.get('DB_POOL_MIN_SIZE', 1))
+DB_POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', 5))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 10))
+# Сколько строк серверный курсор забирает за один FETCH
+DB_ITERSIZE = int(os.environ.get('DB_ITERSIZE', 2000))
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+_cursor_ids = itertools.count(1)
+
+# Подписчики на выполненные запросы: fn(query, params, duration)
+_query_listeners = []
+
+
+def add_query_listener(listener):
+    """Регистрирует функцию, которая вызывается после каждого запроса к БД"""
+    if listener not in _query_listeners:
+        _query_listeners.append(listener)
+
+
+def _notify_query(query, params, duration):
+    for listener in _query_listeners:
+        try:
+            listener(query, params, duration)
+        except Exception as e:
+            print(f"Ошибка обработчика запроса: {e}")
+
+
+class BatchQuery(str):
+    """Текст пачки запросов run_batch для подписчиков: один замер на всю пачку.
+
+    statements - сколько запросов в пачке. Строка начинается с комментария,
+    поэтому журнал медленных запросов ее не объясняет (EXPLAIN не для пачки).
+    """
+
+    def __new__(cls, queries):
+        queries = [query if isinstance(query, str) else repr(query) for query in queries]
+        text = super().__new__(cls, f'/* pipeline: {len(queries)} */ ' + ';\n'.join(queries))
+        text.statements = len(queries)
+        return text
+
+
+class TimedCursor(psycopg.Cursor):
+    """Курсор, замеряющий длительность каждого execute()"""
+
+    def execute(self, query, params=None, **kwargs):
+        if not _query_listeners:
+            return super().execute(query, params, **kwargs)
+
+        start = time.perf_counter()
+        try:
+            return super().execute(query, params, **kwargs)
+        finally:
+            _notify_query(query, params, time.perf_counter() - start)
+
+    def executemany(self, query, params_seq, **kwargs):
+        if not _query_listeners:
+            return super().executemany(query, params_seq, **kwargs)
+
+        start = time.perf_counter()
+        try:
+            return super().executemany(query, params_seq, **kwargs)
+        finally:
+            _notify_query(query, None, time.perf_counter() - start)
+
+
+class TimedServerCursor(psycopg.ServerCursor):
+    """Серверный (именованный) курсор, замеряющий весь запрос.
+
+    execute() только объявляет курсор (DECLARE), основная работа - в FETCH
+    при чтении строк. Время DECLARE и всех FETCH суммируется и сообщается
+    подписчикам одним запросом при закрытии курсора. Время, которое
+    вызывающий код тратит между порциями, в замер не входит.
+    """
+
+    _timed_query = None
+    _timed_params = None
+    _timed_elapsed = 0.0
+
+    def _timed(self, method, *args):
+        if not _query_listeners:
+            return method(*args)
+        start = time.perf_counter()
+        try:
+            return method(*args)
+        finally:
+            self._timed_elapsed += time.perf_counter() - start
+
+    def execute(self, query, params=None, **kwargs):
+        self._timed_query, self._timed_params = query, params
+        return self._timed(lambda: super(TimedServerCursor, self).execute(query, params, **kwargs))
+
+    def fetchone(self):
+        return self._timed(super().fetchone)
+
+    def fetchmany(self, size=0):
+        return self._timed(super().fetchmany, size)
+
+    def fetchall(self):
+        return self._timed(super().fetchall)
+
+    def __iter__(self):
+        # Как ServerCursor.__iter__ (FETCH по itersize), но через замеряемый fetchmany
+        while True:
+            rows = self.fetchmany(self.itersize)
+            yield from rows
+            if len(rows) < self.itersize:
+                break
+
+    def close(self):
+        query, self._timed_query = self._timed_query, None
+        try:
+            super().close()
+        finally:
+            if query is not None and _query_listeners:
+                _notify_query(query, self._timed_params, self._timed_elapsed)
+
+
+def stream_rows(conn, query, params=None, row_factory=dict_row, itersize=None):
+    """Построчно отдает результат запроса через серверный курсор.
+
+    Строки забираются с сервера порциями по itersize (DB_ITERSIZE), поэтому
+    память не растет вместе с таблицей. Курсор живет внутри транзакции conn
+    и закрывается, когда генератор дочитан или закрыт.
+    """
+    name = f'stream_{os.getpid()}_{next(_cursor_ids)}'
+    with TimedServerCursor(conn, name, row_factory=row_factory) as cursor:
+        cursor.itersize = itersize or DB_ITERSIZE
+        cursor.execute(query, params)
+        yield from cursor
+
+
+def stream_batches(conn, query, params=None, row_factory=dict_row, size=None):
+    """Как stream_rows, но отдает списки по size строк (fetchmany).
+
+    Для выгрузок, где сервер уже сформировал готовые значения: порцию можно
+    передать дальше целиком (например, ''.join), не перебирая строки в Python.
+    """
+    size = size or DB_ITERSIZE
+    name = f'stream_{os.getpid()}_{next(_cursor_ids)}'
+    with TimedServerCursor(conn, name, row_factory=row_factory) as cursor:
+        cursor.itersize = size
+        cursor.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(size)
+            if not rows:
+                break
+            yield rows
+
+
+def copy_out(conn, query, params=None, options='FORMAT csv'):
+    """Результат запроса через COPY (query) TO STDOUT WITH (options).
+
+    Строки формирует PostgreSQL (например, готовый CSV), генератор отдает
+    блоки данных в том виде, в каком они пришли с сервера - по блоку на
+    строку результата. Блок - memoryview буфера libpq, он действителен до
+    следующего шага генератора: его нужно сразу записать или скопировать.
+
+    COPY идет мимо TimedCursor.execute(), поэтому замеряется здесь: одним
+    запросом от начала до конца потока (или до закрытия генератора).
+    """
+    statement = f'COPY ({query}) TO STDOUT WITH ({options})'
+    start = time.perf_counter()
+    try:
+        with conn.cursor() as cursor:
+            with cursor.copy(statement, params) as copy:
+                yield from copy
+    finally:
+        if _query_listeners:
+            _notify_query(statement, params, time.perf_counter() - start)
+
+
+def run_batch(conn, statements, row_factory=None):
+    """Выполняет независимые запросы в pipeline-режиме psycopg.
+
+    Все запросы уходят на сервер подряд, не дожидаясь ответов, поэтому пачка
+    стоит примерно одного сетевого цикла до PostgreSQL, а не по циклу на
+    запрос. statements - строки или пары (query, params); запросы не должны
+    зависеть от результатов друг друга. Возвращает список в том же порядке:
+    строки для запросов с результатом, rowcount для остальных. Ошибка любого
+    запроса поднимается после отправки всей пачки, транзакция conn при этом
+    прерывается, как и при обычном execute().
+    """
+    statements = [(item, None) if isinstance(item, str) else item for item in statements]
+    kwargs = {'row_factory': row_factory} if row_factory is not None else {}
+    cursors = []
+
+    if psycopg.Pipeline.is_supported():
+        # В pipeline execute() возвращается до ответа сервера - замер по
+        # запросам дал бы ~0 мс. Замеряется вся пачка: от отправки первого
+        # запроса до синхронизации при выходе из блока, когда ответы получены
+        start = time.perf_counter()
+        try:
+            with conn.pipeline():
+                for query, params in statements:
+                    cursor = psycopg.Cursor(conn, **kwargs)
+                    cursor.execute(query, params)
+                    cursors.append(cursor)
+        finally:
+            if _query_listeners:
+                _notify_query(BatchQuery([query for query, _ in statements]), None,
+                              time.perf_counter() - start)
+    else:
+        # libpq старше 14 pipeline не умеет - те же запросы по одному
+        for query, params in statements:
+            cursor = conn.cursor(**kwargs)
+            cursor.execute(query, params)
+            cursors.append(cursor)
+
+    results = []
+    for cursor in cursors:
+        results.append(cursor.fetchall() if cursor.description is not None else cursor.rowcount)
+        cursor.close()
+    return results
+
+
+class StreamedRows:
+    """Результат запроса, который можно обходить несколько раз без fetchall().
+
+    Каждый обход открывает новый серверный курсор. Проверка на пустоту
+    (if rows) читает первую строку, и первый обход продолжает тот же курсор -
+    так ошибки SQL всплывают до начала потоковой отдачи ответа.
+    """
+
+    def __init__(self, conn, query, params=None, row_factory=dict_row, itersize=None):
+        self.conn = conn
+        self.query = query
+        self.params = params
+        self.row_factory = row_factory
+        self.itersize = itersize
+        self._pending = None
+
+    def _open(self):
+        return stream_rows(self.conn, self.query, self.params, self.row_factory, self.itersize)
+
+    def __iter__(self):
+        if self._pending is not None:
+            first, rows = self._pending
+            self._pending = None
+            yield first
+            yield from rows
+            return
+        yield from self._open()
+
+    def __bool__(self):
+        if self._pending is None:
+            rows = self._open()
+            try:
+                first = next(rows)
+            except StopIteration:
+                return False
+            self._pending = (first, rows)
+        return True
+
+
+class PooledConnection(psycopg.Connection):
+    """Соединение, которое при close() возвращается в пул, а не закрывается.
+
+    Благодаря этому старый код вида conn = get_db_connection() ... conn.close()
+    продолжает работать без изменений, но переиспользует соединения.
+    """
+
+    def close(self):
+        pool = getattr(self, '_pool', None)
+        if pool is not None and not self.closed:
+            self._lease = None
+            # Маршруты, которые только читают (или упали на запросе), не делают
+            # commit - откатываем транзакцию сами, чтобы пул не ругался предупреждениями
+            if self.info.transaction_status in (psycopg.pq.TransactionStatus.INTRANS,
+                                                psycopg.pq.TransactionStatus.INERROR):
+                try:
+                    self.rollback()
+                except psycopg.Error:
+                    pass
+            pool.putconn(self)
+        else:
+            super().close()
+
+
+def get_conninfo():
+    """Параметры подключения из DATABASE_URL или локальные по умолчанию"""
+    database_url = os.environ.get('DATABASE_URL')
+
+    if database_url:
+        parsed_url = urllib.parse.urlparse(database_url)
+        return psycopg.conninfo.make_conninfo(
+            dbname=parsed_url.path[1:],
+            user=parsed_url.username,
+            password=parsed_url.password,
+            host=parsed_url.hostname,
+            port=parsed_url.port,
+            # Для локальной БД (бенчмарки) можно задать DATABASE_SSLMODE=disable
+            sslmode=os.environ.get('DATABASE_SSLMODE', 'require')
+        )
+
+    return psycopg.conninfo.make_conninfo(
+        dbname='tax_excursion',
+        user='postgres',
+        password='postgres',
+        host='localhost'
+    )
+
+
+def open_pool():
+    """Открывает пул соединений текущего процесса (вызывается в post_fork)"""
+    global _pool, _pool_pid
+
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            return _pool
+
+        # Пул, унаследованный от мастера после fork, не закрываем:
+        # его сокеты принадлежат родительскому процессу
+        _pool = ConnectionPool(
+            get_conninfo(),
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            timeout=DB_POOL_TIMEOUT,
+            connection_class=PooledConnection,
+            kwargs={'cursor_factory': TimedCursor},
+            name=f'worker-{os.getpid()}',
+            open=True,
+        )
+        _pool_pid = os.getpid()
+        return _pool
+
+
+def close_pool():
+    """Закрывает пул соединений текущего процесса (вызывается в worker_exit)"""
+    global _pool, _pool_pid
+
+    with _pool_lock:
+        if _pool is not None and _pool_pid == os.getpid():
+            _pool.close()
+        _pool = None
+        _pool_pid = None
+
+
+def get_pool():
+    """Возвращает пул текущего процесса, открывая его при первом обращении"""
+    if _pool is not None and _pool_pid == os.getpid():
+        return _pool
+    return open_pool()
+
+
+def get_db_connection():
+    """Подключение к PostgreSQL с psycopg3 из пула воркера"""
+    pool = get_pool()
+    while True:
+        conn = pool.getconn()
+        if not conn.closed:
+            # Метка выдачи: по ней app.py отличает свою аренду от чужой
+            conn._lease = object()
+            return conn
+        # Соединение закрыли в обход пула (повторный close) - пул заменит его
+        pool.putconn(conn)
+
+
+def pool_metrics():
+    """Заполненность пула для /metrics: [(name, labels, value), ...]"""
+    stats = pool_stats()
+    if not stats:
+        return []
+    return [
+        ('db_pool_connections', {'state': 'size'}, stats.get('pool_size', 0)),
+        ('db_pool_connections', {'state': 'available'}, stats.get('pool_available', 0)),
+        ('db_pool_connections', {'state': 'waiting'}, stats.get('requests_waiting', 0)),
+        ('db_pool_connections', {'state': 'max'}, stats.get('pool_max', 0)),
+    ]
+
+
+def pool_stats():
+    """Статистика пула без обращения к БД"""
+    if _pool is None or _pool_pid != os.getpid():
+        return {}
+    return _pool.get_stats()
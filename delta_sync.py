@@ -0,0 +1,137 @@
+# delta_sync.py - Инкрементальная выгрузка: что изменилось с прошлой синхронизации
+#
+# Каждая запись bookings хранит updated_at (обновляется во всех UPDATE), а
+# удаленные ID попадают в журнал deleted_bookings. Выгрузка с параметром
+# since отдает только записи, измененные после since, и ID удаленных.
+#
+# Запись журнала с booking_id = 0 - метка "удалено все" (очистка, пересоздание
+# или исправление таблицы, после которого ID меняются). Если метка новее since,
+# клиенту отдается полная выгрузка.
+import os
+from datetime import datetime, date
+
+# Запас по времени: транзакция, начатая до выгрузки, может закоммититься после
+# нее со старым updated_at. Такие записи попадут в следующую выгрузку повторно,
+# но не потеряются (повтор безопасен - это та же запись с тем же ID)
+DELTA_OVERLAP_SECONDS = int(os.environ.get('DELTA_OVERLAP_SECONDS', 300))
+# Сколько дней хранить журнал удалений; более старый since - полная выгрузка
+DELTA_TOMBSTONE_DAYS = int(os.environ.get('DELTA_TOMBSTONE_DAYS', 90))
+
+# ID метки "удалено все" в журнале удалений (SERIAL начинается с 1)
+FULL_RESYNC_ID = 0
+
+
+def ensure_schema(cursor):
+    """Колонка updated_at, индекс по ней и журнал удалений (идемпотентно)"""
+    cursor.execute('''
+        ALTER TABLE bookings
+        ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_bookings_updated_at ON bookings(updated_at)')
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS deleted_bookings (
+            booking_id INTEGER PRIMARY KEY,
+            deleted_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_deleted_bookings_at ON deleted_bookings(deleted_at)')
+
+
+def delete_bookings(cursor, ids, returning='id'):
+    """Удаляет записи и заносит их ID в журнал удалений.
+
+    Возвращает удаленные строки с колонками returning (должны включать id).
+    """
+    cursor.execute(f'''
+        WITH deleted AS (
+            DELETE FROM bookings WHERE id = ANY(%s) RETURNING {returning}
+        ), logged AS (
+            INSERT INTO deleted_bookings (booking_id)
+            SELECT id FROM deleted
+            ON CONFLICT (booking_id) DO UPDATE SET deleted_at = EXCLUDED.deleted_at
+        )
+        SELECT * FROM deleted
+    ''', ([int(i) for i in ids],))
+    return cursor.fetchall()
+
+
+def mark_full_resync(cursor):
+    """Метка "удалено все": прежние ID недействительны, нужна полная выгрузка"""
+    cursor.execute('''
+        INSERT INTO deleted_bookings (booking_id) VALUES (%s)
+        ON CONFLICT (booking_id) DO UPDATE SET deleted_at = EXCLUDED.deleted_at
+    ''', (FULL_RESYNC_ID,))
+
+
+def parse_since(value):
+    """since из запроса: ISO-дата/время или токен прошлой выгрузки (тот же формат)"""
+    if not value:
+        return None
+    value = value.strip()
+    try:
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        parsed = datetime.combine(date.fromisoformat(value), datetime.min.time())
+    if parsed.tzinfo is not None:
+        # updated_at хранится без часового пояса, в часовом поясе сервера БД
+        raise ValueError('since указывается без часового пояса')
+    return parsed
+
+
+def format_watermark(value):
+    """Токен для следующей выгрузки"""
+    return value.isoformat(timespec='microseconds')
+
+
+def prepare(cursor, since):
+    """Начинает выгрузку: возвращает (watermark, full).
+
+    watermark - токен для следующей синхронизации, full - нужна ли полная
+    выгрузка (since не задан, старше журнала удалений или раньше метки
+    "удалено все"). Заодно чистит журнал от записей старше DELTA_TOMBSTONE_DAYS.
+    """
+    cursor.execute('''
+        DELETE FROM deleted_bookings
+        WHERE deleted_at < LOCALTIMESTAMP - make_interval(days => %s)
+          AND booking_id <> %s
+    ''', (DELTA_TOMBSTONE_DAYS, FULL_RESYNC_ID))
+
+    cursor.execute('''
+        SELECT LOCALTIMESTAMP - make_interval(secs => %s),
+               LOCALTIMESTAMP - make_interval(days => %s),
+               (SELECT deleted_at FROM deleted_bookings WHERE booking_id = %s)
+    ''', (DELTA_OVERLAP_SECONDS, DELTA_TOMBSTONE_DAYS, FULL_RESYNC_ID))
+    watermark, horizon, resync_at = cursor.fetchone()
+
+    full = since is None or since < horizon or (resync_at is not None and since <= resync_at)
+    return watermark, full
+
+
+def changes_query(columns, since, full):
+    """Запрос изменений: (change, <columns>...) для bookings и удаленных ID.
+
+    columns - список выражений SELECT по bookings; первым должен идти id.
+    Для удаленных записей все колонки, кроме id, равны NULL.
+    """
+    select_list = ',\n               '.join(columns)
+    if full:
+        return f'''
+            SELECT 'upsert' AS change,
+                   {select_list}
+            FROM bookings
+            ORDER BY id
+        ''', []
+
+    # Имена колонок UNION берутся из первой части, во второй достаточно NULL
+    nulls = ', '.join(['NULL'] * (len(columns) - 1))
+    return f'''
+        SELECT 'upsert' AS change,
+               {select_list}
+        FROM bookings
+        WHERE updated_at >= %s
+        UNION ALL
+        SELECT 'delete' AS change, deleted.booking_id, {nulls}
+        FROM deleted_bookings AS deleted
+        WHERE deleted.deleted_at >= %s AND deleted.booking_id <> %s
+        ORDER BY id
+    ''', [since, since, FULL_RESYNC_ID]
@@ -0,0 +1,216 @@
+# export_cache.py - Готовые файлы выгрузок на локальном диске
+#
+# Полную выгрузку скачивают по нескольку раз в день, и каждый раз таблица
+# заново читалась и сериализовалась. Теперь файл выгрузки сохраняется в
+# EXPORT_CACHE_DIR с ключом (формат, фильтры, версия данных) и отдается
+# повторно, пока bookings не изменится.
+#
+# Версия данных - счетчик в bookings_version, который увеличивает триггер
+# на каждый INSERT/UPDATE/DELETE/TRUNCATE в bookings. Счетчик меняется в той
+# же транзакции, что и данные, поэтому версия и строки выгрузки читаются из
+# одного снимка (REPEATABLE READ): файл с версией N содержит ровно данные
+# версии N, даже если запись идет параллельно.
+#
+# Старые файлы удаляются по возрасту (EXPORT_CACHE_MAX_AGE_SECONDS) и по
+# суммарному размеру (EXPORT_CACHE_MAX_MB, сначала давно не скачанные).
+import os
+import time
+import json
+import fcntl
+import hashlib
+import tempfile
+import threading
+
+import metrics
+
+EXPORT_CACHE_DIR = os.environ.get('EXPORT_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'tax_excursion_exports'))
+EXPORT_CACHE_MAX_MB = int(os.environ.get('EXPORT_CACHE_MAX_MB', 256))
+EXPORT_CACHE_MAX_AGE_SECONDS = int(os.environ.get('EXPORT_CACHE_MAX_AGE_SECONDS', 24 * 3600))
+# Пространство ключей pg_advisory_xact_lock для создания триггера
+LOCK_NAMESPACE = 3802
+
+LOCK_FILE = '.lock'
+
+_thread_lock = threading.Lock()
+
+
+def ensure_schema(cursor):
+    """Счетчик версии bookings и триггер, который его увеличивает (идемпотентно).
+
+    Триггер создается, только если его нет: новый или пересозданный bookings.
+    Тогда же версия увеличивается - файлы, собранные по прежней таблице,
+    больше не подходят.
+    """
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS bookings_version (
+            id BOOLEAN PRIMARY KEY DEFAULT TRUE CHECK (id),
+            version BIGINT NOT NULL DEFAULT 0
+        )
+    ''')
+    cursor.execute('''
+        SELECT 1 FROM pg_trigger
+        WHERE tgrelid = 'bookings'::regclass AND tgname = 'trg_bookings_version'
+    ''')
+    if cursor.fetchone():
+        return
+
+    # Воркеры инициализируют базу одновременно - создает один
+    cursor.execute('SELECT pg_advisory_xact_lock(%s, 0)', (LOCK_NAMESPACE,))
+    cursor.execute('''
+        SELECT 1 FROM pg_trigger
+        WHERE tgrelid = 'bookings'::regclass AND tgname = 'trg_bookings_version'
+    ''')
+    if cursor.fetchone():
+        return
+
+    cursor.execute('''
+        CREATE OR REPLACE FUNCTION bump_bookings_version() RETURNS trigger AS $$
+        BEGIN
+            UPDATE bookings_version SET version = version + 1;
+            RETURN NULL;
+        END
+        $$ LANGUAGE plpgsql
+    ''')
+    cursor.execute('''
+        CREATE TRIGGER trg_bookings_version
+        AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON bookings
+        FOR EACH STATEMENT EXECUTE FUNCTION bump_bookings_version()
+    ''')
+    cursor.execute('''
+        INSERT INTO bookings_version (id, version) VALUES (TRUE, 1)
+        ON CONFLICT (id) DO UPDATE SET version = bookings_version.version + 1
+    ''')
+
+
+def data_version(cursor):
+    """Текущая версия данных bookings"""
+    cursor.execute('SELECT version FROM bookings_version')
+    row = cursor.fetchone()
+    return row[0] if row else 0
+
+
+def cache_key(export_format, filters=None):
+    """Имя файла без версии и расширения: формат и хэш фильтров"""
+    digest = hashlib.sha1(json.dumps(filters or {}, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    return f'{export_format}_{digest}'
+
+
+class _DirLock:
+    """Блокировка каталога кэша: между потоками процесса и между процессами"""
+
+    def __enter__(self):
+        _thread_lock.acquire()
+        try:
+            self.file = open(os.path.join(EXPORT_CACHE_DIR, LOCK_FILE), 'a')
+            fcntl.flock(self.file, fcntl.LOCK_EX)
+        except Exception:
+            _thread_lock.release()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        try:
+            fcntl.flock(self.file, fcntl.LOCK_UN)
+            self.file.close()
+        finally:
+            _thread_lock.release()
+
+
+def get_or_build(conn, export_format, filters, extension, build):
+    """Путь к файлу выгрузки актуальной версии; при промахе файл собирается.
+
+    conn - свободное соединение (без открытой транзакции), build(conn) -
+    генератор порций байтов выгрузки. Версия и строки читаются в одной
+    транзакции REPEATABLE READ; она завершается до возврата, так что
+    соединение можно сразу вернуть в пул, а файл отдавать сколько угодно долго.
+    """
+    os.makedirs(EXPORT_CACHE_DIR, exist_ok=True)
+    key = cache_key(export_format, filters)
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ, READ ONLY')
+            version = data_version(cursor)
+        path = os.path.join(EXPORT_CACHE_DIR, f'{key}_{version}.{extension}')
+
+        if _touch(path):
+            metrics.inc('cache_requests_total', cache='export', result='hit', format=export_format)
+            return path
+
+        with _DirLock():
+            # Пока ждали блокировку, этот же файл мог собрать другой воркер
+            if _touch(path):
+                metrics.inc('cache_requests_total', cache='export', result='hit', format=export_format)
+                return path
+            metrics.inc('cache_requests_total', cache='export', result='miss', format=export_format)
+
+            tmp_path = f'{path}.{os.getpid()}.tmp'
+            try:
+                with open(tmp_path, 'wb') as f:
+                    for chunk in build(conn):
+                        f.write(chunk)
+                os.replace(tmp_path, path)
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+            # Файлы прежних версий того же ключа больше не понадобятся
+            for name in os.listdir(EXPORT_CACHE_DIR):
+                if name.startswith(f'{key}_') and os.path.join(EXPORT_CACHE_DIR, name) != path:
+                    _remove(name)
+            evict(keep=path)
+        return path
+    finally:
+        conn.rollback()
+
+
+def _touch(path):
+    """Отмечает обращение к файлу (atime - для вытеснения); False, если файла нет"""
+    try:
+        os.utime(path, (time.time(), os.stat(path).st_mtime))
+        return True
+    except FileNotFoundError:
+        return False
+
+
+def _remove(name):
+    try:
+        os.remove(os.path.join(EXPORT_CACHE_DIR, name))
+    except FileNotFoundError:
+        pass
+
+
+def cleanup():
+    """Удаляет устаревшие файлы (периодическая задача планировщика)"""
+    if not os.path.isdir(EXPORT_CACHE_DIR):
+        return
+    with _DirLock():
+        evict()
+
+
+def evict(keep=None):
+    """Удаляет файлы старше EXPORT_CACHE_MAX_AGE_SECONDS и давно не скачанные
+    сверх EXPORT_CACHE_MAX_MB (вызывать под блокировкой каталога)"""
+    now = time.time()
+    entries = []
+    for name in os.listdir(EXPORT_CACHE_DIR):
+        if name == LOCK_FILE:
+            continue
+        path = os.path.join(EXPORT_CACHE_DIR, name)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        if path != keep and now - stat.st_mtime > EXPORT_CACHE_MAX_AGE_SECONDS:
+            _remove(name)
+        elif not name.endswith('.tmp'):
+            entries.append((stat.st_atime, stat.st_size, name, path))
+
+    total = sum(size for _, size, _, _ in entries)
+    limit = EXPORT_CACHE_MAX_MB * 1024 * 1024
+    for _, size, name, path in sorted(entries):
+        if total <= limit:
+            break
+        if path != keep:
+            _remove(name)
+            total -= size
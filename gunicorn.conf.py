@@ -0,0 +1,107 @@
+# gunicorn.conf.py - Конфигурация gunicorn для Render
+# Все параметры можно переопределить переменными окружения.
+import os
+import multiprocessing
+
+
+def _env_int(name, default):
+    value = os.environ.get(name)
+    return int(value) if value else default
+
+
+def _env_bool(name, default):
+    value = os.environ.get(name)
+    if value is None or value == '':
+        return default
+    return value.lower() in ('1', 'true', 'yes', 'on')
+
+
+def _memory_limit_bytes():
+    """Лимит памяти контейнера (cgroup v2/v1) или объем физической памяти"""
+    for path in ('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory/memory.limit_in_bytes'):
+        try:
+            with open(path) as f:
+                value = f.read().strip()
+            if value.isdigit() and int(value) < 1 << 60:
+                return int(value)
+        except OSError:
+            pass
+
+    try:
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def _default_workers():
+    """2 * CPU + 1, но не больше, чем помещается в память"""
+    by_cpu = multiprocessing.cpu_count() * 2 + 1
+
+    memory = _memory_limit_bytes()
+    worker_memory = _env_int('GUNICORN_WORKER_MEMORY_MB', 128) * 1024 * 1024
+    if memory:
+        by_memory = max(1, memory // worker_memory)
+        return max(1, min(by_cpu, by_memory))
+
+    return by_cpu
+
+
+# Сеть
+bind = os.environ.get('GUNICORN_BIND', f"0.0.0.0:{os.environ.get('PORT', '5000')}")
+
+# Воркеры и потоки (WEB_CONCURRENCY - стандартная переменная Render/Heroku)
+workers = _env_int('WEB_CONCURRENCY', _default_workers())
+threads = _env_int('GUNICORN_THREADS', 4)
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread' if threads > 1 else 'sync')
+
+# Загружаем приложение в мастере до fork - воркеры стартуют быстрее
+preload_app = _env_bool('GUNICORN_PRELOAD', True)
+
+# Таймауты
+timeout = _env_int('GUNICORN_TIMEOUT', 60)
+graceful_timeout = _env_int('GUNICORN_GRACEFUL_TIMEOUT', 30)
+keepalive = _env_int('GUNICORN_KEEPALIVE', 5)
+
+# Перезапуск воркеров против утечек памяти
+max_requests = _env_int('GUNICORN_MAX_REQUESTS', 1000)
+max_requests_jitter = _env_int('GUNICORN_MAX_REQUESTS_JITTER', 100)
+
+# Логи в stdout/stderr (их собирает Render)
+accesslog = os.environ.get('GUNICORN_ACCESSLOG', '-') or None
+errorlog = os.environ.get('GUNICORN_ERRORLOG', '-')
+loglevel = os.environ.get('GUNICORN_LOGLEVEL', 'info')
+
+
+def on_starting(server):
+    """Мастер запускается: очищаем снимки метрик, строим общую таблицу занятости"""
+    import metrics
+    metrics.reset_dir()
+
+    # Общая таблица занятости создается до fork, чтобы воркеры ее унаследовали
+    import psycopg
+    import db
+    import shared_availability
+    shared_availability.create()
+    try:
+        with psycopg.connect(db.get_conninfo()) as conn:
+            days = shared_availability.rebuild(conn)
+        server.log.info("Таблица занятости построена: %s дней", days)
+    except Exception as e:
+        server.log.warning("Таблица занятости не построена (воркеры построят ее сами): %s", e)
+
+
+def when_ready(server):
+    """Мастер готов принимать соединения"""
+    server.log.info("Gunicorn: %s воркеров x %s потоков (%s)", workers, threads, worker_class)
+
+
+def post_fork(server, worker):
+    """Инициализация ресурсов конкретного воркера (пул соединений и т.п.)"""
+    from app import init_worker
+    init_worker()
+
+
+def worker_exit(server, worker):
+    """Корректное закрытие ресурсов воркера"""
+    from app import shutdown_worker
+    shutdown_worker()
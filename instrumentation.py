@@ -0,0 +1,115 @@
+# instrumentation.py - Замеры времени запросов: БД, шаблоны, Server-Timing
+import os
+import time
+from flask import g, request, has_app_context, before_render_template, template_rendered
+
+import db
+import metrics
+
+# Включение/отключение через переменные окружения
+SERVER_TIMING_ENABLED = os.environ.get('SERVER_TIMING', 'true').lower() == 'true'
+SLOW_REQUEST_MS = float(os.environ.get('SLOW_REQUEST_MS', 1000))
+
+
+def _on_query(query, params, duration):
+    """Учитывает запрос к БД в рамках текущего HTTP-запроса"""
+    if not has_app_context():
+        return
+    timing = g.get('timing')
+    if timing is not None:
+        timing['db'] += duration
+        # Пачка run_batch приходит одним замером, но это несколько запросов
+        timing['queries'] += getattr(query, 'statements', 1)
+
+
+def _on_before_render(sender, template, context, **extra):
+    timing = g.get('timing')
+    if timing is not None:
+        timing['render_started'] = time.perf_counter()
+
+
+def _on_rendered(sender, template, context, **extra):
+    timing = g.get('timing')
+    if timing is not None and timing['render_started'] is not None:
+        timing['render'] += time.perf_counter() - timing['render_started']
+        timing['render_started'] = None
+
+
+def _before_request():
+    g.timing = {
+        'start': time.perf_counter(),
+        'db': 0.0,
+        'queries': 0,
+        'render': 0.0,
+        'render_started': None,
+    }
+
+
+def _after_request(response):
+    timing = g.get('timing')
+    if timing is None:
+        return response
+
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    method = request.method
+    # Тот же список, куда app.get_db_connection добавляет аренды (и во время
+    # отдачи потокового тела); teardown убирает его из g, но не очищает
+    leases = g.setdefault('db_leases', [])
+
+    if SERVER_TIMING_ENABLED:
+        # У потоковых ответов (stream_template, Response(генератор), send_file)
+        # заголовок уходит до тела: в нем только время до первого байта
+        total_ms = (time.perf_counter() - timing['start']) * 1000
+        db_ms = timing['db'] * 1000
+        render_ms = timing['render'] * 1000
+        app_ms = max(0.0, total_ms - db_ms - render_ms)
+        response.headers['Server-Timing'] = (
+            f'db;dur={db_ms:.1f};desc="{timing["queries"]} queries, {len(leases)} conn", '
+            f'render;dur={render_ms:.1f}, '
+            f'app;dur={app_ms:.1f}, '
+            f'total;dur={total_ms:.1f}'
+        )
+
+    if response.is_streamed:
+        # Метрики - когда тело отдано целиком: WSGI-сервер закрывает ответ
+        # после генератора, запросы к БД и шаблон к этому моменту уже учтены
+        response.call_on_close(lambda: _record(timing, leases, route, method, response.status_code))
+    else:
+        _record(timing, leases, route, method, response.status_code)
+    return response
+
+
+def _record(timing, leases, route, method, status):
+    """Метрики и журнал медленных запросов по итогам запроса.
+
+    Для потоковых ответов вызывается при закрытии ответа, когда контекста
+    запроса уже нет - поэтому все нужное передается аргументами.
+    """
+    total_ms = (time.perf_counter() - timing['start']) * 1000
+    db_ms = timing['db'] * 1000
+    render_ms = timing['render'] * 1000
+    queries = timing['queries']
+    connections = len(leases)
+
+    # Счетчики без блокировок: каждый поток пишет в свой словарь
+    metrics.inc('http_requests_total', route=route, method=method, status=status)
+    metrics.observe('http_request_duration_seconds', total_ms / 1000, route=route)
+    metrics.inc('http_request_db_seconds_total', timing['db'], route=route)
+    metrics.inc('http_request_render_seconds_total', timing['render'], route=route)
+    metrics.inc('http_request_queries_total', queries, route=route)
+    metrics.inc('http_request_connections_total', connections, route=route)
+    metrics.maybe_flush()
+
+    if total_ms >= SLOW_REQUEST_MS:
+        print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] Медленный запрос {method} {route}: "
+              f"{total_ms:.0f} мс (БД {db_ms:.0f} мс / {queries} запросов / {connections} соединений, "
+              f"шаблон {render_ms:.0f} мс)")
+
+
+def init_app(app):
+    """Подключает замеры к приложению Flask"""
+    db.add_query_listener(_on_query)
+    before_render_template.connect(_on_before_render, app)
+    template_rendered.connect(_on_rendered, app)
+    app.before_request(_before_request)
+    app.after_request(_after_request)
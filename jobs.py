@@ -0,0 +1,340 @@
+# jobs.py - Фоновые задачи: очередь в PostgreSQL и потоки-исполнители
+#
+# Тяжелые операции админки (экспорт, исправление и сброс базы, очистка)
+# ставятся в таблицу jobs и выполняются потоками внутри воркеров gunicorn.
+# Задачу забирает ровно один поток: SELECT ... FOR UPDATE SKIP LOCKED.
+# Файл результата сохраняется в JOBS_DIR и скачивается позже по ссылке.
+# Новая задача будит исполнителей всех воркеров через NOTIFY (LISTEN держит
+# по одному соединению на процесс), опрос раз в JOB_POLL_INTERVAL - запасной.
+import os
+import time
+import tempfile
+import threading
+import psycopg
+from psycopg.rows import dict_row
+from psycopg.types.json import Jsonb
+
+import db
+import metrics
+
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 1))
+# Запасной опрос очереди: обычно исполнителей будит NOTIFY из enqueue
+JOB_POLL_INTERVAL = float(os.environ.get('JOB_POLL_INTERVAL', 30))
+JOB_HEARTBEAT_INTERVAL = float(os.environ.get('JOB_HEARTBEAT_INTERVAL', 15))
+# Задача без отметок дольше этого считается брошенной (воркер перезапущен)
+JOB_STALE_SECONDS = float(os.environ.get('JOB_STALE_SECONDS', 120))
+JOB_MAX_ATTEMPTS = int(os.environ.get('JOB_MAX_ATTEMPTS', 3))
+# Сколько часов хранить завершенные задачи и их файлы
+JOB_RESULT_TTL_HOURS = float(os.environ.get('JOB_RESULT_TTL_HOURS', 24))
+# Сколько ждать текущую задачу при остановке воркера
+JOB_SHUTDOWN_TIMEOUT = float(os.environ.get('JOB_SHUTDOWN_TIMEOUT', 25))
+JOBS_DIR = os.environ.get('JOBS_DIR', os.path.join(tempfile.gettempdir(), 'tax_excursion_jobs'))
+
+# Канал LISTEN/NOTIFY о новых задачах
+JOB_CHANNEL = 'jobs_queued'
+
+JOB_DURATION_BUCKETS = (1, 5, 15, 60, 300, 900, 3600, float('inf'))
+
+STATUS_LABELS = {
+    'queued': 'В очереди',
+    'running': 'Выполняется',
+    'done': 'Готово',
+    'failed': 'Ошибка',
+}
+
+# kind -> (функция, название, можно ли перезапустить после сбоя воркера)
+_handlers = {}
+_app = None
+_threads = []
+_workers_pid = None
+_workers_lock = threading.Lock()
+_wakeup = threading.Event()
+_stop = threading.Event()
+_running = {}
+_running_lock = threading.Lock()
+_last_maintenance = 0.0
+
+
+def ensure_schema(cursor):
+    """Таблица очереди задач (идемпотентно)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS jobs (
+            id BIGSERIAL PRIMARY KEY,
+            kind VARCHAR(50) NOT NULL,
+            title VARCHAR(200),
+            params JSONB NOT NULL DEFAULT '{}',
+            status VARCHAR(20) NOT NULL DEFAULT 'queued',
+            progress INTEGER NOT NULL DEFAULT 0,
+            message TEXT,
+            result JSONB,
+            error TEXT,
+            attempts INTEGER NOT NULL DEFAULT 0,
+            worker VARCHAR(100),
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            started_at TIMESTAMP,
+            heartbeat_at TIMESTAMP,
+            finished_at TIMESTAMP
+        )
+    ''')
+    # Частичный индекс: поиск следующей задачи не просматривает выполненные
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_jobs_queued ON jobs(id) WHERE status = 'queued'")
+
+
+def register(kind, handler, title, retry=False):
+    """Регистрирует обработчик: handler(job) -> dict результата.
+
+    retry=True - задачу можно запустить заново, если воркер остановился
+    посреди выполнения (экспорт). Для изменяющих базу операций - False.
+    """
+    _handlers[kind] = (handler, title, retry)
+
+
+class Job:
+    """Выполняемая задача: параметры, прогресс и путь к файлу результата"""
+
+    def __init__(self, job_id, kind, params):
+        self.id = job_id
+        self.kind = kind
+        self.params = params or {}
+        self._last_progress = 0.0
+
+    def progress(self, percent, message=None):
+        """Сохраняет прогресс (не чаще раза в секунду)"""
+        now = time.monotonic()
+        if now - self._last_progress < 1 and percent < 100:
+            return
+        self._last_progress = now
+        _execute('''
+            UPDATE jobs SET progress = %s, message = COALESCE(%s, message), heartbeat_at = CURRENT_TIMESTAMP
+            WHERE id = %s
+        ''', (max(0, min(100, int(percent))), message, self.id))
+
+    def artifact_path(self, extension):
+        """Путь к файлу результата в JOBS_DIR"""
+        os.makedirs(JOBS_DIR, exist_ok=True)
+        return os.path.join(JOBS_DIR, f'job_{self.id}.{extension}')
+
+
+def _execute(query, params=None, fetch=None):
+    """Короткий запрос на соединении из пула с commit"""
+    conn = db.get_db_connection()
+    try:
+        with conn.cursor(row_factory=dict_row) as cursor:
+            cursor.execute(query, params)
+            if fetch == 'one':
+                result = cursor.fetchone()
+            elif fetch == 'all':
+                result = cursor.fetchall()
+            else:
+                result = cursor.rowcount
+        conn.commit()
+        return result
+    finally:
+        conn.close()
+
+
+def enqueue(kind, params=None, title=None):
+    """Ставит задачу в очередь и возвращает ее id"""
+    if kind not in _handlers:
+        raise ValueError(f'Неизвестный тип задачи: {kind}')
+    # NOTIFY доставляется при commit - вместе с самой задачей
+    row = _execute('''
+        WITH job AS (
+            INSERT INTO jobs (kind, title, params) VALUES (%s, %s, %s) RETURNING id
+        )
+        SELECT id, pg_notify(%s, id::text) FROM job
+    ''', (kind, title or _handlers[kind][1], Jsonb(params or {}), JOB_CHANNEL), fetch='one')
+    metrics.inc('jobs_enqueued_total', kind=kind)
+
+    # В этом процессе будим исполнителей сразу, в остальных - по NOTIFY
+    start_workers()
+    _wakeup.set()
+    return row['id']
+
+
+def get(job_id):
+    return _execute('SELECT * FROM jobs WHERE id = %s', (job_id,), fetch='one')
+
+
+def recent(limit=30):
+    return _execute('SELECT * FROM jobs ORDER BY id DESC LIMIT %s', (limit,), fetch='all')
+
+
+def _claim():
+    """Забирает следующую задачу; параллельные воркеры пропускают заблокированные строки"""
+    row = _execute('''
+        UPDATE jobs SET
+            status = 'running',
+            attempts = attempts + 1,
+            worker = %s,
+            started_at = CURRENT_TIMESTAMP,
+            heartbeat_at = CURRENT_TIMESTAMP
+        WHERE id = (
+            SELECT id FROM jobs
+            WHERE status = 'queued'
+            ORDER BY id
+            LIMIT 1
+            FOR UPDATE SKIP LOCKED
+        )
+        RETURNING id, kind, params
+    ''', (f'{os.getpid()}/{threading.current_thread().name}',), fetch='one')
+    if row is None:
+        return None
+    return Job(row['id'], row['kind'], row['params'])
+
+
+def _finish(job, status, result, error):
+    _execute('''
+        UPDATE jobs SET
+            status = %s,
+            progress = CASE WHEN %s = 'done' THEN 100 ELSE progress END,
+            result = %s,
+            error = %s,
+            finished_at = CURRENT_TIMESTAMP
+        WHERE id = %s
+    ''', (status, status, Jsonb(result) if result is not None else None, error, job.id))
+
+
+def _run(job):
+    handler, _, _ = _handlers.get(job.kind, (None, None, None))
+    status = 'failed'
+    started = time.perf_counter()
+
+    with _running_lock:
+        _running[job.id] = job
+    try:
+        if handler is None:
+            raise ValueError(f'Неизвестный тип задачи: {job.kind}')
+
+        # Обработчики пользуются функциями app.py, поэтому нужен контекст приложения
+        with _app.app_context():
+            result = handler(job) or {}
+
+        status = 'done' if result.get('success', True) else 'failed'
+        _finish(job, status, result, None)
+        print(f"✅ Задача #{job.id} ({job.kind}): {STATUS_LABELS[status]}")
+    except Exception as e:
+        print(f"❌ Задача #{job.id} ({job.kind}): {e}")
+        try:
+            _finish(job, 'failed', None, str(e))
+        except Exception as finish_error:
+            print(f"Ошибка сохранения статуса задачи #{job.id}: {finish_error}")
+    finally:
+        with _running_lock:
+            _running.pop(job.id, None)
+        metrics.inc('jobs_total', kind=job.kind, status=status)
+        metrics.observe('job_duration_seconds', time.perf_counter() - started, JOB_DURATION_BUCKETS, kind=job.kind)
+
+
+def _maintenance():
+    """Возвращает в очередь брошенные задачи и удаляет старые результаты"""
+    global _last_maintenance
+    now = time.monotonic()
+    if now - _last_maintenance < JOB_STALE_SECONDS / 2:
+        return
+    _last_maintenance = now
+
+    retryable = [kind for kind, (_, _, retry) in _handlers.items() if retry]
+    _execute('''
+        UPDATE jobs SET
+            status = CASE WHEN kind = ANY(%s) AND attempts < %s THEN 'queued' ELSE 'failed' END,
+            error = CASE WHEN kind = ANY(%s) AND attempts < %s THEN NULL
+                         ELSE 'Воркер остановился во время выполнения задачи' END,
+            finished_at = CASE WHEN kind = ANY(%s) AND attempts < %s THEN NULL ELSE CURRENT_TIMESTAMP END
+        WHERE status = 'running'
+          AND heartbeat_at < CURRENT_TIMESTAMP - make_interval(secs => %s)
+    ''', (retryable, JOB_MAX_ATTEMPTS, retryable, JOB_MAX_ATTEMPTS, retryable, JOB_MAX_ATTEMPTS, JOB_STALE_SECONDS))
+
+    expired = _execute('''
+        DELETE FROM jobs
+        WHERE finished_at < CURRENT_TIMESTAMP - %s * INTERVAL '1 hour'
+        RETURNING result->>'file' AS file
+    ''', (JOB_RESULT_TTL_HOURS,), fetch='all')
+    for row in expired:
+        if row['file']:
+            try:
+                os.remove(row['file'])
+            except OSError:
+                pass
+
+
+def _worker_loop():
+    while not _stop.is_set():
+        job = None
+        try:
+            _maintenance()
+            job = _claim()
+        except Exception as e:
+            print(f"Ошибка очереди задач: {e}")
+
+        if job is None:
+            _wakeup.wait(JOB_POLL_INTERVAL)
+            _wakeup.clear()
+            continue
+        _run(job)
+
+
+def _listen_loop():
+    """Будит исполнителей процесса по NOTIFY о новой задаче"""
+    while not _stop.is_set():
+        try:
+            # Отдельное соединение вне пула: оно все время ждет уведомлений
+            with psycopg.connect(db.get_conninfo(), autocommit=True) as conn:
+                conn.execute(f'LISTEN {JOB_CHANNEL}')
+                # Задачи, поставленные без слушателя, забираем сразу
+                _wakeup.set()
+                while not _stop.is_set():
+                    for _ in conn.notifies(timeout=1):
+                        _wakeup.set()
+        except Exception as e:
+            print(f"Ошибка ожидания новых задач: {e}")
+            _stop.wait(JOB_POLL_INTERVAL)
+
+
+def _heartbeat_loop():
+    """Отмечает выполняемые задачи, чтобы их не сочли брошенными"""
+    while not _stop.wait(JOB_HEARTBEAT_INTERVAL):
+        with _running_lock:
+            job_ids = list(_running)
+        if not job_ids:
+            continue
+        try:
+            _execute('UPDATE jobs SET heartbeat_at = CURRENT_TIMESTAMP WHERE id = ANY(%s)', (job_ids,))
+        except Exception as e:
+            print(f"Ошибка отметки задач: {e}")
+
+
+def init_app(app):
+    global _app
+    _app = app
+
+
+def start_workers():
+    """Запускает потоки-исполнители в текущем процессе (один раз на воркер)"""
+    global _workers_pid
+    if _workers_pid == os.getpid() or _app is None or JOB_WORKERS <= 0:
+        return
+    with _workers_lock:
+        if _workers_pid == os.getpid():
+            return
+        _stop.clear()
+        _threads[:] = [threading.Thread(target=_worker_loop, daemon=True, name=f'job-worker-{i}')
+                       for i in range(JOB_WORKERS)]
+        _threads.append(threading.Thread(target=_heartbeat_loop, daemon=True, name='job-heartbeat'))
+        _threads.append(threading.Thread(target=_listen_loop, daemon=True, name='job-listen'))
+        for thread in _threads:
+            thread.start()
+        _workers_pid = os.getpid()
+
+
+def stop_workers():
+    """Останавливает опрос очереди и ждет текущие задачи до JOB_SHUTDOWN_TIMEOUT"""
+    global _workers_pid
+    if _workers_pid != os.getpid():
+        return
+    _stop.set()
+    _wakeup.set()
+    deadline = time.monotonic() + JOB_SHUTDOWN_TIMEOUT
+    for thread in _threads:
+        thread.join(max(0.0, deadline - time.monotonic()))
+    _workers_pid = None
@@ -1,33 +1,74 @@
-import requests
-import time
+# keep_alive.py - Пинг приложения, чтобы Render free tier не усыплял сервис
+#
+# Render усыпляет бесплатный сервис после 15 минут без запросов. ping()
+# вызывает планировщик (scheduler.py) только в воркере-лидере, поэтому
+# при нескольких воркерах пингует один. Запросы идут через постоянную
+# requests.Session: TCP/TLS-соединение переиспользуется, пока сервер его
+# держит. Ошибка пинга - исключение: планировщик повторит попытку раньше
+# обычного интервала (с увеличением задержки).
+#
+# Скрипт можно запустить и отдельно: python keep_alive.py
 import os
-from threading import Thread
+import time
+import threading
 from datetime import datetime
 
-def ping_self():
-    """Периодически пингует приложение чтобы не засыпало"""
-    url = os.environ.get('RENDER_EXTERNAL_URL', 'https://taxexcursion.ru')
-    
-    while True:
-        try:
-            response = requests.get(f"{url}/health", timeout=10)
-            print(f"[{datetime.now()}] Keep-alive ping: {response.status_code}")
-        except Exception as e:
-            print(f"[{datetime.now()}] Keep-alive failed: {e}")
-        
-        # Ждем 5 минут (300 секунд) - Render free tier спит после 15 минут неактивности
-        time.sleep(300)  # 5 минут
+import requests
+from requests.adapters import HTTPAdapter
+
+import metrics
+
+KEEPALIVE_URL = os.environ.get('RENDER_EXTERNAL_URL', 'https://taxexcursion.ru')
+KEEPALIVE_INTERVAL_SECONDS = float(os.environ.get('KEEPALIVE_INTERVAL_SECONDS', 600))
+KEEPALIVE_TIMEOUT_SECONDS = float(os.environ.get('KEEPALIVE_TIMEOUT_SECONDS', 10))
+
+_session = None
+_session_pid = None
+_session_lock = threading.Lock()
+
+
+def enabled():
+    """Пинг нужен только на Render"""
+    return os.environ.get('RENDER') == 'true'
+
+
+def get_session():
+    """Сессия текущего процесса (после fork - новая: сокеты родителя не наследуем)"""
+    global _session, _session_pid
+    with _session_lock:
+        if _session is None or _session_pid != os.getpid():
+            session = requests.Session()
+            session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+            session.mount('http://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+            session.headers['User-Agent'] = 'tax-excursion-keepalive'
+            _session, _session_pid = session, os.getpid()
+        return _session
+
+
+def ping():
+    """Один пинг /health; при ошибке - исключение"""
+    try:
+        response = get_session().get(f"{KEEPALIVE_URL}/health", timeout=KEEPALIVE_TIMEOUT_SECONDS)
+    except requests.RequestException as e:
+        print(f"[{datetime.now()}] Keep-alive failed: {e}")
+        metrics.inc('keepalive_pings_total', outcome='error')
+        raise
+
+    print(f"[{datetime.now()}] Keep-alive ping: {response.status_code}")
+    if not response.ok:
+        metrics.inc('keepalive_pings_total', outcome='http_error')
+        raise RuntimeError(f'Keep-alive: HTTP {response.status_code}')
+    metrics.inc('keepalive_pings_total', outcome='ok')
+
 
 if __name__ == '__main__':
     print("Starting keep-alive service...")
-    
-    # Запускаем в фоне
-    thread = Thread(target=ping_self, daemon=True)
-    thread.start()
-    
-    # Держим основной поток активным
     try:
         while True:
-            time.sleep(1)
+            try:
+                ping()
+            except Exception:
+                pass
+            time.sleep(KEEPALIVE_INTERVAL_SECONDS)
     except KeyboardInterrupt:
         print("Keep-alive service stopped.")
\ No newline at end of file
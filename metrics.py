@@ -0,0 +1,289 @@
+# metrics.py - Счетчики и гистограммы в формате Prometheus
+#
+# Каждый поток пишет только в свой словарь (shard), поэтому блокировок на
+# горячем пути нет. При сборе словари потоков складываются. Чтобы /metrics
+# показывал сумму по всем воркерам gunicorn, каждый процесс не чаще раза в
+# METRICS_FLUSH_INTERVAL секунд сохраняет свой снимок в METRICS_DIR.
+import os
+import json
+import time
+import tempfile
+import threading
+
+METRICS_PREFIX = 'taxexcursion_'
+METRICS_DIR = os.environ.get('METRICS_DIR', os.path.join(tempfile.gettempdir(), 'tax_excursion_metrics'))
+METRICS_FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 1))
+
+# Границы корзин гистограмм, секунды
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, float('inf'))
+
+# Описания метрик для # HELP
+HELP = {
+    'http_requests_total': 'HTTP-запросы по маршруту, методу и статусу',
+    'http_request_duration_seconds': 'Длительность HTTP-запросов',
+    'http_request_db_seconds_total': 'Суммарное время в БД по маршрутам',
+    'http_request_render_seconds_total': 'Суммарное время рендеринга шаблонов по маршрутам',
+    'http_request_queries_total': 'Количество SQL-запросов по маршрутам',
+    'http_request_connections_total': 'Количество соединений из пула по маршрутам',
+    'db_pool_connections': 'Соединения пула (size/available/waiting/max)',
+    'cache_requests_total': 'Обращения к кэшам (hit/miss)',
+    'bookings_created_total': 'Созданные записи',
+    'bookings_cancelled_total': 'Отмененные записи',
+    'pending_expired_total': 'Ожидающие заявки, отмененные автоматически (прошедшая дата или возраст)',
+    'bookings_rejected_total': 'Отклоненные заявки: лимит частоты, повтор, дубль, заблокированная дата',
+    'bulk_action_rows_total': 'Записи в массовых действиях по результату',
+    'export_bytes_total': 'Байт отдано в экспортах',
+    'keepalive_pings_total': 'Результаты keep-alive пингов',
+    'scheduler_runs_total': 'Запуски периодических задач по результату',
+    'scheduler_run_seconds': 'Длительность периодических задач',
+    'slow_queries_total': 'SQL-запросы дольше SLOW_QUERY_MS',
+    'jobs_enqueued_total': 'Фоновые задачи, поставленные в очередь',
+    'jobs_total': 'Выполненные фоновые задачи по результату',
+    'job_duration_seconds': 'Длительность фоновых задач',
+    'notifications_total': 'Уведомления: отправленные и неудачные попытки',
+}
+
+_local = threading.local()
+_shards = []
+_shards_lock = threading.Lock()
+_collectors = []
+_last_flush = 0.0
+
+
+def _shard():
+    """Словарь счетчиков текущего потока (создается один раз на поток)"""
+    shard = getattr(_local, 'shard', None)
+    if shard is None or shard['pid'] != os.getpid():
+        shard = _local.shard = {'pid': os.getpid(), 'counters': {}, 'histograms': {}}
+        with _shards_lock:
+            _shards.append(shard)
+    return shard
+
+
+def _key(name, labels):
+    return (name, tuple(sorted((k, str(v)) for k, v in labels.items())))
+
+
+def inc(name, value=1, **labels):
+    """Увеличивает счетчик"""
+    counters = _shard()['counters']
+    key = _key(name, labels)
+    counters[key] = counters.get(key, 0) + value
+
+
+def observe(name, value, buckets=DEFAULT_BUCKETS, **labels):
+    """Добавляет наблюдение в гистограмму"""
+    histograms = _shard()['histograms']
+    key = _key(name, labels)
+    hist = histograms.get(key)
+    if hist is None:
+        hist = histograms[key] = [list(buckets), [0] * len(buckets), 0.0, 0]
+    bounds, counts = hist[0], hist[1]
+    for i, bound in enumerate(bounds):
+        if value <= bound:
+            counts[i] += 1
+            break
+    hist[2] += value
+    hist[3] += 1
+
+
+def register_collector(collector):
+    """Регистрирует функцию, возвращающую gauge-значения: [(name, labels, value), ...]"""
+    if collector not in _collectors:
+        _collectors.append(collector)
+
+
+def collect_local():
+    """Снимок метрик текущего процесса (сумма по потокам + коллекторы)"""
+    counters = {}
+    histograms = {}
+    gauges = {}
+
+    pid = os.getpid()
+    with _shards_lock:
+        # После fork в списке остаются словари потоков родителя - отбрасываем их
+        _shards[:] = [shard for shard in _shards if shard['pid'] == pid]
+        shards = list(_shards)
+
+    for shard in shards:
+        # dict() копирует словарь атомарно под GIL
+        for key, value in dict(shard['counters']).items():
+            counters[key] = counters.get(key, 0) + value
+        for key, (bounds, counts, total, count) in dict(shard['histograms']).items():
+            merged = histograms.get(key)
+            if merged is None:
+                histograms[key] = [bounds, list(counts), total, count]
+            else:
+                merged[1] = [a + b for a, b in zip(merged[1], counts)]
+                merged[2] += total
+                merged[3] += count
+
+    for collector in _collectors:
+        try:
+            for name, labels, value in collector():
+                key = _key(name, labels)
+                gauges[key] = gauges.get(key, 0) + value
+        except Exception as e:
+            print(f"Ошибка сбора метрик: {e}")
+
+    return {'counters': counters, 'histograms': histograms, 'gauges': gauges}
+
+
+def _snapshot_path(pid):
+    return os.path.join(METRICS_DIR, f'metrics_{pid}.json')
+
+
+def _encode(snapshot):
+    return {
+        kind: [[name, list(labels), value] for (name, labels), value in values.items()]
+        for kind, values in snapshot.items()
+    }
+
+
+def _decode(data):
+    return {
+        kind: {(name, tuple(tuple(label) for label in labels)): value for name, labels, value in values}
+        for kind, values in data.items()
+    }
+
+
+def flush():
+    """Сохраняет снимок текущего процесса для агрегации другими воркерами"""
+    global _last_flush
+    _last_flush = time.monotonic()
+    try:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        path = _snapshot_path(os.getpid())
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump(_encode(collect_local()), f)
+        os.replace(tmp_path, path)
+    except OSError as e:
+        print(f"Ошибка сохранения метрик: {e}")
+
+
+def maybe_flush():
+    """Сохраняет снимок, если с прошлого раза прошло METRICS_FLUSH_INTERVAL"""
+    if time.monotonic() - _last_flush >= METRICS_FLUSH_INTERVAL:
+        flush()
+
+
+def reset_dir():
+    """Очищает снимки прошлого запуска (вызывается в мастере при старте)"""
+    try:
+        for filename in os.listdir(METRICS_DIR):
+            if filename.startswith('metrics_'):
+                os.remove(os.path.join(METRICS_DIR, filename))
+    except FileNotFoundError:
+        pass
+
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def collect_all():
+    """Сумма метрик всех процессов: свои живые значения + снимки остальных"""
+    total = collect_local()
+    own_file = os.path.basename(_snapshot_path(os.getpid()))
+
+    try:
+        filenames = os.listdir(METRICS_DIR)
+    except FileNotFoundError:
+        filenames = []
+
+    for filename in filenames:
+        if not filename.startswith('metrics_') or not filename.endswith('.json') or filename == own_file:
+            continue
+        try:
+            with open(os.path.join(METRICS_DIR, filename)) as f:
+                snapshot = _decode(json.load(f))
+        except (OSError, ValueError):
+            continue
+
+        # Счетчики завершившихся воркеров сохраняем, а их gauge-значения - нет
+        kinds = ('counters', 'gauges')
+        pid = filename[len('metrics_'):-len('.json')]
+        if not pid.isdigit() or not _is_alive(int(pid)):
+            kinds = ('counters',)
+
+        for kind in kinds:
+            for key, value in snapshot.get(kind, {}).items():
+                total[kind][key] = total[kind].get(key, 0) + value
+        for key, (bounds, counts, hist_sum, count) in snapshot.get('histograms', {}).items():
+            merged = total['histograms'].get(key)
+            if merged is None:
+                total['histograms'][key] = [bounds, counts, hist_sum, count]
+            else:
+                merged[1] = [a + b for a, b in zip(merged[1], counts)]
+                merged[2] += hist_sum
+                merged[3] += count
+
+    return total
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{k}="{_escape(v)}"' for k, v in pairs) + '}'
+
+
+def _format_number(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+def render_text():
+    """Метрики в текстовом формате Prometheus (version 0.0.4)"""
+    snapshot = collect_all()
+    lines = []
+
+    def grouped(values):
+        by_name = {}
+        for (name, labels), value in sorted(values.items()):
+            by_name.setdefault(name, []).append((labels, value))
+        return by_name.items()
+
+    def header(name, metric_type):
+        full_name = METRICS_PREFIX + name
+        if name in HELP:
+            lines.append(f'# HELP {full_name} {HELP[name]}')
+        lines.append(f'# TYPE {full_name} {metric_type}')
+        return full_name
+
+    for name, series in grouped(snapshot['counters']):
+        full_name = header(name, 'counter')
+        for labels, value in series:
+            lines.append(f'{full_name}{_format_labels(labels)} {_format_number(value)}')
+
+    for name, series in grouped(snapshot['gauges']):
+        full_name = header(name, 'gauge')
+        for labels, value in series:
+            lines.append(f'{full_name}{_format_labels(labels)} {_format_number(value)}')
+
+    for name, series in grouped(snapshot['histograms']):
+        full_name = header(name, 'histogram')
+        for labels, (bounds, counts, hist_sum, count) in series:
+            cumulative = 0
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count
+                le = (('le', _format_number(float(bound))),)
+                lines.append(f'{full_name}_bucket{_format_labels(labels, le)} {cumulative}')
+            lines.append(f'{full_name}_sum{_format_labels(labels)} {_format_number(float(hist_sum))}')
+            lines.append(f'{full_name}_count{_format_labels(labels)} {count}')
+
+    return '\n'.join(lines) + '\n'
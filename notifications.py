@@ -0,0 +1,371 @@
+# notifications.py - Уведомления через транзакционную очередь (outbox)
+#
+# Уведомление записывается в таблицу notification_outbox в той же транзакции,
+# что и сама запись или смена статуса: если транзакция откатилась, письма не
+# будет, а если закоммитилась - оно обязательно уйдет. Отправкой занимается
+# фоновый поток каждого воркера, поэтому запись на экскурсию не ждет SMTP.
+#
+# Транспорт задается NOTIFY_TRANSPORT:
+#   file - сообщения дописываются в NOTIFY_FILE (JSON Lines), для проверки;
+#          файл больше NOTIFY_FILE_MAX_MB переименовывается в NOTIFY_FILE.1
+#   smtp - письма на NOTIFY_SMTP_HOST (подойдет и локальная SMTP-заглушка)
+#   none - уведомления не создаются
+# Без NOTIFY_TRANSPORT локально используется file, а на Render (RENDER=true)
+# уведомления выключены с предупреждением в логе: file там никому ничего
+# не доставляет. Отправки SMS нет: сообщения учителю (канал phone) только
+# записываются в файл транспортом file, smtp их не создает.
+import os
+import json
+import time
+import smtplib
+import tempfile
+import threading
+from email.message import EmailMessage
+from psycopg.rows import dict_row
+
+import db
+import metrics
+
+NOTIFY_TRANSPORT = os.environ.get('NOTIFY_TRANSPORT', '').lower()
+NOTIFY_FILE = os.environ.get('NOTIFY_FILE', os.path.join(tempfile.gettempdir(), 'tax_excursion_notifications.jsonl'))
+NOTIFY_FILE_MAX_MB = float(os.environ.get('NOTIFY_FILE_MAX_MB', 10))
+NOTIFY_ADMIN_EMAIL = os.environ.get('NOTIFY_ADMIN_EMAIL', '')
+# Уведомлять учителя по телефону из заявки (нужен транспорт с каналом phone)
+NOTIFY_TEACHER = os.environ.get('NOTIFY_TEACHER', 'true').lower() == 'true'
+
+NOTIFY_SMTP_HOST = os.environ.get('NOTIFY_SMTP_HOST', 'localhost')
+NOTIFY_SMTP_PORT = int(os.environ.get('NOTIFY_SMTP_PORT', 25))
+NOTIFY_SMTP_USER = os.environ.get('NOTIFY_SMTP_USER', '')
+NOTIFY_SMTP_PASSWORD = os.environ.get('NOTIFY_SMTP_PASSWORD', '')
+NOTIFY_SMTP_STARTTLS = os.environ.get('NOTIFY_SMTP_STARTTLS', 'false').lower() == 'true'
+NOTIFY_FROM = os.environ.get('NOTIFY_FROM', 'noreply@tax-excursion.local')
+
+NOTIFY_BATCH_SIZE = int(os.environ.get('NOTIFY_BATCH_SIZE', 50))
+NOTIFY_POLL_INTERVAL = float(os.environ.get('NOTIFY_POLL_INTERVAL', 5))
+NOTIFY_MAX_ATTEMPTS = int(os.environ.get('NOTIFY_MAX_ATTEMPTS', 5))
+# На это время взятые сообщения скрыты от других воркеров; если воркер
+# остановился посреди отправки, сообщения снова станут доступны
+NOTIFY_LEASE_SECONDS = int(os.environ.get('NOTIFY_LEASE_SECONDS', 60))
+NOTIFY_RETENTION_DAYS = int(os.environ.get('NOTIFY_RETENTION_DAYS', 30))
+
+STATUS_TEXT = {
+    'pending': 'ожидает подтверждения',
+    'confirmed': 'подтверждена',
+    'cancelled': 'отменена',
+}
+
+# Колонки bookings для RETURNING: все, что нужно для текста уведомлений
+BOOKING_FIELDS = 'id, username, school_name, class_number, excursion_date, contact_phone, participants_count, status'
+
+_dispatcher_pid = None
+_dispatcher_lock = threading.Lock()
+_wakeup = threading.Event()
+_stop = threading.Event()
+_thread = None
+_last_cleanup = 0.0
+
+
+def ensure_schema(cursor):
+    """Таблица очереди уведомлений (идемпотентно)"""
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS notification_outbox (
+            id BIGSERIAL PRIMARY KEY,
+            event VARCHAR(50) NOT NULL,
+            channel VARCHAR(20) NOT NULL,
+            recipient VARCHAR(200) NOT NULL,
+            subject TEXT NOT NULL,
+            body TEXT NOT NULL,
+            booking_id INTEGER,
+            status VARCHAR(20) NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            last_error TEXT,
+            created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            next_attempt_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            sent_at TIMESTAMP
+        )
+    ''')
+    cursor.execute('''
+        CREATE INDEX IF NOT EXISTS idx_notification_outbox_due
+        ON notification_outbox(next_attempt_at) WHERE status = 'pending'
+    ''')
+
+
+# ---- Транспорты ----
+
+class FileTransport:
+    """Дописывает сообщения в файл JSON Lines (для локальной проверки)"""
+    channels = ('email', 'phone')
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def send_batch(self, messages):
+        with self._lock:
+            self._rotate()
+            self._write(messages)
+        return [None] * len(messages)
+
+    def _rotate(self):
+        """Файл не растет бесконечно: при превышении лимита - в .1 (прежний .1 удаляется)"""
+        try:
+            if os.path.getsize(self.path) >= NOTIFY_FILE_MAX_MB * 1024 * 1024:
+                os.replace(self.path, f'{self.path}.1')
+        except FileNotFoundError:
+            pass
+
+    def _write(self, messages):
+        with open(self.path, 'a', encoding='utf-8') as f:
+            for message in messages:
+                f.write(json.dumps({
+                    'id': message['id'],
+                    'channel': message['channel'],
+                    'to': message['recipient'],
+                    'subject': message['subject'],
+                    'body': message['body'],
+                    'sent_at': time.strftime('%Y-%m-%d %H:%M:%S'),
+                }, ensure_ascii=False) + '\n')
+
+
+class SmtpTransport:
+    """Письма через SMTP: одно соединение на пачку сообщений"""
+    channels = ('email',)
+
+    def send_batch(self, messages):
+        errors = []
+        with smtplib.SMTP(NOTIFY_SMTP_HOST, NOTIFY_SMTP_PORT, timeout=30) as smtp:
+            if NOTIFY_SMTP_STARTTLS:
+                smtp.starttls()
+            if NOTIFY_SMTP_USER:
+                smtp.login(NOTIFY_SMTP_USER, NOTIFY_SMTP_PASSWORD)
+            for message in messages:
+                email = EmailMessage()
+                email['From'] = NOTIFY_FROM
+                email['To'] = message['recipient']
+                email['Subject'] = message['subject']
+                email.set_content(message['body'])
+                try:
+                    smtp.send_message(email)
+                    errors.append(None)
+                except smtplib.SMTPException as e:
+                    errors.append(str(e))
+        return errors
+
+
+def get_transport():
+    transport = NOTIFY_TRANSPORT
+    if not transport:
+        if os.environ.get('RENDER') == 'true':
+            print("⚠️ NOTIFY_TRANSPORT не задан: уведомления выключены. "
+                  "Для писем администратору задайте NOTIFY_TRANSPORT=smtp и NOTIFY_SMTP_*")
+            return None
+        transport = 'file'
+    if transport == 'smtp':
+        return SmtpTransport()
+    if transport == 'file':
+        return FileTransport(NOTIFY_FILE)
+    return None
+
+
+_transport = get_transport()
+
+
+def set_transport(transport):
+    """Подменяет транспорт (например, на собственный класс с send_batch)"""
+    global _transport
+    _transport = transport
+
+
+# ---- Запись в outbox (в транзакции вызывающего кода) ----
+
+def _messages(event, booking):
+    """Сообщения о событии: [(channel, recipient, subject, body), ...]"""
+    excursion_date = booking['excursion_date']
+    if hasattr(excursion_date, 'strftime'):
+        excursion_date = excursion_date.strftime('%d.%m.%Y')
+    school = f"{booking['school_name']}, {booking['class_number']}"
+
+    messages = []
+    if event == 'booking_created':
+        if NOTIFY_ADMIN_EMAIL:
+            messages.append(('email', NOTIFY_ADMIN_EMAIL, f'Новая запись на экскурсию {excursion_date}', (
+                f"Дата: {excursion_date}\n"
+                f"Школа: {school}\n"
+                f"Ответственный: {booking['username']}\n"
+                f"Телефон: {booking['contact_phone']}\n"
+                f"Участников: {booking['participants_count']}\n"
+                f"Запись №{booking['id']}"
+            )))
+        if NOTIFY_TEACHER and booking.get('contact_phone'):
+            messages.append(('phone', booking['contact_phone'], 'Заявка на экскурсию принята', (
+                f"Заявка на экскурсию {excursion_date} ({school}) принята "
+                f"и ожидает подтверждения. Номер записи: {booking['id']}."
+            )))
+    elif event == 'status_changed':
+        status_text = STATUS_TEXT.get(booking['status'], booking['status'])
+        if NOTIFY_TEACHER and booking.get('contact_phone'):
+            messages.append(('phone', booking['contact_phone'], f'Заявка на экскурсию {status_text}', (
+                f"Ваша заявка на экскурсию {excursion_date} ({school}) {status_text}. "
+                f"Номер записи: {booking['id']}."
+            )))
+        if NOTIFY_ADMIN_EMAIL:
+            messages.append(('email', NOTIFY_ADMIN_EMAIL, f"Запись №{booking['id']}: {status_text}", (
+                f"Запись №{booking['id']} на {excursion_date} ({school}) {status_text}."
+            )))
+    return messages
+
+
+def enqueue(cursor, event, bookings):
+    """Добавляет уведомления о событии в outbox в текущей транзакции.
+
+    bookings - строки (словари) с полями id, excursion_date, school_name,
+    class_number, username, contact_phone, participants_count, status.
+    """
+    if _transport is None:
+        return 0
+    if isinstance(bookings, dict):
+        bookings = [bookings]
+
+    rows = []
+    for booking in bookings:
+        for channel, recipient, subject, body in _messages(event, booking):
+            if channel in _transport.channels:
+                rows.append((event, channel, recipient, subject, body, booking['id']))
+    if rows:
+        cursor.executemany('''
+            INSERT INTO notification_outbox (event, channel, recipient, subject, body, booking_id)
+            VALUES (%s, %s, %s, %s, %s, %s)
+        ''', rows)
+    return len(rows)
+
+
+def wakeup():
+    """Будит диспетчер этого процесса (вызывать после commit)"""
+    if _transport is not None:
+        start_dispatcher()
+        _wakeup.set()
+
+
+# ---- Диспетчер ----
+
+def _claim(conn):
+    """Берет пачку готовых к отправке сообщений; чужие взятые строки пропускаются"""
+    with conn.cursor(row_factory=dict_row) as cursor:
+        cursor.execute('''
+            UPDATE notification_outbox SET
+                attempts = attempts + 1,
+                next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+            WHERE id IN (
+                SELECT id FROM notification_outbox
+                WHERE status = 'pending' AND next_attempt_at <= CURRENT_TIMESTAMP
+                ORDER BY next_attempt_at, id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING id, channel, recipient, subject, body, attempts
+        ''', (NOTIFY_LEASE_SECONDS, NOTIFY_BATCH_SIZE))
+        messages = cursor.fetchall()
+    conn.commit()
+    return messages
+
+
+def _record(conn, messages, errors):
+    """Сохраняет результат отправки; неудачные повторяются с нарастающей паузой"""
+    sent = [m['id'] for m, error in zip(messages, errors) if error is None]
+    failed = [(m, error) for m, error in zip(messages, errors) if error is not None]
+
+    with conn.cursor() as cursor:
+        if sent:
+            cursor.execute('''
+                UPDATE notification_outbox
+                SET status = 'sent', sent_at = CURRENT_TIMESTAMP, last_error = NULL
+                WHERE id = ANY(%s)
+            ''', (sent,))
+        for message, error in failed:
+            final = message['attempts'] >= NOTIFY_MAX_ATTEMPTS
+            cursor.execute('''
+                UPDATE notification_outbox SET
+                    status = %s,
+                    last_error = %s,
+                    next_attempt_at = CURRENT_TIMESTAMP + make_interval(secs => %s)
+                WHERE id = %s
+            ''', ('failed' if final else 'pending', error[:1000],
+                  min(3600, 30 * 2 ** (message['attempts'] - 1)), message['id']))
+    conn.commit()
+
+    metrics.inc('notifications_total', len(sent), status='sent')
+    if failed:
+        metrics.inc('notifications_total', len(failed), status='error')
+
+
+def _cleanup(conn):
+    """Удаляет отправленные уведомления старше NOTIFY_RETENTION_DAYS (раз в час)"""
+    global _last_cleanup
+    if time.monotonic() - _last_cleanup < 3600:
+        return
+    _last_cleanup = time.monotonic()
+    with conn.cursor() as cursor:
+        cursor.execute('''
+            DELETE FROM notification_outbox
+            WHERE status = 'sent' AND sent_at < CURRENT_TIMESTAMP - make_interval(days => %s)
+        ''', (NOTIFY_RETENTION_DAYS,))
+    conn.commit()
+
+
+def dispatch_once():
+    """Отправляет одну пачку; возвращает число обработанных сообщений"""
+    transport = _transport
+    if transport is None:
+        return 0
+
+    conn = db.get_db_connection()
+    try:
+        _cleanup(conn)
+        messages = _claim(conn)
+        if not messages:
+            return 0
+        try:
+            errors = transport.send_batch(messages)
+        except Exception as e:
+            # Транспорт недоступен целиком (нет соединения с SMTP и т.п.)
+            errors = [str(e)] * len(messages)
+        _record(conn, messages, errors)
+        return len(messages)
+    finally:
+        conn.close()
+
+
+def _dispatcher_loop():
+    while not _stop.is_set():
+        try:
+            if dispatch_once() >= NOTIFY_BATCH_SIZE:
+                # Очередь не пуста - следующую пачку берем сразу
+                continue
+        except Exception as e:
+            print(f"Ошибка отправки уведомлений: {e}")
+        _wakeup.wait(NOTIFY_POLL_INTERVAL)
+        _wakeup.clear()
+
+
+def start_dispatcher():
+    """Запускает поток отправки в текущем процессе (один на воркер)"""
+    global _dispatcher_pid, _thread
+    if _dispatcher_pid == os.getpid() or _transport is None:
+        return
+    with _dispatcher_lock:
+        if _dispatcher_pid == os.getpid():
+            return
+        _stop.clear()
+        _thread = threading.Thread(target=_dispatcher_loop, daemon=True, name='notification-dispatcher')
+        _thread.start()
+        _dispatcher_pid = os.getpid()
+
+
+def stop_dispatcher(timeout=5):
+    global _dispatcher_pid
+    if _dispatcher_pid != os.getpid():
+        return
+    _stop.set()
+    _wakeup.set()
+    _thread.join(timeout)
+    _dispatcher_pid = None
@@ -0,0 +1,95 @@
+# pending_expiry.py - Автоотмена брошенных заявок в статусе "Ожидание"
+#
+# Заявка 'pending' занимает место дня так же, как подтвержденная
+# (календарь считает все неотмененные записи). Если администратор ее так и
+# не подтвердил, место остается занятым навсегда. Периодическая задача
+# (scheduler.py, только в воркере-лидере) отменяет ожидающие заявки:
+# - дата экскурсии уже прошла;
+# - заявка подана больше PENDING_EXPIRY_DAYS дней назад (0 - правило выключено).
+#
+# Отмена - один UPDATE ... RETURNING на порцию до PENDING_EXPIRY_BATCH строк,
+# каждая порция в своей транзакции: блокировки строк короткие, а строки,
+# которые сейчас меняет администратор, пропускаются (SKIP LOCKED) до
+# следующего запуска. После commit пересчитываются затронутые дни общей
+# таблицы занятости, школам с будущей датой уходит уведомление об отмене.
+import os
+from datetime import date
+from psycopg.rows import dict_row
+
+import db
+import metrics
+import notifications
+import shared_availability
+
+PENDING_EXPIRY_DAYS = int(os.environ.get('PENDING_EXPIRY_DAYS', 14))
+PENDING_EXPIRY_BATCH = int(os.environ.get('PENDING_EXPIRY_BATCH', 500))
+# Больше порций за один запуск не делаем - остаток заберет следующий
+PENDING_EXPIRY_MAX_BATCHES = int(os.environ.get('PENDING_EXPIRY_MAX_BATCHES', 20))
+PENDING_EXPIRY_INTERVAL_SECONDS = float(os.environ.get('PENDING_EXPIRY_INTERVAL_SECONDS', 3600))
+
+
+def expire_batch(cursor, max_age_days=None, limit=None):
+    """Отменяет порцию устаревших заявок в текущей транзакции (commit - у вызывающего).
+
+    cursor должен возвращать словари (dict_row). Возвращает отмененные
+    строки с полями notifications.BOOKING_FIELDS.
+    """
+    max_age_days = PENDING_EXPIRY_DAYS if max_age_days is None else max_age_days
+    conditions = ['excursion_date < CURRENT_DATE']
+    params = []
+    if max_age_days > 0:
+        conditions.append('booking_date < CURRENT_TIMESTAMP - make_interval(days => %s)')
+        params.append(max_age_days)
+
+    cursor.execute(f'''
+        UPDATE bookings SET status = 'cancelled', updated_at = CURRENT_TIMESTAMP
+        WHERE id IN (
+            SELECT id FROM bookings
+            WHERE status = 'pending' AND ({' OR '.join(conditions)})
+            ORDER BY id
+            LIMIT %s
+            FOR UPDATE SKIP LOCKED
+        )
+        AND status = 'pending'
+        RETURNING {notifications.BOOKING_FIELDS}
+    ''', (*params, limit or PENDING_EXPIRY_BATCH))
+    return cursor.fetchall()
+
+
+def sweep():
+    """Отменяет устаревшие заявки порциями (периодическая задача планировщика).
+
+    Возвращает количество отмененных записей.
+    """
+    total = 0
+    for _ in range(PENDING_EXPIRY_MAX_BATCHES):
+        conn = db.get_db_connection()
+        try:
+            cursor = conn.cursor(row_factory=dict_row)
+            expired = expire_batch(cursor)
+            # Уведомляем только о будущих экскурсиях - о прошедших школе сообщать незачем
+            today = date.today()
+            notifications.enqueue(cursor, 'status_changed',
+                                  [row for row in expired if row['excursion_date'] >= today])
+            conn.commit()
+            cursor.close()
+        finally:
+            conn.close()
+
+        if not expired:
+            break
+        total += len(expired)
+        past = sum(1 for row in expired if row['excursion_date'] < today)
+        metrics.inc('bookings_cancelled_total', len(expired))
+        if past:
+            metrics.inc('pending_expired_total', past, reason='past_date')
+        if len(expired) - past:
+            metrics.inc('pending_expired_total', len(expired) - past, reason='age')
+        shared_availability.update_days([row['excursion_date'] for row in expired])
+        notifications.wakeup()
+        if len(expired) < PENDING_EXPIRY_BATCH:
+            break
+
+    if total:
+        print(f"🧹 Автоматически отменено ожидающих заявок: {total}")
+    return total
@@ -1,6 +1,6 @@
 #!/bin/bash
 # Устанавливаем зависимости
-pip install Flask==2.3.3 gunicorn==21.2.0 psycopg[binary]==3.2.4
+pip install Flask==2.3.3 gunicorn==21.2.0 psycopg[binary,pool]==3.2.4
 
 # Или для SQLite:
 # pip install Flask==2.3.3 gunicorn==21.2.0
\ No newline at end of file
@@ -0,0 +1,203 @@
+# scheduler.py - Периодические задачи с одним лидером на все воркеры
+#
+# Планировщик запускается в каждом воркере gunicorn (post_fork), но задачи
+# выполняет только лидер - процесс, который держит сессионную advisory-
+# блокировку PostgreSQL на отдельном соединении. Остальные воркеры раз в
+# SCHEDULER_ELECTION_SECONDS проверяют, занята ли блокировка; если лидер
+# остановился (перезапуск по max_requests, падение, деплой), PostgreSQL
+# снимает блокировку вместе с его соединением и лидером становится
+# следующий воркер. Так же выбирается лидер между несколькими экземплярами
+# приложения.
+#
+# Задача - функция без аргументов. Следующий запуск - через interval с
+# разбросом SCHEDULER_JITTER, чтобы задачи не совпадали по времени. Если
+# функция бросила исключение, повтор идет раньше: через
+# SCHEDULER_RETRY_SECONDS, затем вдвое дольше на каждую следующую ошибку,
+# но не дольше interval.
+import os
+import time
+import random
+import threading
+import psycopg
+
+import db
+import metrics
+
+SCHEDULER_ENABLED = os.environ.get('SCHEDULER_ENABLED', '1') != '0'
+SCHEDULER_ELECTION_SECONDS = float(os.environ.get('SCHEDULER_ELECTION_SECONDS', 30))
+SCHEDULER_RETRY_SECONDS = float(os.environ.get('SCHEDULER_RETRY_SECONDS', 15))
+SCHEDULER_JITTER = float(os.environ.get('SCHEDULER_JITTER', 0.1))
+# Пространство ключей pg_advisory_lock для выбора лидера
+LOCK_NAMESPACE = 3803
+LOCK_KEY = 0
+
+# name -> Task
+_tasks = {}
+_thread = None
+_thread_pid = None
+_start_lock = threading.Lock()
+_stop = threading.Event()
+_leader_conn = None
+
+
+class Task:
+    """Периодическая задача и ее расписание"""
+
+    def __init__(self, name, func, interval, delay):
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.delay = delay
+        self.next_run = 0.0
+        self.failures = 0
+
+    def schedule(self, seconds):
+        spread = seconds * SCHEDULER_JITTER
+        self.next_run = time.monotonic() + max(0.0, seconds + random.uniform(-spread, spread))
+
+
+def register(name, func, interval, delay=None):
+    """Регистрирует периодическую задачу.
+
+    interval - секунды между запусками, delay - задержка первого запуска
+    после получения лидерства (по умолчанию - сразу).
+    """
+    _tasks[name] = Task(name, func, interval, delay or 0.0)
+
+
+def is_leader():
+    """Выполняет ли текущий процесс периодические задачи"""
+    return _leader_conn is not None
+
+
+def _lock_is_held():
+    """Занята ли блокировка лидера (запрос через пул, без своего соединения)"""
+    conn = db.get_db_connection()
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('''
+                SELECT EXISTS (
+                    SELECT 1 FROM pg_locks
+                    WHERE locktype = 'advisory' AND granted
+                      AND classid = %s AND objid = %s AND objsubid = 2
+                      AND database = (SELECT oid FROM pg_database WHERE datname = current_database())
+                )
+            ''', (LOCK_NAMESPACE, LOCK_KEY))
+            held = cursor.fetchone()[0]
+        conn.commit()
+        return held
+    finally:
+        conn.close()
+
+
+def _try_lead():
+    """Соединение, удерживающее блокировку лидера, или None"""
+    if _lock_is_held():
+        return None
+
+    conn = psycopg.connect(db.get_conninfo(), autocommit=True,
+                           application_name=f'tax_excursion_scheduler_{os.getpid()}')
+    try:
+        if conn.execute('SELECT pg_try_advisory_lock(%s, %s)', (LOCK_NAMESPACE, LOCK_KEY)).fetchone()[0]:
+            return conn
+    except Exception:
+        conn.close()
+        raise
+    conn.close()
+    return None
+
+
+def _alive(conn):
+    try:
+        conn.execute('SELECT 1')
+        return True
+    except psycopg.Error:
+        return False
+
+
+def _run(task):
+    started = time.perf_counter()
+    try:
+        task.func()
+    except Exception as e:
+        task.failures += 1
+        retry = min(task.interval, SCHEDULER_RETRY_SECONDS * 2 ** (task.failures - 1))
+        print(f"Ошибка периодической задачи {task.name} (попытка {task.failures}, повтор через {retry:.0f} с): {e}")
+        metrics.inc('scheduler_runs_total', task=task.name, outcome='error')
+        task.schedule(retry)
+    else:
+        task.failures = 0
+        metrics.inc('scheduler_runs_total', task=task.name, outcome='ok')
+        task.schedule(task.interval)
+    metrics.observe('scheduler_run_seconds', time.perf_counter() - started, task=task.name)
+    metrics.flush()
+
+
+def _release():
+    global _leader_conn
+    conn, _leader_conn = _leader_conn, None
+    if conn is not None:
+        try:
+            conn.close()
+        except Exception:
+            pass
+
+
+def _loop():
+    global _leader_conn
+    while not _stop.is_set():
+        if _leader_conn is None:
+            try:
+                _leader_conn = _try_lead()
+            except Exception as e:
+                print(f"Ошибка выбора лидера планировщика: {e}")
+            if _leader_conn is None:
+                # Разброс - чтобы воркеры не опрашивали блокировку одновременно
+                _stop.wait(SCHEDULER_ELECTION_SECONDS * random.uniform(0.5, 1.5))
+                continue
+            print(f"✅ Воркер {os.getpid()}: лидер планировщика ({', '.join(_tasks)})")
+            for task in _tasks.values():
+                task.failures = 0
+                task.schedule(task.delay)
+
+        # Соединение потеряно - блокировка снята, лидерство мог забрать другой
+        if not _alive(_leader_conn):
+            print(f"⚠️ Воркер {os.getpid()}: соединение лидера планировщика потеряно")
+            _release()
+            continue
+
+        for task in _tasks.values():
+            if _stop.is_set():
+                break
+            if task.next_run <= time.monotonic():
+                _run(task)
+
+        wait = min((task.next_run for task in _tasks.values()), default=time.monotonic() + SCHEDULER_ELECTION_SECONDS)
+        _stop.wait(min(SCHEDULER_ELECTION_SECONDS, max(0.1, wait - time.monotonic())))
+
+    _release()
+
+
+def start():
+    """Запускает поток планировщика в текущем процессе (один раз на воркер)"""
+    global _thread, _thread_pid
+    if not SCHEDULER_ENABLED or _thread_pid == os.getpid():
+        return
+    with _start_lock:
+        if _thread_pid == os.getpid():
+            return
+        _stop.clear()
+        _thread = threading.Thread(target=_loop, daemon=True, name='scheduler')
+        _thread.start()
+        _thread_pid = os.getpid()
+
+
+def stop(timeout=5):
+    """Останавливает планировщик и отдает лидерство (закрывает соединение)"""
+    global _thread_pid
+    if _thread_pid != os.getpid():
+        return
+    _stop.set()
+    if _thread is not None:
+        _thread.join(timeout)
+    _thread_pid = None
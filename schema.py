@@ -0,0 +1,77 @@
+# schema.py - Структура таблиц бронирований в одном месте
+#
+# bookings создается при старте приложения (init_database), при полном
+# сбросе (recreate_database) и в обоих путях database_fix.py. Раньше в
+# каждом месте был свой CREATE TABLE, и пересозданная таблица расходилась
+# с той, которую ждет код: без idempotency_key /submit_booking падал, а
+# индекс защиты от дублей пропадал. Теперь все пути создают таблицы через
+# create_bookings_table() / create_blocked_dates_table() и достраивают
+# зависящие объекты через ensure_schema().
+#
+# В BOOKINGS_TABLE_SQL - все колонки, которые добавляют модули
+# (ALTER TABLE ... ADD COLUMN IF NOT EXISTS для старых баз): мягкое
+# исправление в database_fix.py переносит данные по колонкам новой таблицы.
+import availability
+import capacity
+import delta_sync
+import export_cache
+import jobs
+import notifications
+import submission_guard
+
+BOOKINGS_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS bookings (
+        id SERIAL PRIMARY KEY,
+        username VARCHAR(100),
+        school_name VARCHAR(200) NOT NULL,
+        class_number VARCHAR(20) NOT NULL,
+        class_profile VARCHAR(100),
+        excursion_date DATE NOT NULL,
+        contact_phone VARCHAR(20) NOT NULL,
+        participants_count INTEGER NOT NULL,
+        booking_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        additional_info TEXT,
+        status VARCHAR(20) NOT NULL DEFAULT 'pending',
+        updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        time_slot VARCHAR(5),
+        idempotency_key UUID
+    )
+'''
+
+BLOCKED_DATES_TABLE_SQL = '''
+    CREATE TABLE IF NOT EXISTS blocked_dates (
+        id SERIAL PRIMARY KEY,
+        blocked_date DATE NOT NULL UNIQUE,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+'''
+
+
+def create_bookings_table(cursor):
+    """Таблица bookings (если ее нет)"""
+    cursor.execute(BOOKINGS_TABLE_SQL)
+
+
+def create_blocked_dates_table(cursor):
+    """Таблица заблокированных дат (если ее нет)"""
+    cursor.execute(BLOCKED_DATES_TABLE_SQL)
+
+
+def ensure_schema(cursor):
+    """Колонки, индексы, триггеры и служебные таблицы вокруг bookings (идемпотентно).
+
+    Вызывать после создания bookings, в той же транзакции.
+    """
+    # updated_at и журнал удалений для инкрементальной выгрузки
+    delta_sync.ensure_schema(cursor)
+    # Правила вместимости дней
+    capacity.ensure_schema(cursor)
+    # status NOT NULL и частичный индекс активных записей для календаря
+    availability.ensure_schema(cursor)
+    # Версия данных bookings для кэша файлов выгрузок
+    export_cache.ensure_schema(cursor)
+    # Лимит частоты заявок, ключ идемпотентности, защита от дублей
+    submission_guard.ensure_schema(cursor)
+    # Очередь фоновых задач и уведомлений
+    jobs.ensure_schema(cursor)
+    notifications.ensure_schema(cursor)
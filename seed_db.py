@@ -0,0 +1,348 @@
+# seed_db.py - Генератор реалистичных тестовых данных для PostgreSQL
+#
+# Заполняет bookings и blocked_dates записями, похожими на боевые:
+# школы, классы и профили, ФИО, телефоны, смесь статусов и сезонность
+# (пики осенью и весной, спад летом). Даты учитывают выходные, закрытые
+# правилами вместимости дни недели и лимит активных записей в день. Загрузка идет через
+# COPY, поэтому миллион записей вставляется примерно за минуту.
+#
+#   python seed_db.py --bookings 100000 --years 3 --blocked 20 --truncate
+#   python seed_db.py --bookings 1000000 --max-per-day auto --truncate
+import io
+import sys
+import math
+import random
+import argparse
+from datetime import date, datetime, timedelta
+
+import psycopg
+from psycopg.rows import dict_row
+
+import capacity
+import db
+
+# Лимит активных записей в день, как в приложении
+DEFAULT_MAX_PER_DAY = capacity.DEFAULT_SLOTS
+
+# Относительная загрузка по месяцам: пики в октябре-декабре и феврале-апреле
+SEASONAL_WEIGHTS = {
+    1: 0.6, 2: 1.2, 3: 1.4, 4: 1.3, 5: 0.8, 6: 0.2,
+    7: 0.05, 8: 0.1, 9: 0.9, 10: 1.4, 11: 1.5, 12: 1.1,
+}
+
+# Государственные праздники (месяц, день) - кандидаты в заблокированные даты
+HOLIDAYS = [(1, d) for d in range(1, 9)] + [(2, 23), (3, 8), (5, 1), (5, 9), (6, 12), (11, 4)]
+
+SURNAMES = [
+    'Иванов', 'Смирнов', 'Кузнецов', 'Попов', 'Васильев', 'Петров', 'Соколов', 'Михайлов',
+    'Новиков', 'Федоров', 'Морозов', 'Волков', 'Алексеев', 'Лебедев', 'Семенов', 'Егоров',
+    'Павлов', 'Козлов', 'Степанов', 'Николаев', 'Орлов', 'Андреев', 'Макаров', 'Никитин',
+    'Захаров', 'Зайцев', 'Соловьев', 'Борисов', 'Яковлев', 'Григорьев', 'Романов', 'Воробьев',
+]
+MALE_NAMES = ['Александр', 'Сергей', 'Дмитрий', 'Андрей', 'Алексей', 'Максим', 'Евгений', 'Игорь',
+              'Владимир', 'Николай', 'Павел', 'Олег']
+FEMALE_NAMES = ['Елена', 'Ольга', 'Наталья', 'Татьяна', 'Ирина', 'Светлана', 'Анна', 'Марина',
+                'Екатерина', 'Юлия', 'Людмила', 'Галина']
+PATRONYMICS = [
+    ('Александрович', 'Александровна'), ('Сергеевич', 'Сергеевна'), ('Владимирович', 'Владимировна'),
+    ('Николаевич', 'Николаевна'), ('Иванович', 'Ивановна'), ('Петрович', 'Петровна'),
+    ('Михайлович', 'Михайловна'), ('Андреевич', 'Андреевна'), ('Викторович', 'Викторовна'),
+    ('Юрьевич', 'Юрьевна'),
+]
+
+SCHOOL_TEMPLATES = [
+    ('МБОУ СОШ №{n}', 40), ('Школа №{n}', 25), ('Гимназия №{n}', 12), ('Лицей №{n}', 10),
+    ('МАОУ «Лицей №{n}»', 5), ('МБОУ «Гимназия №{n}»', 5), ('Кадетская школа №{n}', 3),
+]
+NAMED_SCHOOLS = [
+    'Гимназия имени А.С. Пушкина', 'Лицей имени Н.И. Лобачевского', 'Школа имени М.В. Ломоносова',
+    'Президентский физико-математический лицей', 'Экономический лицей', 'Гимназия «Логос»',
+]
+CLASS_LETTERS = 'АБВГД'
+# Налоговые экскурсии чаще заказывают старшие классы
+GRADE_WEIGHTS = {5: 2, 6: 2, 7: 3, 8: 6, 9: 12, 10: 16, 11: 14}
+CLASS_PROFILES = [
+    ('', 40), ('Универсальный', 12), ('Социально-экономический', 14), ('Экономический', 10),
+    ('Физмат', 8), ('Гуманитарный', 6), ('Информационно-технологический', 5), ('Химбио', 5),
+]
+ADDITIONAL_INFO = [
+    ('', 70), ('Нужна лекция о налоговой грамотности', 6), ('Будут два сопровождающих', 6),
+    ('Просим начать не раньше 10:00', 5), ('Есть ученики с ОВЗ', 2),
+    ('Интересует тема самозанятости', 5), ('Приедем на школьном автобусе', 6),
+]
+
+COLUMNS = ('username', 'school_name', 'class_number', 'class_profile', 'excursion_date',
+           'contact_phone', 'participants_count', 'booking_date', 'additional_info', 'status')
+
+
+def _weighted(pairs):
+    values, weights = zip(*pairs)
+    return list(values), list(weights)
+
+
+def eligible_days(start, end, closed_weekdays, blocked=()):
+    """Будние дни, в которые можно записаться (без закрытых и заблокированных)"""
+    days = []
+    day = start
+    while day <= end:
+        if day.weekday() < 5 and day.weekday() not in closed_weekdays and day not in blocked:
+            days.append(day)
+        day += timedelta(days=1)
+    return days
+
+
+def fit_max_per_day(active_count, days_count, utilization=0.8):
+    """Минимальный лимит в день, при котором активные записи помещаются в диапазон"""
+    if days_count == 0:
+        return DEFAULT_MAX_PER_DAY
+    return max(DEFAULT_MAX_PER_DAY, math.ceil(active_count / (days_count * utilization)))
+
+
+def pick_blocked_dates(rng, start, end, count, closed_weekdays):
+    """Праздники в диапазоне плюс случайные рабочие дни (каникулы, санитарные дни)"""
+    blocked = set()
+    for year in range(start.year, end.year + 1):
+        for month, day in HOLIDAYS:
+            holiday = date(year, month, day)
+            if start <= holiday <= end and holiday.weekday() < 5 and holiday.weekday() not in closed_weekdays:
+                blocked.add(holiday)
+
+    candidates = eligible_days(start, end, closed_weekdays, blocked)
+    rng.shuffle(candidates)
+    blocked.update(candidates[:max(0, count - len(blocked))])
+    return blocked
+
+
+class BookingGenerator:
+    """Генерирует строки bookings с учетом сезонности и лимита в день"""
+
+    def __init__(self, rng, days, max_per_day, cancelled_share=0.12, today=None):
+        self.rng = rng
+        self.days = days
+        self.max_per_day = max_per_day
+        self.cancelled_share = cancelled_share
+        self.today = today or date.today()
+        self.now = datetime.now()
+
+        weights = [SEASONAL_WEIGHTS[day.month] for day in days]
+        self.cum_weights = []
+        total = 0.0
+        for weight in weights:
+            total += weight
+            self.cum_weights.append(total)
+
+        self.day_counts = [0] * len(days)
+        # Класс школы на дату (активные записи) - как уникальный индекс в bookings
+        self.day_classes = {}
+        self.school_numbers = list(range(1, 400))
+        self.grades, self.grade_weights = _weighted(GRADE_WEIGHTS.items())
+        self.profiles, self.profile_weights = _weighted(CLASS_PROFILES)
+        self.infos, self.info_weights = _weighted(ADDITIONAL_INFO)
+        self.school_templates, self.school_weights = _weighted(SCHOOL_TEMPLATES)
+
+    def _pick_day(self, active):
+        """Индекс дня по сезонным весам; активные записи не превышают лимит"""
+        rng = self.rng
+        for _ in range(50):
+            index = rng.choices(range(len(self.days)), cum_weights=self.cum_weights)[0]
+            if not active or self.day_counts[index] < self.max_per_day:
+                break
+        else:
+            # Пиковые дни заполнены - берем первый свободный день
+            index = next(i for i, c in enumerate(self.day_counts) if c < self.max_per_day)
+
+        if active:
+            self.day_counts[index] += 1
+        return index
+
+    def _school_class(self, day_index, active):
+        """Школа и класс; активная запись не повторяет класс, уже записанный на дату"""
+        rng = self.rng
+        taken = self.day_classes.setdefault(day_index, set()) if active else set()
+        while True:
+            grade = rng.choices(self.grades, weights=self.grade_weights)[0]
+            school, class_number = self._school(), f'{grade}{rng.choice(CLASS_LETTERS)}'
+            key = hash((school.lower(), class_number.lower()))
+            if key not in taken:
+                if active:
+                    taken.add(key)
+                return school, class_number
+
+    def _person(self):
+        rng = self.rng
+        surname = rng.choice(SURNAMES)
+        male_patronymic, female_patronymic = rng.choice(PATRONYMICS)
+        if rng.random() < 0.8:
+            # Среди учителей больше женщин
+            return f'{surname}а {rng.choice(FEMALE_NAMES)} {female_patronymic}'
+        return f'{surname} {rng.choice(MALE_NAMES)} {male_patronymic}'
+
+    def _school(self):
+        rng = self.rng
+        if rng.random() < 0.05:
+            return rng.choice(NAMED_SCHOOLS)
+        template = rng.choices(self.school_templates, weights=self.school_weights)[0]
+        return template.format(n=rng.choice(self.school_numbers))
+
+    def _active_status(self, excursion_date):
+        # Прошедшие экскурсии почти все подтверждены, будущие - вперемешку
+        if excursion_date < self.today:
+            return 'confirmed' if self.rng.random() < 0.95 else 'pending'
+        return 'confirmed' if self.rng.random() < 0.55 else 'pending'
+
+    def row(self):
+        rng = self.rng
+        # Отмененные записи не занимают место и не ограничены лимитом
+        active = rng.random() >= self.cancelled_share
+        day_index = self._pick_day(active)
+        excursion_date = self.days[day_index]
+        status = self._active_status(excursion_date) if active else 'cancelled'
+
+        lead_days = rng.randint(3, 60)
+        booking_date = datetime.combine(excursion_date - timedelta(days=lead_days), datetime.min.time())
+        booking_date += timedelta(hours=rng.randint(8, 19), minutes=rng.randint(0, 59))
+        if booking_date > self.now:
+            booking_date = self.now - timedelta(minutes=rng.randint(1, 600))
+
+        school, class_number = self._school_class(day_index, active)
+        return (
+            self._person(),
+            school,
+            class_number,
+            rng.choices(self.profiles, weights=self.profile_weights)[0],
+            excursion_date.isoformat(),
+            f'+79{rng.randint(0, 999999999):09d}',
+            str(max(5, min(35, int(rng.gauss(22, 5))))),
+            booking_date.strftime('%Y-%m-%d %H:%M:%S'),
+            rng.choices(self.infos, weights=self.info_weights)[0],
+            status,
+        )
+
+
+def _copy_line(values):
+    """Строка формата COPY text (экранирование \\, табуляции и переводов строк)"""
+    return '\t'.join(
+        value.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+        for value in values
+    ) + '\n'
+
+
+def seed(conn, bookings, years=3, future_days=180, max_per_day=DEFAULT_MAX_PER_DAY,
+         blocked=10, cancelled_share=0.12, truncate=False, random_seed=None, batch_size=50000,
+         closed_weekdays=None, progress=None):
+    """Загружает синтетические данные через COPY. Возвращает словарь со статистикой.
+
+    max_per_day='auto' подбирает лимит так, чтобы записи уместились в диапазон дат.
+    """
+    if closed_weekdays is None:
+        with conn.cursor(row_factory=dict_row) as cursor:
+            closed_weekdays = capacity.load(cursor).closed_weekdays()
+
+    rng = random.Random(random_seed)
+    today = date.today()
+    start = today - timedelta(days=int(365 * years))
+    end = today + timedelta(days=future_days)
+
+    blocked_dates = pick_blocked_dates(rng, start, end, blocked, closed_weekdays) if blocked else set()
+    days = eligible_days(start, end, closed_weekdays, blocked_dates)
+
+    active_count = int(bookings * (1 - cancelled_share))
+    if max_per_day == 'auto':
+        max_per_day = fit_max_per_day(active_count, len(days))
+    if active_count > len(days) * max_per_day:
+        raise ValueError(
+            f'{active_count} активных записей не помещаются в {len(days)} дней по {max_per_day} в день: '
+            f'увеличьте --years или --max-per-day'
+        )
+
+    generator = BookingGenerator(rng, days, max_per_day, cancelled_share, today)
+
+    with conn.cursor() as cursor:
+        if truncate:
+            cursor.execute('TRUNCATE bookings, blocked_dates RESTART IDENTITY')
+
+        if blocked_dates:
+            cursor.executemany(
+                'INSERT INTO blocked_dates (blocked_date) VALUES (%s) ON CONFLICT DO NOTHING',
+                [(d,) for d in sorted(blocked_dates)]
+            )
+
+        written = 0
+        with cursor.copy(f"COPY bookings ({', '.join(COLUMNS)}) FROM STDIN") as copy:
+            while written < bookings:
+                size = min(batch_size, bookings - written)
+                buffer = io.StringIO()
+                for _ in range(size):
+                    buffer.write(_copy_line(generator.row()))
+                copy.write(buffer.getvalue())
+                written += size
+                if progress:
+                    progress(written, bookings)
+
+    conn.commit()
+
+    # VACUUM заполняет карту видимости: без нее index-only scan по
+    # частичному индексу активных записей ходит в таблицу за каждой строкой
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        with conn.cursor() as cursor:
+            cursor.execute('VACUUM (ANALYZE) bookings')
+            cursor.execute('VACUUM (ANALYZE) blocked_dates')
+    finally:
+        conn.autocommit = autocommit
+
+    return {
+        'bookings': written,
+        'blocked_dates': len(blocked_dates),
+        'days': len(days),
+        'max_per_day': max_per_day,
+        'date_from': start.isoformat(),
+        'date_to': end.isoformat(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Заполнение БД реалистичными тестовыми записями')
+    parser.add_argument('--bookings', type=int, default=1000, help='Количество записей')
+    parser.add_argument('--years', type=float, default=3, help='Глубина истории в годах')
+    parser.add_argument('--future-days', type=int, default=180, help='Горизонт будущих записей в днях')
+    parser.add_argument('--max-per-day', default=str(DEFAULT_MAX_PER_DAY),
+                        help='Лимит активных записей в день или "auto" для больших объемов')
+    parser.add_argument('--blocked', type=int, default=10, help='Количество заблокированных дат')
+    parser.add_argument('--cancelled-share', type=float, default=0.12, help='Доля отмененных записей')
+    parser.add_argument('--truncate', action='store_true', help='Очистить таблицы перед загрузкой')
+    parser.add_argument('--seed', type=int, default=None, help='Seed генератора для воспроизводимости')
+    args = parser.parse_args()
+
+    max_per_day = args.max_per_day if args.max_per_day == 'auto' else int(args.max_per_day)
+
+    from app import init_database
+    init_database()
+
+    def progress(done, total):
+        print(f"\r   загружено {done}/{total}", end='', flush=True)
+
+    started = datetime.now()
+    with psycopg.connect(db.get_conninfo()) as conn:
+        try:
+            stats = seed(conn, args.bookings, years=args.years, future_days=args.future_days,
+                         max_per_day=max_per_day, blocked=args.blocked,
+                         cancelled_share=args.cancelled_share, truncate=args.truncate,
+                         random_seed=args.seed, progress=progress)
+        except ValueError as e:
+            print(f"❌ {e}")
+            return 1
+
+    elapsed = (datetime.now() - started).total_seconds()
+    print()
+    print(f"✅ Загружено записей: {stats['bookings']} за {elapsed:.1f} с "
+          f"({stats['bookings'] / elapsed * 60:,.0f} в минуту)")
+    print(f"✅ Заблокированных дат: {stats['blocked_dates']}")
+    print(f"   Диапазон: {stats['date_from']} - {stats['date_to']}, "
+          f"{stats['days']} рабочих дней, до {stats['max_per_day']} записей в день")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
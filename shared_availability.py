@@ -0,0 +1,268 @@
+# shared_availability.py - Занятость дней в общей памяти всех воркеров gunicorn
+#
+# Мастер до fork создает анонимный mmap (MAP_SHARED) и заполняет его из
+# PostgreSQL: для каждого дня окна (с начала текущего месяца на
+# SHARED_AVAILABILITY_MONTHS месяцев вперед) - число активных записей,
+# участников и флаг блокировки. Воркеры наследуют отображение, поэтому
+# таблица одна на весь сервер, в том числе для перезапущенных воркеров.
+#
+# Чтение - срез memoryview без системных вызовов и запросов к БД.
+# Согласованность обеспечивает счетчик версии (seqlock): писатель делает его
+# нечетным на время записи, читатель повторяет чтение, если версия изменилась.
+# Писатели (пути записи в app.py) после commit пересчитывают затронутые дни
+# под межпроцессной блокировкой (flock файла: ее снимает ядро, даже если
+# воркер убит посреди записи). Изменения в обход приложения (seed_db.py,
+# ручные запросы) подхватываются полной перестройкой раз в
+# SHARED_AVAILABILITY_REBUILD_SECONDS. Дни вне окна и ненаполненная таблица -
+# повод вернуть None: вызывающий идет в БД, как раньше.
+import os
+import mmap
+import time
+import fcntl
+import struct
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import date, timedelta
+
+import availability
+import db
+
+SHARED_AVAILABILITY_MONTHS = int(os.environ.get('SHARED_AVAILABILITY_MONTHS', 6))
+SHARED_AVAILABILITY_REBUILD_SECONDS = float(os.environ.get('SHARED_AVAILABILITY_REBUILD_SECONDS', 3600))
+# Сколько раз читатель повторяет чтение, пока идет запись
+READ_RETRIES = 100
+
+# Дней в окне: текущий месяц и SHARED_AVAILABILITY_MONTHS следующих
+WINDOW_DAYS = (SHARED_AVAILABILITY_MONTHS + 1) * 31
+
+# Заголовок: версия (seqlock), порядковый номер первого дня, дней в окне,
+# время построения (time.time(), 0 - таблица не построена)
+_HEADER = struct.Struct('<qqqd')
+_SEQ = struct.Struct('<q')
+
+_table = None
+_create_lock = threading.Lock()
+_rebuilding = threading.Lock()
+# Файл блокировки открывается в каждом процессе свой: flock на общем
+# (унаследованном) дескрипторе процессы друг от друга не защищает
+_lock_file = None
+_lock_file_pid = None
+_thread_lock = threading.Lock()
+
+
+class _Table:
+    """Отображение и представления его частей"""
+
+    def __init__(self, days):
+        size = _HEADER.size + days * 9
+        self.mm = mmap.mmap(-1, size)
+        self.capacity = days
+        offset = _HEADER.size
+        view = memoryview(self.mm)
+        self.bookings = view[offset:offset + days * 4].cast('I')
+        offset += days * 4
+        self.participants = view[offset:offset + days * 4].cast('I')
+        offset += days * 4
+        self.blocked = view[offset:offset + days].cast('B')
+        self.lock_path = os.path.join(tempfile.gettempdir(), f'tax_excursion_availability.{os.getpid()}.lock')
+
+
+def create():
+    """Создает таблицу в текущем процессе (мастер gunicorn - до fork)"""
+    global _table
+    with _create_lock:
+        if _table is None:
+            _table = _Table(WINDOW_DAYS)
+        return _table
+
+
+@contextmanager
+def _write_lock(table):
+    """Блокировка писателей: между потоками процесса и между процессами"""
+    global _lock_file, _lock_file_pid
+    with _thread_lock:
+        if _lock_file is None or _lock_file_pid != os.getpid():
+            _lock_file = open(table.lock_path, 'a')
+            _lock_file_pid = os.getpid()
+        fcntl.flock(_lock_file, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(_lock_file, fcntl.LOCK_UN)
+
+
+def _get_table():
+    # Без gunicorn (flask run) таблица создается в процессе при первом обращении
+    return _table if _table is not None else create()
+
+
+def _window_start(today=None):
+    today = today or date.today()
+    return today.replace(day=1)
+
+
+def _load(cursor, start, days):
+    cursor.execute(f'''
+        SELECT d::date AS day,
+               COALESCE(load.bookings, 0),
+               COALESCE(load.participants, 0),
+               EXISTS (SELECT 1 FROM blocked_dates WHERE blocked_date = d::date)
+        FROM generate_series(%(start)s::date, %(end)s::date, INTERVAL '1 day') AS d
+        LEFT JOIN ({availability.LOAD_SQL}) AS load ON load.excursion_date = d::date
+        ORDER BY d
+    ''', {'start': start, 'end': start + timedelta(days=days - 1)})
+    return cursor.fetchall()
+
+
+def _load_days(cursor, days):
+    cursor.execute('''
+        SELECT d AS day,
+               (SELECT COUNT(*) FROM bookings
+                WHERE excursion_date = d AND status != 'cancelled'),
+               (SELECT COALESCE(SUM(participants_count), 0) FROM bookings
+                WHERE excursion_date = d AND status != 'cancelled'),
+               EXISTS (SELECT 1 FROM blocked_dates WHERE blocked_date = d)
+        FROM unnest(%s::date[]) AS d
+    ''', (sorted(set(days)),))
+    return cursor.fetchall()
+
+
+def _begin_write(table):
+    """Делает версию нечетной; возвращает версию после записи"""
+    seq = _HEADER.unpack_from(table.mm, 0)[0]
+    # Нечетная версия остается, если писатель был убит посреди записи
+    seq = seq + 1 if seq % 2 == 0 else seq + 2
+    _SEQ.pack_into(table.mm, 0, seq)
+    return seq + 1
+
+
+def _write_rows(table, base, rows):
+    for day, bookings, participants, blocked in rows:
+        i = day.toordinal() - base
+        if 0 <= i < table.capacity:
+            table.bookings[i] = bookings
+            table.participants[i] = participants
+            table.blocked[i] = 1 if blocked else 0
+
+
+def rebuild(conn=None):
+    """Полностью перестраивает таблицу из PostgreSQL.
+
+    conn - соединение вызывающего (мастер gunicorn не открывает пул до fork),
+    иначе берется соединение из пула воркера.
+    """
+    table = _get_table()
+    start = _window_start()
+    with _write_lock(table):
+        own = conn is None
+        if own:
+            conn = db.get_db_connection()
+        try:
+            with conn.cursor() as cursor:
+                rows = _load(cursor, start, table.capacity)
+            conn.commit()
+        finally:
+            if own:
+                conn.close()
+
+        seq = _begin_write(table)
+        _write_rows(table, start.toordinal(), rows)
+        _HEADER.pack_into(table.mm, 0, seq, start.toordinal(), table.capacity, time.time())
+    return len(rows)
+
+
+def update_days(days):
+    """Пересчитывает дни после изменения записей или блокировок (вызывать после commit).
+
+    Запрос выполняется под блокировкой писателей, поэтому в таблице
+    остается результат последнего по времени пересчета.
+    """
+    table = _table
+    if table is None or not days:
+        return
+    with _write_lock(table):
+        _, base, size, built_at = _HEADER.unpack_from(table.mm, 0)
+        if not built_at:
+            return
+        days = [day for day in days if 0 <= day.toordinal() - base < size]
+        if not days:
+            return
+        conn = db.get_db_connection()
+        try:
+            with conn.cursor() as cursor:
+                rows = _load_days(cursor, days)
+            conn.commit()
+        finally:
+            conn.close()
+
+        seq = _begin_write(table)
+        _write_rows(table, base, rows)
+        _SEQ.pack_into(table.mm, 0, seq)
+
+
+def invalidate():
+    """Помечает таблицу непостроенной: до перестройки чтение идет в БД"""
+    table = _table
+    if table is None:
+        return
+    with _write_lock(table):
+        seq = _begin_write(table)
+        _HEADER.pack_into(table.mm, 0, seq, 0, 0, 0.0)
+    _rebuild_in_background()
+
+
+def _rebuild_in_background():
+    if not _rebuilding.acquire(blocking=False):
+        return
+
+    def run():
+        try:
+            rebuild()
+        except Exception as e:
+            print(f"Ошибка построения общей таблицы занятости: {e}")
+        finally:
+            _rebuilding.release()
+
+    threading.Thread(target=run, daemon=True, name='shared-availability-rebuild').start()
+
+
+def read_range(start, end):
+    """[(записей, участников, заблокирован)] по дням с start по end или None.
+
+    None - таблица не построена, устарела или период выходит за окно.
+    """
+    table = _get_table()
+    for _ in range(READ_RETRIES):
+        seq, base, size, built_at = _HEADER.unpack_from(table.mm, 0)
+        if seq & 1:
+            # Идет запись - она короткая
+            time.sleep(0.0001)
+            continue
+        if not built_at:
+            break
+        if (time.time() - built_at > SHARED_AVAILABILITY_REBUILD_SECONDS
+                or base != _window_start().toordinal()):
+            break
+        first = start.toordinal() - base
+        last = end.toordinal() - base
+        if first < 0 or last >= size or last < first:
+            return None
+        rows = list(zip(
+            table.bookings[first:last + 1].tolist(),
+            table.participants[first:last + 1].tolist(),
+            [flag == 1 for flag in table.blocked[first:last + 1].tolist()],
+        ))
+        if _SEQ.unpack_from(table.mm, 0)[0] == seq:
+            return rows
+
+    # Таблица пуста, устарела или запись не закончилась (писатель убит):
+    # перестраиваем в фоне, а пока - БД
+    _rebuild_in_background()
+    return None
+
+
+def read_day(day):
+    """(записей, участников, заблокирован) на дату или None"""
+    rows = read_range(day, day)
+    return rows[0] if rows else None
@@ -0,0 +1,139 @@
+# slow_queries.py - Журнал медленных SQL-запросов с планами EXPLAIN
+#
+# Включается переменной SLOW_QUERY_MS (порог в миллисекундах). Планы
+# EXPLAIN (ANALYZE, BUFFERS) снимаются в отдельном потоке на собственном
+# соединении, поэтому запрос пользователя не ждет их.
+import os
+import re
+import time
+import queue
+import threading
+import psycopg
+from psycopg.sql import SQL, Composable
+
+import db
+import metrics
+
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 0))
+SLOW_QUERY_EXPLAIN = os.environ.get('SLOW_QUERY_EXPLAIN', 'true').lower() == 'true'
+# Один и тот же запрос объясняем не чаще, чем раз в N секунд
+SLOW_QUERY_EXPLAIN_INTERVAL = float(os.environ.get('SLOW_QUERY_EXPLAIN_INTERVAL', 600))
+SLOW_QUERY_EXPLAIN_TIMEOUT_MS = int(os.environ.get('SLOW_QUERY_EXPLAIN_TIMEOUT_MS', 30000))
+
+_explain_queue = queue.Queue(maxsize=100)
+_explained_at = {}
+_worker_pid = None
+_worker_lock = threading.Lock()
+
+_STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+_NUMBER_LITERAL = re.compile(r'\b\d+(?:\.\d+)?\b')
+_WHITESPACE = re.compile(r'\s+')
+
+
+def normalize_sql(query):
+    """SQL без литералов и лишних пробелов - одинаковый для одинаковых запросов"""
+    if isinstance(query, str):
+        sql = query
+    elif isinstance(query, Composable):
+        sql = query.as_string(None)
+    else:
+        sql = repr(query)
+    sql = _STRING_LITERAL.sub('?', sql)
+    sql = _NUMBER_LITERAL.sub('?', sql)
+    return _WHITESPACE.sub(' ', sql).strip()
+
+
+def params_shape(params):
+    """Типы параметров без значений (в параметрах бывают телефоны и ФИО)"""
+    if params is None:
+        return '()'
+    if isinstance(params, dict):
+        return '{' + ', '.join(f'{k}: {type(v).__name__}' for k, v in params.items()) + '}'
+    return '(' + ', '.join(type(v).__name__ for v in params) + ')'
+
+
+def _is_explainable(sql):
+    """EXPLAIN ANALYZE выполняет запрос, поэтому берем только чтение"""
+    head = sql.lstrip('( ').split(' ', 1)[0].upper()
+    return head in ('SELECT', 'WITH') and not re.search(r'\b(INSERT|UPDATE|DELETE)\b', sql, re.IGNORECASE)
+
+
+def _on_query(query, params, duration):
+    duration_ms = duration * 1000
+    if duration_ms < SLOW_QUERY_MS:
+        return
+
+    sql = normalize_sql(query)
+    if sql.upper().startswith('EXPLAIN'):
+        return
+
+    shape = params_shape(params)
+    metrics.inc('slow_queries_total')
+    print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] 🐢 Медленный запрос {duration_ms:.0f} мс "
+          f"params={shape}: {sql}")
+
+    if not SLOW_QUERY_EXPLAIN or not _is_explainable(sql):
+        return
+
+    key = (sql, shape)
+    now = time.monotonic()
+    if len(_explained_at) > 1000:
+        _explained_at.clear()
+    if now - _explained_at.get(key, -SLOW_QUERY_EXPLAIN_INTERVAL) < SLOW_QUERY_EXPLAIN_INTERVAL:
+        return
+    _explained_at[key] = now
+
+    _ensure_worker()
+    try:
+        _explain_queue.put_nowait((query, params, sql, shape))
+    except queue.Full:
+        pass
+
+
+def _explain_worker():
+    """Снимает планы медленных запросов на отдельном соединении"""
+    conn = None
+    while True:
+        query, params, sql, shape = _explain_queue.get()
+        try:
+            if conn is None or conn.closed:
+                # Отдельное соединение вне пула: не отнимаем соединения у запросов
+                conn = psycopg.connect(db.get_conninfo())
+
+            with conn.cursor() as cursor:
+                cursor.execute(f"SET LOCAL statement_timeout = {SLOW_QUERY_EXPLAIN_TIMEOUT_MS}")
+                # Composed (psycopg.sql) не склеивается f-строкой - собираем через SQL
+                if isinstance(query, Composable):
+                    cursor.execute(SQL('EXPLAIN (ANALYZE, BUFFERS) ') + query, params)
+                else:
+                    cursor.execute(f'EXPLAIN (ANALYZE, BUFFERS) {query}', params)
+                plan = '\n'.join(row[0] for row in cursor.fetchall())
+            conn.rollback()
+
+            print(f"[{time.strftime('%Y-%m-%d %H:%M:%S')}] 📋 План медленного запроса "
+                  f"params={shape}: {sql}\n{plan}")
+        except Exception as e:
+            print(f"Ошибка EXPLAIN медленного запроса: {e}")
+            if conn is not None and not conn.closed:
+                try:
+                    conn.rollback()
+                except psycopg.Error:
+                    conn.close()
+
+
+def _ensure_worker():
+    """Запускает поток EXPLAIN в текущем процессе (один на воркер)"""
+    global _worker_pid
+    if _worker_pid == os.getpid():
+        return
+    with _worker_lock:
+        if _worker_pid != os.getpid():
+            threading.Thread(target=_explain_worker, daemon=True, name='slow-query-explain').start()
+            _worker_pid = os.getpid()
+
+
+def init():
+    """Подключает журнал медленных запросов, если задан SLOW_QUERY_MS"""
+    if SLOW_QUERY_MS > 0:
+        db.add_query_listener(_on_query)
+        print(f"✅ Журнал медленных запросов включен (порог {SLOW_QUERY_MS:.0f} мс)")
@@ -0,0 +1,123 @@
+# submission_guard.py - Защита /submit_booking от повторов и потока заявок
+#
+# Три уровня, все на состоянии в PostgreSQL, поэтому работают сразу для
+# всех воркеров gunicorn:
+#   1. Token bucket на IP и на сессию: одна строка rate_limits на ключ,
+#      пополнение и списание жетона - один атомарный UPSERT.
+#   2. Ключ идемпотентности из формы booking.html: повторная отправка той же
+#      формы (двойной клик, обновление страницы) не создает вторую запись.
+#   3. Уникальный частичный индекс: одна активная запись класса школы на дату.
+import os
+import time
+import uuid
+
+from flask import request, session
+
+# Жетонов в корзине (сколько заявок можно отправить подряд)
+RATE_LIMIT_BURST = float(os.environ.get('RATE_LIMIT_BURST', 5))
+# Пополнение: жетонов в минуту
+RATE_LIMIT_PER_MINUTE = float(os.environ.get('RATE_LIMIT_PER_MINUTE', 2))
+# Сколько прокси перед приложением добавляют X-Forwarded-For (Render - один)
+RATE_LIMIT_PROXY_HOPS = int(os.environ.get('RATE_LIMIT_PROXY_HOPS', 1))
+
+DUPLICATE_INDEX = 'idx_bookings_active_unique'
+
+_last_cleanup = 0.0
+
+
+def ensure_schema(cursor):
+    """Таблица корзин, ключ идемпотентности и индекс от дублей (идемпотентно)"""
+    cursor.execute('''
+        CREATE UNLOGGED TABLE IF NOT EXISTS rate_limits (
+            key VARCHAR(200) PRIMARY KEY,
+            tokens DOUBLE PRECISION NOT NULL,
+            updated_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+        )
+    ''')
+    cursor.execute('ALTER TABLE bookings ADD COLUMN IF NOT EXISTS idempotency_key UUID')
+    cursor.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_bookings_idempotency_key ON bookings(idempotency_key)')
+
+    # В старых данных дубли могут уже быть - тогда индекс не создастся,
+    # но остальная схема должна примениться
+    cursor.execute('SAVEPOINT duplicate_index')
+    try:
+        cursor.execute(f'''
+            CREATE UNIQUE INDEX IF NOT EXISTS {DUPLICATE_INDEX}
+            ON bookings (excursion_date, lower(btrim(school_name)), lower(btrim(class_number)))
+            WHERE status IS DISTINCT FROM 'cancelled'
+        ''')
+        cursor.execute('RELEASE SAVEPOINT duplicate_index')
+    except Exception as e:
+        cursor.execute('ROLLBACK TO SAVEPOINT duplicate_index')
+        print(f"⚠️ Индекс от дублей записей не создан (в данных есть дубли): {e}")
+
+
+def client_ip():
+    """IP клиента с учетом прокси Render"""
+    forwarded = [part.strip() for part in request.headers.get('X-Forwarded-For', '').split(',') if part.strip()]
+    if forwarded and RATE_LIMIT_PROXY_HOPS > 0:
+        return forwarded[-min(RATE_LIMIT_PROXY_HOPS, len(forwarded))]
+    return request.remote_addr or 'unknown'
+
+
+def client_keys():
+    """Ключи корзин запроса: IP и сессия"""
+    if 'client_id' not in session:
+        session['client_id'] = uuid.uuid4().hex
+    return [f'submit:ip:{client_ip()}', f"submit:session:{session['client_id']}"]
+
+
+def take_token(cursor, key):
+    """Списывает жетон из корзины key. False - корзина пуста.
+
+    Пополнение считается по времени с прошлого списания прямо в UPSERT,
+    поэтому параллельные воркеры не теряют и не удваивают жетоны.
+    """
+    rate = RATE_LIMIT_PER_MINUTE / 60
+    cursor.execute('''
+        INSERT INTO rate_limits AS bucket (key, tokens, updated_at)
+        VALUES (%(key)s, %(burst)s - 1, clock_timestamp())
+        ON CONFLICT (key) DO UPDATE SET
+            tokens = LEAST(%(burst)s, bucket.tokens
+                           + EXTRACT(EPOCH FROM clock_timestamp() - bucket.updated_at) * %(rate)s) - 1,
+            updated_at = clock_timestamp()
+        WHERE LEAST(%(burst)s, bucket.tokens
+                    + EXTRACT(EPOCH FROM clock_timestamp() - bucket.updated_at) * %(rate)s) >= 1
+        RETURNING tokens
+    ''', {'key': key, 'burst': RATE_LIMIT_BURST, 'rate': rate})
+    return cursor.fetchone() is not None
+
+
+def allow(cursor, keys):
+    """Проверяет все корзины запроса; очищает давно полные корзины"""
+    global _last_cleanup
+    allowed = all([take_token(cursor, key) for key in keys])
+
+    # Корзина, не тронутая дольше времени полного пополнения, снова полна -
+    # строка не нужна
+    now = time.monotonic()
+    if now - _last_cleanup > 600 and RATE_LIMIT_PER_MINUTE > 0:
+        _last_cleanup = now
+        cursor.execute('''
+            DELETE FROM rate_limits
+            WHERE updated_at < clock_timestamp() - make_interval(secs => %s)
+        ''', (RATE_LIMIT_BURST / (RATE_LIMIT_PER_MINUTE / 60),))
+    return allowed
+
+
+def new_idempotency_key():
+    return str(uuid.uuid4())
+
+
+def parse_idempotency_key(value):
+    """Ключ из формы; некорректный или пустой - None (проверка только на дубли)"""
+    try:
+        return str(uuid.UUID(value)) if value else None
+    except ValueError:
+        return None
+
+
+def is_duplicate_error(error):
+    """Нарушение индекса "одна активная запись класса на дату" """
+    diag = getattr(error, 'diag', None)
+    return diag is not None and diag.constraint_name == DUPLICATE_INDEX
@@ -0,0 +1,54 @@
+from datetime import date
+
+from blocked_index import BlockedDateIndex
+
+DAYS = [date(2026, 3, 2), date(2026, 3, 8), date(2026, 4, 1)]
+
+
+def test_contains_and_len():
+    index = BlockedDateIndex(DAYS)
+    assert len(index) == 3
+    assert all(day in index for day in DAYS)
+    assert date(2026, 3, 3) not in index
+    # Дни до начала карты
+    assert date(2026, 3, 1) not in index
+    assert date(2020, 1, 1) not in index
+
+
+def test_in_range():
+    index = BlockedDateIndex(DAYS)
+    assert index.in_range(date(2026, 1, 1), date(2026, 12, 31)) == DAYS
+    # Границы включаются
+    assert index.in_range(date(2026, 3, 2), date(2026, 3, 8)) == DAYS[:2]
+    assert index.in_range(date(2026, 3, 3), date(2026, 3, 31)) == [date(2026, 3, 8)]
+    assert index.in_range(date(2026, 3, 9), date(2026, 3, 31)) == []
+    # Пустой и перевернутый периоды
+    assert index.in_range(date(2026, 3, 8), date(2026, 3, 2)) == []
+    assert BlockedDateIndex().in_range(date(2026, 1, 1), date(2026, 12, 31)) == []
+
+
+def test_any_in_range():
+    index = BlockedDateIndex(DAYS)
+    assert index.any_in_range(date(2026, 3, 1), date(2026, 3, 2))
+    assert index.any_in_range(date(2026, 4, 1), date(2026, 4, 1))
+    assert not index.any_in_range(date(2026, 3, 9), date(2026, 3, 31))
+    assert not index.any_in_range(date(2026, 1, 1), date(2026, 3, 1))
+    assert not index.any_in_range(date(2026, 4, 2), date(2026, 12, 31))
+
+
+def test_changed_returns_new_index():
+    index = BlockedDateIndex(DAYS)
+    # Дата раньше начала карты сдвигает базу - старые биты на своих днях
+    earlier = date(2026, 2, 1)
+    updated = index.changed(blocked=[earlier], unblocked=[date(2026, 3, 8)])
+    assert updated.in_range(date(2026, 1, 1), date(2026, 12, 31)) == [earlier, date(2026, 3, 2), date(2026, 4, 1)]
+    # Исходная карта не меняется
+    assert index.in_range(date(2026, 1, 1), date(2026, 12, 31)) == DAYS
+
+
+def test_changed_unblock_outside_index():
+    index = BlockedDateIndex(DAYS)
+    updated = index.changed(unblocked=[date(2025, 1, 1), date(2027, 1, 1)])
+    assert updated.in_range(date(2026, 1, 1), date(2026, 12, 31)) == DAYS
+    # Повторная блокировка - без изменений
+    assert len(index.changed(blocked=[DAYS[0]])) == 3
@@ -0,0 +1,35 @@
+from datetime import date
+
+import capacity
+
+DAY = date(2030, 5, 15)
+
+
+def add_booking(cursor, day, class_number, participants, status='pending', time_slot=None):
+    cursor.execute('''
+        INSERT INTO bookings (username, school_name, class_number, excursion_date,
+                              contact_phone, participants_count, status, time_slot)
+        VALUES ('Учитель', 'Школа 1', %s, %s, '+79990000000', %s, %s, %s)
+    ''', (class_number, day, participants, status, time_slot))
+
+
+def test_day_load_empty_day(conn):
+    assert capacity.day_load(conn.cursor(), DAY) == (0, 0, [])
+
+
+def test_day_load_counts_active_bookings(conn):
+    cursor = conn.cursor()
+    add_booking(cursor, DAY, '9А', 12, time_slot='10:00')
+    add_booking(cursor, DAY, '9Б', 15, status='confirmed')
+    # Отмененные и записи на другие даты не считаются
+    add_booking(cursor, DAY, '9В', 20, status='cancelled', time_slot='12:00')
+    add_booking(cursor, date(2030, 5, 16), '9А', 20, time_slot='12:00')
+
+    assert capacity.day_load(cursor, DAY) == (2, 27, ['10:00'])
+
+
+def test_day_load_sees_uncommitted_rows_of_transaction(conn):
+    # Проверка вместимости в submit_booking идет в той же транзакции, что и вставка
+    cursor = conn.cursor()
+    add_booking(cursor, DAY, '10А', 5)
+    assert capacity.day_load(cursor, DAY)[:2] == (1, 5)
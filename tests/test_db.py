@@ -0,0 +1,44 @@
+import psycopg
+import pytest
+from psycopg.rows import dict_row
+
+import db
+
+STATEMENTS = [
+    ('SELECT generate_series(1, %s) AS n', (3,)),
+    'SELECT 2 AS n',
+    ("UPDATE bookings SET status = status WHERE school_name = %s", ('нет такой школы',)),
+    ('SELECT %s::text AS n', ('последний',)),
+]
+
+
+@pytest.fixture(params=[True, False], ids=['pipeline', 'sequential'])
+def pipeline(request, monkeypatch):
+    """Оба пути run_batch: pipeline и запросы по одному (libpq старше 14)"""
+    if not request.param:
+        monkeypatch.setattr(psycopg.Pipeline, 'is_supported', classmethod(lambda cls: False))
+    elif not psycopg.Pipeline.is_supported():
+        pytest.skip('libpq без pipeline-режима')
+    return request.param
+
+
+def test_run_batch_keeps_order(conn, pipeline):
+    assert db.run_batch(conn, STATEMENTS) == [
+        [(1,), (2,), (3,)],
+        [(2,)],
+        0,
+        [('последний',)],
+    ]
+
+
+def test_run_batch_row_factory(conn, pipeline):
+    results = db.run_batch(conn, STATEMENTS, row_factory=dict_row)
+    assert results[1] == [{'n': 2}]
+    assert results[3] == [{'n': 'последний'}]
+
+
+def test_run_batch_error_aborts_transaction(conn, pipeline):
+    with pytest.raises(psycopg.errors.DivisionByZero):
+        db.run_batch(conn, ['SELECT 1', 'SELECT 1 / 0', 'SELECT 3'])
+    conn.rollback()
+    assert db.run_batch(conn, ['SELECT 1']) == [[(1,)]]
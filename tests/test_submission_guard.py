@@ -0,0 +1,57 @@
+import pytest
+
+import submission_guard
+
+
+@pytest.fixture
+def bucket(conn, monkeypatch):
+    """Корзина на 2 жетона, пополнение - жетон в секунду"""
+    monkeypatch.setattr(submission_guard, 'RATE_LIMIT_BURST', 2)
+    monkeypatch.setattr(submission_guard, 'RATE_LIMIT_PER_MINUTE', 60)
+    cursor = conn.cursor()
+    cursor.execute('DELETE FROM rate_limits')
+    return cursor
+
+
+def age_bucket(cursor, key, seconds):
+    """Сдвигает время последнего списания в прошлое вместо ожидания"""
+    cursor.execute('UPDATE rate_limits SET updated_at = updated_at - make_interval(secs => %s) WHERE key = %s',
+                   (seconds, key))
+
+
+def test_take_token_burst(bucket):
+    assert submission_guard.take_token(bucket, 'test:a')
+    assert submission_guard.take_token(bucket, 'test:a')
+    assert not submission_guard.take_token(bucket, 'test:a')
+    # У другого ключа своя корзина
+    assert submission_guard.take_token(bucket, 'test:b')
+
+
+def test_take_token_refill(bucket):
+    assert submission_guard.take_token(bucket, 'test:a')
+    assert submission_guard.take_token(bucket, 'test:a')
+    assert not submission_guard.take_token(bucket, 'test:a')
+
+    # Через полторы секунды пополнился один жетон
+    age_bucket(bucket, 'test:a', 1.5)
+    assert submission_guard.take_token(bucket, 'test:a')
+    assert not submission_guard.take_token(bucket, 'test:a')
+
+
+def test_take_token_refill_capped_at_burst(bucket):
+    assert submission_guard.take_token(bucket, 'test:a')
+    # За час жетонов больше, чем RATE_LIMIT_BURST, не становится
+    age_bucket(bucket, 'test:a', 3600)
+    assert submission_guard.take_token(bucket, 'test:a')
+    assert submission_guard.take_token(bucket, 'test:a')
+    assert not submission_guard.take_token(bucket, 'test:a')
+
+
+def test_rejected_take_keeps_tokens(bucket):
+    assert submission_guard.take_token(bucket, 'test:a')
+    assert submission_guard.take_token(bucket, 'test:a')
+    # Отказ не двигает время списания - накопленное пополнение не теряется
+    age_bucket(bucket, 'test:a', 0.6)
+    assert not submission_guard.take_token(bucket, 'test:a')
+    age_bucket(bucket, 'test:a', 0.6)
+    assert submission_guard.take_token(bucket, 'test:a')
@@ -0,0 +1,91 @@
+import uuid
+from datetime import date, timedelta
+
+import pytest
+
+import db
+import submission_guard
+
+
+def next_wednesday():
+    # Понедельник и пятница закрыты правилами по умолчанию (capacity.py)
+    day = date.today() + timedelta(days=30)
+    return day + timedelta(days=(2 - day.weekday()) % 7)
+
+
+DAY = next_wednesday()
+
+
+@pytest.fixture
+def client(clean, monkeypatch):
+    import app
+    # Лимит частоты проверяется отдельно (test_submission_guard.py)
+    monkeypatch.setattr(submission_guard, 'RATE_LIMIT_BURST', 1000)
+    return app.app.test_client()
+
+
+def form(**overrides):
+    data = {
+        'excursion_date': DAY.isoformat(),
+        'username': 'Иванова Мария',
+        'school_name': 'Школа 1',
+        'class_number': '9А',
+        'contact_phone': '+79990000000',
+        'participants_count': '15',
+        'idempotency_key': str(uuid.uuid4()),
+    }
+    data.update(overrides)
+    return data
+
+
+def bookings():
+    conn = db.get_db_connection()
+    try:
+        return conn.execute('SELECT school_name, class_number, status FROM bookings ORDER BY id').fetchall()
+    finally:
+        conn.rollback()
+        conn.close()
+
+
+def test_submit_creates_booking(client):
+    response = client.post('/submit_booking', data=form())
+    assert response.status_code == 200
+    assert bookings() == [('Школа 1', '9А', 'pending')]
+
+
+def test_repeated_submit_is_idempotent(client):
+    data = form()
+    first = client.post('/submit_booking', data=data)
+    second = client.post('/submit_booking', data=data)
+    # Повтор той же формы - тот же ответ об успехе, но без второй записи
+    assert first.status_code == second.status_code == 200
+    assert 'Школа 1' in second.get_data(as_text=True)
+    assert len(bookings()) == 1
+
+
+def test_duplicate_class_on_same_day_is_rejected(client):
+    assert client.post('/submit_booking', data=form()).status_code == 200
+    # Другая форма (новый ключ), тот же класс: регистр и пробелы не важны
+    response = client.post('/submit_booking', data=form(school_name=' школа 1 ', class_number='9а'))
+    assert response.status_code == 409
+    assert len(bookings()) == 1
+
+
+def test_other_class_or_day_is_not_duplicate(client):
+    assert client.post('/submit_booking', data=form()).status_code == 200
+    assert client.post('/submit_booking', data=form(class_number='9Б')).status_code == 200
+    next_week = (DAY + timedelta(days=7)).isoformat()
+    assert client.post('/submit_booking', data=form(excursion_date=next_week)).status_code == 200
+    assert len(bookings()) == 3
+
+
+def test_cancelled_booking_does_not_block_new_one(client):
+    assert client.post('/submit_booking', data=form()).status_code == 200
+    conn = db.get_db_connection()
+    try:
+        conn.execute("UPDATE bookings SET status = 'cancelled'")
+        conn.commit()
+    finally:
+        conn.close()
+    assert client.post('/submit_booking', data=form()).status_code == 200
+    assert [row[2] for row in bookings()] == ['cancelled', 'pending']
@@ -0,0 +1,205 @@
+# xlsx_stream.py - Потоковая запись XLSX без сторонних библиотек
+#
+# XLSX - zip-архив с XML-частями. Лист пишется в архив построчно по мере
+# поступления строк из серверного курсора: zipfile умеет писать в
+# непозиционируемый поток (размеры и CRC уходят в data descriptor после
+# данных записи), а генератор отдает накопленные байты архива порциями.
+# Память не зависит от количества строк.
+#
+# Строки пишутся inline-строками (t="inlineStr"), без таблицы sharedStrings:
+# ее пришлось бы держать в памяти до конца листа. Текст остается текстом
+# (телефон с '+' не становится числом), числа - числами, date/datetime -
+# датами Excel с форматом дд.мм.гггг.
+import re
+import zipfile
+from datetime import date, datetime
+from xml.sax.saxutils import escape
+
+# Стили (индексы cellXfs в STYLES_XML)
+STYLE_HEADER = 1
+STYLE_DATE = 2
+STYLE_DATETIME = 3
+
+CONTENT_TYPES_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    '<Default Extension="xml" ContentType="application/xml"/>'
+    '<Override PartName="/xl/workbook.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+    '<Override PartName="/xl/worksheets/sheet1.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+    '<Override PartName="/xl/styles.xml" '
+    'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.styles+xml"/>'
+    '</Types>'
+)
+
+ROOT_RELS_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+    'Target="xl/workbook.xml"/>'
+    '</Relationships>'
+)
+
+WORKBOOK_RELS_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    '<Relationship Id="rId1" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+    'Target="worksheets/sheet1.xml"/>'
+    '<Relationship Id="rId2" '
+    'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/styles" '
+    'Target="styles.xml"/>'
+    '</Relationships>'
+)
+
+STYLES_XML = (
+    '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    '<styleSheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+    '<numFmts count="2">'
+    '<numFmt numFmtId="164" formatCode="dd.mm.yyyy"/>'
+    '<numFmt numFmtId="165" formatCode="dd.mm.yyyy hh:mm"/>'
+    '</numFmts>'
+    '<fonts count="2">'
+    '<font><sz val="11"/><name val="Calibri"/></font>'
+    '<font><b/><sz val="11"/><name val="Calibri"/></font>'
+    '</fonts>'
+    '<fills count="2">'
+    '<fill><patternFill patternType="none"/></fill>'
+    '<fill><patternFill patternType="gray125"/></fill>'
+    '</fills>'
+    '<borders count="1"><border><left/><right/><top/><bottom/><diagonal/></border></borders>'
+    '<cellStyleXfs count="1"><xf numFmtId="0" fontId="0" fillId="0" borderId="0"/></cellStyleXfs>'
+    '<cellXfs count="4">'
+    '<xf numFmtId="0" fontId="0" fillId="0" borderId="0" xfId="0"/>'
+    '<xf numFmtId="0" fontId="1" fillId="0" borderId="0" xfId="0" applyFont="1"/>'
+    '<xf numFmtId="164" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    '<xf numFmtId="165" fontId="0" fillId="0" borderId="0" xfId="0" applyNumberFormat="1"/>'
+    '</cellXfs>'
+    '<cellStyles count="1"><cellStyle name="Normal" xfId="0" builtinId="0"/></cellStyles>'
+    '</styleSheet>'
+)
+
+# Символы, недопустимые в XML 1.0 (управляющие, кроме табуляции и переводов строк)
+_INVALID_XML = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+# Дополнительное экранирование для значений атрибутов
+_ATTR_ENTITIES = {'"': '&quot;'}
+
+# Начало отсчета дат Excel (система 1900 с ошибкой високосного 1900 года)
+_EXCEL_EPOCH = datetime(1899, 12, 30)
+
+
+class _Sink:
+    """Непозиционируемый поток для zipfile: копит байты до take()"""
+
+    def __init__(self):
+        self.chunks = []
+
+    def write(self, data):
+        self.chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def take(self):
+        data = b''.join(self.chunks)
+        self.chunks = []
+        return data
+
+
+def column_letter(index):
+    """Буква колонки Excel по номеру с нуля: 0 -> A, 26 -> AA"""
+    letters = ''
+    index += 1
+    while index:
+        index, remainder = divmod(index - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+def _text(value):
+    return escape(_INVALID_XML.sub('', value))
+
+
+def _cell(ref, value):
+    if value is None or value == '':
+        return ''
+    if isinstance(value, bool):
+        return f'<c r="{ref}" t="b"><v>{int(value)}</v></c>'
+    if isinstance(value, (int, float)):
+        return f'<c r="{ref}"><v>{value}</v></c>'
+    if isinstance(value, datetime):
+        serial = (value.replace(tzinfo=None) - _EXCEL_EPOCH).total_seconds() / 86400
+        return f'<c r="{ref}" s="{STYLE_DATETIME}"><v>{serial:.10f}</v></c>'
+    if isinstance(value, date):
+        serial = (value - _EXCEL_EPOCH.date()).days
+        return f'<c r="{ref}" s="{STYLE_DATE}"><v>{serial}</v></c>'
+    return f'<c r="{ref}" t="inlineStr"><is><t xml:space="preserve">{_text(str(value))}</t></is></c>'
+
+
+def stream_xlsx(rows, header, sheet_name='Лист1', widths=None, chunk_rows=1000):
+    """Генератор порций байтов XLSX-файла с одним листом.
+
+    rows - итерируемое строк (последовательностей значений), header -
+    заголовки колонок (первая строка, закреплена, с автофильтром), widths -
+    ширины колонок в символах. Порция отдается на каждые chunk_rows строк.
+    """
+    sink = _Sink()
+    letters = [column_letter(i) for i in range(len(header))]
+
+    archive = zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED)
+    archive.writestr('[Content_Types].xml', CONTENT_TYPES_XML)
+    archive.writestr('_rels/.rels', ROOT_RELS_XML)
+    archive.writestr('xl/workbook.xml', (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        f'<sheets><sheet name="{escape(sheet_name, _ATTR_ENTITIES)}" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'
+    ))
+    archive.writestr('xl/_rels/workbook.xml.rels', WORKBOOK_RELS_XML)
+    archive.writestr('xl/styles.xml', STYLES_XML)
+
+    with archive.open('xl/worksheets/sheet1.xml', 'w') as sheet:
+        parts = [
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main">'
+            '<sheetViews><sheetView workbookViewId="0">'
+            '<pane ySplit="1" topLeftCell="A2" activePane="bottomLeft" state="frozen"/>'
+            '</sheetView></sheetViews>'
+        ]
+        if widths:
+            parts.append('<cols>')
+            parts.extend(f'<col min="{i}" max="{i}" width="{width}" customWidth="1"/>'
+                         for i, width in enumerate(widths, 1))
+            parts.append('</cols>')
+        parts.append('<sheetData><row r="1">')
+        parts.extend(f'<c r="{letter}1" t="inlineStr" s="{STYLE_HEADER}"><is><t>{_text(title)}</t></is></c>'
+                     for letter, title in zip(letters, header))
+        parts.append('</row>')
+        sheet.write(''.join(parts).encode('utf-8'))
+        parts = []
+        yield sink.take()
+
+        number = 1
+        for row in rows:
+            number += 1
+            parts.append(f'<row r="{number}">')
+            parts.extend(_cell(f'{letter}{number}', value) for letter, value in zip(letters, row))
+            parts.append('</row>')
+            if number % chunk_rows == 1:
+                sheet.write(''.join(parts).encode('utf-8'))
+                parts = []
+                yield sink.take()
+
+        parts.append('</sheetData>')
+        parts.append(f'<autoFilter ref="A1:{letters[-1]}{number}"/>')
+        parts.append('</worksheet>')
+        sheet.write(''.join(parts).encode('utf-8'))
+
+    archive.close()
+    yield sink.take()